@@ -1,24 +1,46 @@
 import time
 import os
+import json
+import uuid
 import logging
+import itertools
+from functools import partial
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import base64
-import io
-import cv2
-import numpy as np
-import pytesseract
-from PIL import Image
-from flask import Flask, render_template, request, jsonify, session, url_for, redirect
+from flask import Flask, render_template, request, jsonify, session, url_for, redirect, Response, stream_with_context, g, abort
+from sqlalchemy import event
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
+import models
+from extensions import db
 
 # Load environment variables from .env file
 load_dotenv()
-from utils.huggingface_api import get_ai_response, get_specialized_ai_response
+from utils.huggingface_api import get_ai_response, get_specialized_ai_response, stream_specialized_ai_response, \
+    get_packed_ai_responses
+from utils.image_pipeline import optimize_for_display, prepare_for_gemini, thumbnail_for_display
+from utils.image_workers import image_workers
+from utils.ocr import binarize_for_ocr, recognize_text, ocr_prompt, ocr_gate, OCR_TIMEOUT
+from utils.upload_store import UploadStore
+from utils.gemini_client import gemini_client
+from utils.response_cache import response_cache, hash_bytes
+from utils.single_flight import single_flight
+from utils.near_duplicates import near_duplicates
+from utils.image_index import image_index
+from utils.scheduler import upstream_scheduler, SchedulerOverloaded
+from utils.resilience import upstream_guard
+from utils.key_pool import key_pool
+from utils.batch import batch_runner, BATCH_MAX_QUESTIONS
+from utils.metrics import metrics, REQUEST_METRIC
+from utils.assets import AssetManifest, MATHJAX_COMPONENTS_URL
+from utils.compression import response_compressor
+from utils.answer_render import answer_renderer
+from utils.upload_jobs import upload_jobs
 
 # Set environment variables directly in code
 
-# Set up logging - giảm mức log để tăng hiệu suất
-logging.basicConfig(level=logging.INFO)
+# Set up logging - giảm mức log để tăng hiệu suất (LOG_LEVEL=DEBUG khi cần debug)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
 # Create Flask app 
@@ -31,6 +53,13 @@ logger.debug("Setting app config")
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
 logger.debug("Setting app config")
 app.config['UPLOAD_FOLDER'] = os.path.join('static', 'uploads')
+# Ghi ảnh tải lên ra đĩa (tắt bằng PERSIST_UPLOADS=0 để xử lý hoàn toàn trong bộ nhớ)
+app.config['PERSIST_UPLOADS'] = os.environ.get('PERSIST_UPLOADS', '1') != '0'
+# Ảnh đã xử lý trong JSON của upload_image: chỉ URL (mặc định), ảnh thu nhỏ, hoặc cả ảnh base64 như trước
+UPLOAD_IMAGE_RESPONSE_MODES = ('url', 'thumbnail', 'inline')
+app.config['UPLOAD_IMAGE_RESPONSE'] = os.environ.get('UPLOAD_IMAGE_RESPONSE', 'url')
+# JSON dạng UTF-8 thay vì \uXXXX: câu trả lời tiếng Việt nhỏ hơn khoảng một nửa khi không nén
+app.json.ensure_ascii = False
 
 # Đặt API key từ biến môi trường - không lưu vào app.config nữa để tránh ghi đè
 logger.debug("Setting API key from environment variable")
@@ -45,14 +74,187 @@ else:
 logger.debug("Setting app config")
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 31536000  # 1 năm cache cho static files
 
+# URL asset theo hash nội dung, tính một lần khi khởi động; template gọi asset_url()/vendor_url()
+assets = AssetManifest(app.static_folder)
+
+def asset_url(path):
+    """Fingerprinted URL of a file under static/, falling back to the plain static URL."""
+    return assets.url(path) or url_for('static', filename=path)
+
+app.jinja_env.globals.update(asset_url=asset_url, vendor_url=assets.vendor_url, vendored=assets.is_vendored,
+                             mathjax_components_url=MATHJAX_COMPONENTS_URL)
+
+# Lịch sử chat lưu phía server, cookie chỉ giữ session id
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///chat_history.db')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "pool_recycle": 300,
+    "pool_pre_ping": True,
+}
+db.init_app(app)
+
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
 # Create upload folder if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# Kho ảnh tải lên định danh theo nội dung, có dọn dẹp theo tuổi và dung lượng
+upload_store = UploadStore(app.config['UPLOAD_FOLDER'])
+
+# Gauge cho /metrics, đọc từ stats() của từng module lúc Prometheus scrape
+metrics.register_gauge('app_upstream_in_flight', 'Gemini calls currently in flight',
+                       lambda: [({}, gemini_client.stats()['in_flight'])])
+metrics.register_gauge('app_scheduler_calls', 'Upstream scheduler calls by state',
+                       lambda: [({'state': state}, upstream_scheduler.stats()[state]) for state in ('running', 'queued')])
+metrics.register_gauge('app_circuit_open', '1 while the Gemini circuit breaker fails calls fast',
+                       lambda: [({}, int(upstream_guard.breaker.is_open()))])
+metrics.register_gauge('app_image_pool_queue_depth', 'Image jobs waiting for a pool worker',
+                       lambda: [({}, image_workers.stats()['queue_depth'])])
+# Bộ đếm của các module xuất ra app_stats{module,stat} trên /metrics
+metrics.register_stats('gemini_pool', gemini_client.stats)
+metrics.register_stats('response_cache', response_cache.stats)
+metrics.register_stats('near_duplicates', near_duplicates.stats)
+metrics.register_stats('image_index', image_index.stats)
+metrics.register_stats('single_flight', single_flight.stats)
+metrics.register_stats('scheduler', upstream_scheduler.stats)
+metrics.register_stats('upstream', upstream_guard.stats)
+metrics.register_stats('key_pool', key_pool.stats)
+metrics.register_stats('batch', batch_runner.stats)
+metrics.register_stats('image_pool', image_workers.stats)
+metrics.register_stats('ocr', ocr_gate.stats)
+metrics.register_stats('assets', assets.stats)
+metrics.register_stats('compression', response_compressor.stats)
+metrics.register_stats('render', answer_renderer.stats)
+metrics.register_stats('upload_jobs', upload_jobs.stats)
+metrics.register_stats('upload_store', upload_store.stats)
+
 # Không cần danh sách môn học nữa do đã loại bỏ tính năng này
 
 # Định nghĩa định dạng file được phép (vẫn cần cho phương thức allowed_file)
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        # WAL để các worker gunicorn ghi lịch sử mà không chặn nhau khi đọc
+        @event.listens_for(db.engine, 'connect')
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.close()
+
+    db.create_all()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    started = g.get('request_started')
+    if started is not None:
+        metrics.observe(REQUEST_METRIC, time.perf_counter() - started,
+                        route=request.endpoint or 'unknown', status=str(response.status_code))
+    return response
+
+# Đăng ký sau record_request_duration nên chạy trước nó: thời gian nén được tính vào request
+@app.after_request
+def compress_response(response):
+    with metrics.span(request.endpoint or 'unknown', 'compress'):
+        return response_compressor.maybe_compress(response, request.headers.get('Accept-Encoding', ''))
+
+def history_session_id():
+    """Return the history id of this browser session, creating it on first use."""
+    if 'history_id' not in session:
+        session['history_id'] = uuid.uuid4().hex
+    return session['history_id']
+
+def append_history(entry, session_id=None):
+    """Append one exchange to the server-side chat history of this session (or of session_id)."""
+    try:
+        models.SearchHistory.append(session_id or history_session_id(), entry)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error saving history: {str(e)}")
+
+def bypass_cache_requested(data):
+    """Check the per-request flag that skips the shared response cache."""
+    return str(data.get('bypass_cache', '')).lower() in ('1', 'true', 'yes', 'on')
+
+def async_requested(data):
+    """Check whether the client asked for a job id instead of waiting for the answer."""
+    return str(data.get('async', '')).lower() in ('1', 'true', 'yes', 'on') or \
+        'respond-async' in request.headers.get('Prefer', '')
+
+def wants_stream():
+    """Check whether the client asked for a server-sent-events response."""
+    return 'text/event-stream' in request.headers.get('Accept', '')
+
+def sse_event(data, event=None):
+    """Format one server-sent event with a JSON payload."""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def start_stream(chunks):
+    """Pull the first chunk before responding so an overload can still become a 429."""
+    chunks = iter(chunks)
+    try:
+        first = next(chunks)
+    except StopIteration:
+        return iter(())
+    return itertools.chain([first], chunks)
+
+def overloaded_response(e):
+    """Build the fast 429 returned when the upstream scheduler rejects a request."""
+    logger.warning(f"Upstream scheduler rejected request: {e.reason}")
+    response = jsonify({"error": "Hệ thống đang quá tải, vui lòng thử lại sau ít giây.",
+                        "retry_after": e.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def stream_answer(chunks, history_entry, extra=None):
+    """
+    Relay answer chunks as SSE and finish with the full answer.
+
+    The history id is put in the session before the stream starts so the
+    cookie carries it; the full answer is appended to the history at the end.
+    extra is merged into the done event; a callable is called once the
+    answer has finished streaming.
+    """
+    session_id = history_session_id()
+
+    def generate():
+        parts = []
+        try:
+            for chunk in chunks:
+                parts.append(chunk)
+                yield sse_event({"text": chunk})
+        except Exception as e:
+            logger.error(f"Error while streaming answer: {str(e)}")
+            yield sse_event({"error": f"Đã xảy ra lỗi: {str(e)}"}, event="error")
+            return
+
+        entry = dict(history_entry, bot="".join(parts))
+        try:
+            models.SearchHistory.append(session_id, entry)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error saving history: {str(e)}")
+        # HTML dựng sẵn thay cho bản client tự định dạng trong lúc stream
+        with metrics.span(request.endpoint or 'unknown', 'render'):
+            response_html = answer_renderer.render(entry['bot'])
+        done = {
+            "response": entry['bot'],
+            "response_html": response_html,
+            "solution_mode": entry['solution_mode']
+        }
+        done.update((extra() if callable(extra) else extra) or {})
+        yield sse_event(done, event="done")
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api_key', methods=['GET', 'POST'])
 def set_api_key():
     """Set Google AI API key."""
@@ -79,10 +281,8 @@ def index():
         # Đảm bảo thư mục uploads tồn tại
         os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
         
-        # Initialize chat history if not present
-        if 'chat_history' not in session:
-            # Không thêm tin nhắn chào nữa, chỉ khởi tạo mảng trống
-            session['chat_history'] = []
+        # Lịch sử đã chuyển sang server, bỏ bản cũ còn nằm trong cookie
+        session.pop('chat_history', None)
         
         # Kiểm tra xem có API key trong biến môi trường không
         env_api_key = os.environ.get('GOOGLE_AI_API_KEY')
@@ -94,23 +294,51 @@ def index():
         if 'google_ai_api_key' in session:
             app.config['GOOGLE_AI_API_KEY'] = session['google_ai_api_key']
         
-        # Cache busting cho phát triển
-        no_cache = int(time.time())
+        # Asset có URL theo hash nội dung nên không cần tham số chống cache;
+        # chỉ trang HTML phải kiểm tra lại mỗi lần để nhận URL mới sau khi deploy
         logger.info("Rendering index page")
-        return render_template('index.html', no_cache=no_cache)
+        response = app.make_response(render_template('index.html'))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         logger.error(f"Error in index route: {str(e)}")
         return render_template('error.html', error=str(e))
 
+@app.route(f'{assets.url_prefix}/<digest>/<path:filename>')
+def serve_asset(digest, filename):
+    """Serve a static file by content hash, with a strong ETag and a precompressed variant."""
+    asset = assets.get(filename)
+    if asset is None:
+        abort(404)
+    encoding = assets.choose_encoding(asset, request.headers.get('Accept-Encoding', ''))
+    # Hash cũ (trang HTML cũ sau khi deploy): trả nội dung hiện tại nhưng không cho cache lâu
+    stale = digest != asset.digest
+    etag = asset.etag(encoding)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        assets.count(encoding, 0, not_modified=True, stale=stale)
+    else:
+        body = assets.read(asset, encoding)
+        response = Response(body, mimetype=asset.mime_type)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        assets.count(encoding, len(body), stale=stale)
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache' if stale else 'public, max-age=31536000, immutable'
+    return response
+
 @app.route('/send_message', methods=['POST'])
 def send_message():
     """Process a message sent by the user and return AI response."""
     try:
-        data = request.json
+        with metrics.span('send_message', 'parse'):
+            data = request.get_json(silent=True) or request.form
         user_message = data.get('message', '')
         solution_mode = data.get('solution_mode', 'full')  # full, step_by_step, or hint
         subject = data.get('subject', 'chung')  # Không giới hạn môn học
         mode = data.get('mode', 'giải bài tập')  # Mặc định là "giải bài tập"
+        use_cache = not bypass_cache_requested(data)
         
         # Log incoming request
         logger.debug(f"Received message request: {user_message[:50]}...")
@@ -119,37 +347,308 @@ def send_message():
         if not user_message:
             return jsonify({"error": "Tin nhắn không được để trống"}), 400
         
+        if wants_stream():
+            chunks = start_stream(stream_specialized_ai_response(user_message, subject, mode, solution_mode,
+                                                                 use_cache=use_cache,
+                                                                 session_id=history_session_id()))
+            return stream_answer(chunks, {
+                'user': user_message,
+                'solution_mode': solution_mode,
+                'subject': subject,
+                'mode': mode
+            })
+        
         # Sử dụng API Gemini để lấy phản hồi
-        response_text = get_specialized_ai_response(user_message, subject, mode, solution_mode)
+        with metrics.span('send_message', 'upstream'):
+            response_text = get_specialized_ai_response(user_message, subject, mode, solution_mode,
+                                                        use_cache=use_cache, session_id=history_session_id())
         
         # Save to history
-        if 'chat_history' not in session:
-            session['chat_history'] = []
-        
-        session['chat_history'].append({
-            'user': user_message,
-            'bot': response_text,
-            'solution_mode': solution_mode,
-            'subject': subject,
-            'mode': mode
-        })
+        with metrics.span('send_message', 'history'):
+            append_history({
+                'user': user_message,
+                'bot': response_text,
+                'solution_mode': solution_mode,
+                'subject': subject,
+                'mode': mode
+            })
         
-        session.modified = True
+        # Dựng sẵn HTML (Markdown + MathML) để client chỉ việc chèn vào trang
+        with metrics.span('send_message', 'render'):
+            response_html = answer_renderer.render(response_text)
         
-        return jsonify({
-            "response": response_text,
-            "solution_mode": solution_mode
-        })
+        with metrics.span('send_message', 'serialize'):
+            return jsonify({
+                "response": response_text,
+                "response_html": response_html,
+                "solution_mode": solution_mode
+            })
+    
+    except SchedulerOverloaded as e:
+        return overloaded_response(e)
     
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
         return jsonify({"error": f"Đã xảy ra lỗi: {str(e)}"}), 500
 
+def batch_questions(data):
+    """Read the questions of a batch: a JSON list, or one question per line."""
+    questions = data.get('questions') or []
+    if isinstance(questions, str):
+        questions = questions.splitlines()
+    return [str(q).strip() for q in questions if str(q).strip()]
+
+@app.route('/send_batch', methods=['POST'])
+def send_batch():
+    """
+    Answer a worksheet of questions sharing mode, solution_mode and subject.
+
+    Questions are answered concurrently (short ones packed into one Gemini
+    call). The JSON response lists answers in question order; with
+    Accept: text/event-stream each answer is sent as soon as it is ready.
+    """
+    data = request.get_json(silent=True) or {}
+    questions = batch_questions(data)
+    solution_mode = data.get('solution_mode', 'full')
+    subject = data.get('subject', 'chung')
+    mode = data.get('mode', 'giải bài tập')
+    use_cache = not bypass_cache_requested(data)
+    pack = data.get('pack')
+    concurrency = data.get('concurrency')
+
+    if not questions:
+        return jsonify({"error": "Danh sách câu hỏi không được để trống"}), 400
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"Mỗi lượt tối đa {BATCH_MAX_QUESTIONS} câu hỏi"}), 400
+    if concurrency is not None and (not isinstance(concurrency, int) or isinstance(concurrency, bool)
+                                    or concurrency < 1):
+        return jsonify({"error": "concurrency phải là số nguyên dương"}), 400
+
+    session_id = history_session_id()
+    overloaded_message = "Hệ thống đang quá tải, vui lòng thử lại sau ít giây."
+
+    # Các câu trả lời chạy trên thread riêng nên cần app context để đọc cấu hình
+    def answer_one(question):
+        with app.app_context():
+            try:
+                return get_specialized_ai_response(question, subject, mode, solution_mode, use_cache=use_cache,
+                                                   session_id=session_id)
+            except SchedulerOverloaded:
+                return overloaded_message
+
+    def answer_packed(group):
+        with app.app_context():
+            try:
+                return get_packed_ai_responses(group, subject, mode, solution_mode, use_cache=use_cache,
+                                               session_id=session_id)
+            except SchedulerOverloaded:
+                return [overloaded_message] * len(group)
+
+    results = batch_runner.run(questions, answer_one, answer_packed,
+                               pack=None if pack is None else bool(pack), concurrency=concurrency)
+
+    def save_history(answers):
+        for index in sorted(answers):
+            entry = {
+                'user': questions[index],
+                'bot': answers[index],
+                'solution_mode': solution_mode,
+                'subject': subject,
+                'mode': mode
+            }
+            try:
+                models.SearchHistory.append(session_id, entry)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error saving history: {str(e)}")
+
+    if wants_stream():
+        def generate():
+            answers = {}
+            try:
+                for index, answer in results:
+                    answers[index] = answer
+                    yield sse_event({"index": index, "question": questions[index], "response": answer},
+                                    event="answer")
+            except Exception as e:
+                logger.error(f"Error while streaming batch: {str(e)}")
+                yield sse_event({"error": f"Đã xảy ra lỗi: {str(e)}"}, event="error")
+                return
+            save_history(answers)
+            yield sse_event({"count": len(answers), "solution_mode": solution_mode}, event="done")
+
+        return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    try:
+        answers = dict(results)
+    except Exception as e:
+        logger.error(f"Error processing batch: {str(e)}")
+        return jsonify({"error": f"Đã xảy ra lỗi: {str(e)}"}), 500
+    save_history(answers)
+    return jsonify({
+        "responses": [{"question": questions[i], "response": answers[i]} for i in range(len(questions))],
+        "solution_mode": solution_mode
+    })
+
+def finish_image_work(work, upload, route):
+    """
+    Wait for the optimized display copy and store the upload before its URLs are returned.
+
+    The original is stored even when optimizing it failed.
+
+    Returns:
+        The optimized JPEG, or None if it was not needed or could not be made
+    """
+    optimized_jpeg = work['optimized_jpeg']
+    if work['display_future'] is not None:
+        try:
+            # Thường đã xong trong lúc chờ Gemini
+            with metrics.span(route, 'clahe_wait'):
+                optimized_jpeg = work['display_future'].result()
+        except Exception as e:
+            logger.error(f"Lỗi khi tối ưu ảnh: {str(e)}")
+    # Bản tối ưu lấy từ kho thì ảnh gốc cũng đã nằm trong kho
+    if upload['persist'] and work['optimized_jpeg'] is None:
+        try:
+            with metrics.span(route, 'store_save'):
+                upload_store.save(work['sha256'], work['data'], optimized_jpeg)
+        except Exception as e:
+            logger.error(f"Lỗi khi lưu ảnh: {str(e)}")
+    return optimized_jpeg
+
+def stored_image_urls(upload, optimized_jpeg):
+    """URLs of the stored upload; the optimized one points at the original if optimizing failed."""
+    optimized_image = upload['optimized_image'] if optimized_jpeg is not None else upload['original_image']
+    return {"original_image": upload['original_image'], "optimized_image": optimized_image}
+
 def allowed_file(filename):
     """Check if file has an allowed extension."""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def start_image_work(data, sha256, upload, route):
+    """Submit the image work of an upload to the pool: display variants, OCR and the Gemini copy."""
+    # Ảnh đã từng tải lên: dùng lại bản tối ưu trong kho, không chạy lại CLAHE.
+    # Nếu chưa có, CLAHE chạy trong pool tiến trình song song với lời gọi Gemini.
+    # Bản tối ưu cỡ gốc chỉ cần khi lưu vào kho hoặc client yêu cầu trả cả ảnh.
+    work = {'data': data, 'sha256': sha256, 'optimized_jpeg': None, 'display_future': None,
+            'thumbnail_future': None}
+    if upload['persist'] or upload['image_response'] == 'inline':
+        with metrics.span(route, 'store_lookup'):
+            work['optimized_jpeg'] = upload_store.load_optimized(sha256) if upload['persist'] else None
+        if work['optimized_jpeg'] is None:
+            work['display_future'] = image_workers.submit(optimize_for_display, data)
+    if upload['image_response'] == 'thumbnail':
+        work['thumbnail_future'] = image_workers.submit(thumbnail_for_display, data)
+    
+    # Chuẩn bị ảnh cho OCR và bước thu nhỏ/nén ảnh chạy song song trong pool
+    work['ocr_future'] = image_workers.submit(binarize_for_ocr, data) if ocr_gate.enabled else None
+    work['prepare_future'] = image_workers.submit(prepare_for_gemini, data, sha256)
+    return work
+
+def upload_prompt(work, route):
+    """
+    Wait for OCR or the prepared image and build what is sent to Gemini.
+
+    Returns:
+        (prompt, image, ocr_used); image is None when the OCR text is sent instead
+
+    Raises:
+        ValueError: The upload cannot be decoded
+    """
+    ocr_result = None
+    if work['ocr_future'] is not None:
+        try:
+            with metrics.span(route, 'ocr'):
+                # Quá hạn thì gửi ảnh như bình thường, không để request chờ tesseract mãi
+                deadline = time.monotonic() + OCR_TIMEOUT
+                binary = work['ocr_future'].result(timeout=OCR_TIMEOUT)
+                # Tesseract chạy ở greenlet của request để subprocess của gevent không chặn worker
+                remaining = deadline - time.monotonic()
+                if binary is not None and remaining > 0:
+                    ocr_result = recognize_text(binary, timeout=remaining)
+        except FutureTimeoutError:
+            work['ocr_future'].cancel()
+            logger.warning(f"OCR took longer than {OCR_TIMEOUT}s, sending image")
+        except Exception as e:
+            logger.warning(f"OCR failed, sending image: {str(e)}")
+    
+    if work['ocr_future'] is not None and ocr_gate.accept(ocr_result):
+        # Bài in rõ nét: chỉ gửi chữ, nhỏ hơn nhiều và cache được theo nội dung chữ
+        return ocr_prompt(ocr_result.text), None, True
+    
+    # Ảnh được thu nhỏ/nén lại trong pool trước khi gửi, không đọc lại từ đĩa
+    with metrics.span(route, 'prepare'):
+        image = work['prepare_future'].result()
+    # Tạo prompt mô tả cho AI
+    prompt = f"Đây là ảnh chứa nội dung mà học sinh muốn hỏi. Hãy phân tích thông tin trong ảnh và trả lời câu hỏi liên quan. Nếu không thấy rõ ảnh, hãy thông báo."
+    return prompt, image, False
+
+def answer_upload(work, prompt, image, ocr_used, upload, session_id, route):
+    """
+    Get the answer for an upload, save it to the history and build the JSON result.
+
+    Raises:
+        ValueError: The upload cannot be decoded
+    """
+    # Sử dụng API Gemini để lấy phản hồi với chế độ giải bài phù hợp
+    # và truyền ảnh để Gemini phân tích
+    with metrics.span(route, 'upstream'):
+        response_text = get_specialized_ai_response(prompt, upload['subject'], upload['mode'],
+                                                    upload['solution_mode'], use_cache=upload['use_cache'],
+                                                    image=image, session_id=session_id)
+    
+    # Lưu vào lịch sử chat
+    with metrics.span(route, 'history'):
+        append_history({
+            'user': f"[Ảnh đã tải lên: {upload['filename']}]",
+            'bot': response_text,
+            'solution_mode': upload['solution_mode'],
+            'subject': upload['subject'],
+            'mode': upload['mode'],
+            'image_url': upload['image_url']
+        }, session_id)
+    
+    # Lưu ảnh vào kho trước khi trả về để URL trả về đã có file
+    optimized_jpeg = finish_image_work(work, upload, route)
+    if work['thumbnail_future'] is not None:
+        with metrics.span(route, 'thumbnail_wait'):
+            thumbnail_jpeg = work['thumbnail_future'].result()
+    
+    with metrics.span(route, 'render'):
+        response_html = answer_renderer.render(response_text)
+    
+    result = {
+        "status": "success",
+        "response": response_text,
+        "response_html": response_html,
+        "solution_mode": upload['solution_mode'],
+        "ocr_used": ocr_used
+    }
+    result.update(stored_image_urls(upload, optimized_jpeg))
+    # Ảnh đã xử lý đã có ở URL cache được; chỉ nhúng base64 khi client yêu cầu
+    with metrics.span(route, 'base64'):
+        if upload['image_response'] == 'inline':
+            # Tối ưu lỗi thì trả ảnh gốc
+            result["optimized_image_b64"] = base64.b64encode(optimized_jpeg or work['data']).decode('ascii')
+        elif upload['image_response'] == 'thumbnail':
+            result["thumbnail_b64"] = base64.b64encode(thumbnail_jpeg).decode('ascii')
+    return result
+
+def run_upload_job(data, sha256, upload, session_id):
+    """Run the whole upload pipeline in the job pool, outside the request that queued it."""
+    with app.app_context():
+        try:
+            work = start_image_work(data, sha256, upload, 'upload_job')
+            prompt, image, ocr_used = upload_prompt(work, 'upload_job')
+            return answer_upload(work, prompt, image, ocr_used, upload, session_id, 'upload_job')
+        except ValueError as e:
+            raise ValueError(f"Không thể đọc ảnh: {str(e)}") from e
+
+def upload_job_urls(job_id):
+    return url_for('upload_job_status', job_id=job_id), url_for('upload_job_events', job_id=job_id)
+
 @app.route('/upload_image', methods=['POST'])
 def upload_image():
     """Tính năng tải ảnh và gửi trực tiếp đến AI để giải đáp."""
@@ -162,90 +661,160 @@ def upload_image():
             return jsonify({"error": "Không có tên tệp"}), 400
         
         # Lấy thông tin từ form data
-        solution_mode = request.form.get('solution_mode', 'full')  # full, step_by_step, or hint
-        subject = request.form.get('subject', 'chung')
-        mode = request.form.get('mode', 'giải bài tập')
+        image_response = request.form.get('image_response', app.config['UPLOAD_IMAGE_RESPONSE'])
+        if image_response not in UPLOAD_IMAGE_RESPONSE_MODES:
+            image_response = app.config['UPLOAD_IMAGE_RESPONSE']
+        upload = {
+            'solution_mode': request.form.get('solution_mode', 'full'),  # full, step_by_step, or hint
+            'subject': request.form.get('subject', 'chung'),
+            'mode': request.form.get('mode', 'giải bài tập'),
+            'use_cache': not bypass_cache_requested(request.form),
+            'image_response': image_response,
+            'persist': app.config['PERSIST_UPLOADS'],
+        }
         
         if file and allowed_file(file.filename):
-            # Lưu tệp tạm thời
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
+            upload['filename'] = secure_filename(file.filename)
             
-            # Lưu URL ảnh
-            image_url = url_for('static', filename=f'uploads/{filename}', _external=True)
+            # Đọc ảnh một lần từ request và xử lý hoàn toàn trong bộ nhớ
+            with metrics.span('upload_image', 'read'):
+                data = file.read()
+                sha256 = hash_bytes(data)
             
-            # Xử lý ảnh (để tối ưu hiển thị, không phải để OCR)
-            image = cv2.imread(filepath)
+            # Chỉ trả URL khi ảnh được lưu trong kho
+            upload.update(original_image=None, optimized_image=None, image_url=None)
+            if upload['persist']:
+                original_path, optimized_path = upload_store.relative_paths(sha256, data)
+                upload['image_url'] = url_for('static', filename=f'uploads/{original_path}', _external=True)
+                upload['original_image'] = url_for('static', filename=f'uploads/{original_path}')
+                upload['optimized_image'] = url_for('static', filename=f'uploads/{optimized_path}')
             
-            # Tự động điều chỉnh độ sáng và tương phản để tối ưu hiển thị
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-            optimized = clahe.apply(gray)
+            if async_requested(request.form):
+                # Trả job id ngay; cùng ảnh và tham số gửi lại trong thời gian giữ kết quả thì gắn vào job cũ
+                session_id = history_session_id()
+                key = hash_bytes(json.dumps([sha256, session_id, upload], sort_keys=True).encode('utf-8'))
+                job_id, attached = upload_jobs.submit(key, partial(run_upload_job, data, sha256, upload, session_id))
+                status_url, events_url = upload_job_urls(job_id)
+                job = upload_jobs.get(job_id) or {"status": "queued"}
+                response = jsonify({"job_id": job_id, "status": job['status'], "attached": attached,
+                                    "status_url": status_url, "events_url": events_url})
+                response.status_code = 202
+                response.headers['Location'] = status_url
+                return response
             
-            # Lưu ảnh đã tối ưu
-            optimized_filename = f"optimized_{filename}"
-            optimized_filepath = os.path.join(app.config['UPLOAD_FOLDER'], optimized_filename)
-            cv2.imwrite(optimized_filepath, optimized)
-            
-            # Sử dụng đường dẫn tương đối cho ảnh thay vì URL đầy đủ
-            # Vì chúng ta đã sửa đổi API để đọc ảnh trực tiếp từ hệ thống tệp
-            image_relative_path = url_for('static', filename=f'uploads/{filename}')
-            
-            # Ghi log để debug
-            logger.debug(f"Image relative path: {image_relative_path}")
-
-            # Tạo prompt mô tả cho AI
-            prompt = f"Đây là ảnh chứa nội dung mà học sinh muốn hỏi. Hãy phân tích thông tin trong ảnh và trả lời câu hỏi liên quan. Nếu không thấy rõ ảnh, hãy thông báo."
+            work = start_image_work(data, sha256, upload, 'upload_image')
+            try:
+                prompt, image, ocr_used = upload_prompt(work, 'upload_image')
+            except ValueError as e:
+                return jsonify({"error": f"Không thể đọc ảnh: {str(e)}"}), 400
             
-            # Sử dụng API Gemini để lấy phản hồi với chế độ giải bài phù hợp
-            # và truyền image_url để Gemini phân tích ảnh
-            response_text = get_specialized_ai_response(prompt, subject, mode, solution_mode, image_relative_path)
-            
-            # Lưu vào lịch sử chat
-            if 'chat_history' not in session:
-                session['chat_history'] = []
-            
-            session['chat_history'].append({
-                'user': f"[Ảnh đã tải lên: {filename}]",
-                'bot': response_text,
-                'solution_mode': solution_mode,
-                'subject': subject,
-                'mode': mode,
-                'image_url': image_url
-            })
+            if wants_stream():
+                def stored_images():
+                    # Gọi khi stream xong, trước sự kiện done chứa URL ảnh
+                    optimized_jpeg = finish_image_work(work, upload, 'upload_image')
+                    return dict(stored_image_urls(upload, optimized_jpeg), status="success", ocr_used=ocr_used)
+                
+                chunks = start_stream(stream_specialized_ai_response(prompt, upload['subject'], upload['mode'],
+                                                                     upload['solution_mode'],
+                                                                     use_cache=upload['use_cache'], image=image,
+                                                                     session_id=history_session_id()))
+                return stream_answer(chunks, {
+                    'user': f"[Ảnh đã tải lên: {upload['filename']}]",
+                    'solution_mode': upload['solution_mode'],
+                    'subject': upload['subject'],
+                    'mode': upload['mode'],
+                    'image_url': upload['image_url']
+                }, stored_images)
             
-            session.modified = True
-            
-            # Mã hóa ảnh đã tối ưu để gửi về client
-            _, buffer = cv2.imencode('.jpg', optimized)
-            optimized_image_b64 = base64.b64encode(buffer).decode('utf-8')
+            try:
+                result = answer_upload(work, prompt, image, ocr_used, upload, history_session_id(), 'upload_image')
+            except ValueError as e:
+                return jsonify({"error": f"Không thể đọc ảnh: {str(e)}"}), 400
             
             # Trả về kết quả
-            return jsonify({
-                "status": "success",
-                "response": response_text,
-                "solution_mode": solution_mode,
-                "original_image": url_for('static', filename=f'uploads/{filename}'),
-                "optimized_image": url_for('static', filename=f'uploads/{optimized_filename}'),
-                "optimized_image_b64": optimized_image_b64
-            }), 200
+            with metrics.span('upload_image', 'serialize'):
+                return jsonify(result), 200
         else:
             return jsonify({"error": "Định dạng tệp không được hỗ trợ"}), 400
     
+    except SchedulerOverloaded as e:
+        return overloaded_response(e)
+    
     except Exception as e:
         logger.error(f"Lỗi khi xử lý ảnh: {str(e)}")
         return jsonify({"error": f"Đã xảy ra lỗi khi xử lý ảnh: {str(e)}"}), 500
 
+@app.route('/upload_jobs/<job_id>', methods=['GET'])
+def upload_job_status(job_id):
+    """Return the state of an upload job, with the same JSON as /upload_image once it is done."""
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Không tìm thấy job hoặc job đã hết hạn"}), 404
+    response = jsonify(job)
+    if job['status'] not in ('done', 'failed'):
+        response.headers['Retry-After'] = '1'
+    return response
+
+@app.route('/upload_jobs/<job_id>/events', methods=['GET'])
+def upload_job_events(job_id):
+    """Stream the state changes of an upload job as server-sent events, ending with done or error."""
+    if upload_jobs.get(job_id) is None:
+        return jsonify({"error": "Không tìm thấy job hoặc job đã hết hạn"}), 404
+
+    def generate():
+        status = None
+        # Job chờ lâu nhất queue_timeout rồi chạy lâu nhất lease trước khi bị coi là hỏng
+        deadline = time.monotonic() + upload_jobs.queue_timeout + upload_jobs.lease
+        while time.monotonic() < deadline:
+            job = upload_jobs.wait(job_id, status, timeout=15)
+            if job is None:
+                yield sse_event({"error": "Không tìm thấy job hoặc job đã hết hạn"}, event="error")
+                return
+            if job['status'] == status:
+                # Giữ kết nối qua proxy khi Gemini trả lời lâu
+                yield ": keepalive\n\n"
+                continue
+            status = job['status']
+            if status == 'done':
+                yield sse_event(job['result'], event="done")
+                return
+            if status == 'failed':
+                yield sse_event({"error": job.get('error')}, event="error")
+                return
+            yield sse_event({"job_id": job_id, "status": status}, event="status")
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/history', methods=['GET'])
+def history():
+    """Return one page of the chat history, newest first."""
+    limit = max(min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), HISTORY_MAX_PAGE_SIZE), 1)
+    before = request.args.get('before', type=int)
+    if 'history_id' not in session:
+        return jsonify({"items": [], "next_before": None})
+
+    items = models.SearchHistory.page(session['history_id'], before, limit)
+    # Con trỏ trang sau là id nhỏ nhất của trang này
+    next_before = items[-1].id if len(items) == limit else None
+    return jsonify({"items": [item.to_dict() for item in items], "next_before": next_before})
+
 @app.route('/clear_history', methods=['POST'])
 def clear_history():
     """Clear the chat history."""
     try:
-        session.pop('chat_history', None)
+        if 'history_id' in session:
+            models.SearchHistory.clear(session['history_id'])
         return jsonify({"status": "success", "message": "Lịch sử đã được xóa"})
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error clearing history: {str(e)}")
         return jsonify({"error": f"Đã xảy ra lỗi khi xóa lịch sử: {str(e)}"}), 500
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Expose phase and request timings, upstream gauges and module counters of this worker in Prometheus text format."""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
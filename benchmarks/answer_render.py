@@ -0,0 +1,105 @@
+"""
+Measure the server-side cost of rendering answer HTML (utils.answer_render).
+
+Generates Gemini-like answers (headings, step lists, $...$ and $$...$$
+formulas, code) whose formulas repeat across answers, then times:
+
+  - cold: new answers, formulas not cached yet
+  - math cache: new answers with formulas seen before
+  - answer cache: the same answer a second time
+
+Client-side insertion time is logged by static/js/script.js with
+console.debug ("Answer rendered in ... ms"):
+
+    python -m benchmarks.answer_render
+    python -m benchmarks.answer_render --answers 500 --steps 12 --json out.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.answer_render import AnswerRenderer, latex_to_mathml  # noqa: E402
+
+EXPRESSIONS = [
+    r"x^2 - {a}x + {b} = 0", r"\Delta = b^2 - 4ac = {a}", r"x_{{1,2}} = \frac{{-b \pm \sqrt{{\Delta}}}}{{2a}}",
+    r"\sin^2 \alpha + \cos^2 \alpha = 1", r"S = \pi r^2 = {a}\pi", r"\int_0^{a} x^2 \, dx = \frac{{{a}^3}}{{3}}",
+    r"\lim_{{x \to 0}} \frac{{\sin x}}{{x}} = 1", r"a^2 + b^2 = c^2", r"v = \frac{{s}}{{t}} = \frac{{{a}}}{{{b}}}",
+    r"\sqrt{{{a}}} \approx {b}", r"\left( x + {a} \right)^2 = x^2 + {b}x + {a}", r"F = m \cdot a",
+]
+
+
+def make_answer(rng, steps, numbers):
+    """One answer; numbers bounds how many distinct values appear, i.e. how often expressions repeat."""
+    def expression():
+        return rng.choice(EXPRESSIONS).format(a=rng.randint(1, numbers), b=rng.randint(1, numbers))
+
+    lines = ["# Lời giải", f"Xét phương trình ${expression()}$ với **điều kiện** *đã cho*.", "",
+             "---GIẢI THÍCH TỪNG BƯỚC---"]
+    for step in range(1, steps + 1):
+        lines.append(f"{step}. Bước {step}: từ ${expression()}$ suy ra ${expression()}$.")
+    lines += ["", f"$${expression()}$$", "", "```python", "print(x ** 2)", "```",
+              f"Vậy đáp số là ${expression()}$."]
+    return "\n".join(lines)
+
+
+def timed(renderer, answers):
+    latencies = []
+    for answer in answers:
+        started = time.perf_counter()
+        renderer.render(answer)
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return {
+        "ms_p50": round(statistics.median(latencies), 3),
+        "ms_p95": round(latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--answers", type=int, default=200)
+    parser.add_argument("--steps", type=int, default=8, help="Numbered steps per answer")
+    parser.add_argument("--numbers", type=int, default=20, help="Distinct numbers in expressions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    answers = [make_answer(rng, args.steps, args.numbers) for _ in range(args.answers)]
+    # Cùng công thức nhưng câu chữ khác, để bộ đệm câu trả lời không trúng
+    reworded = [answer.replace("Lời giải", "Bài giải") for answer in answers]
+
+    renderer = AnswerRenderer(enabled=True, math_cache_size=0)
+    cold = timed(renderer, answers)
+    renderer = AnswerRenderer(enabled=True)
+    timed(renderer, answers)
+    math_cached = timed(renderer, reworded)
+    answer_cached = timed(renderer, answers[-min(len(answers), renderer.answer_cache_size // 2):])
+
+    html = [renderer.render(answer) for answer in answers]
+    stats = renderer.stats()
+    results = {
+        "mathml": latex_to_mathml is not None,
+        "answers": len(answers),
+        "text_bytes_avg": round(sum(len(a.encode("utf-8")) for a in answers) / len(answers)),
+        "html_bytes_avg": round(sum(len(h.encode("utf-8")) for h in html) / len(html)),
+        "cold": cold,
+        "math_cache": math_cached,
+        "answer_cache": answer_cached,
+        "math_hit_rate": stats["math_hit_rate"],
+        "cached_expressions": stats["cached_expressions"],
+    }
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
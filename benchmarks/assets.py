@@ -0,0 +1,104 @@
+"""
+Measure bytes and load time of the home page and local assets, first visit and repeat visit.
+
+Runs on the Flask test client (no server needed) and compares:
+
+  - static: plain /static/... URLs, uncompressed
+  - fingerprinted: /assets/<hash>/... URLs from the manifest, br/gzip by
+    Accept-Encoding, strong ETag and immutable Cache-Control
+
+Repeat visits skip fresh immutable responses and revalidate the rest with
+If-None-Match. CDN bundles only count once downloaded into static/vendor
+(python -m utils.assets --vendor):
+
+    python -m benchmarks.assets
+    python -m benchmarks.assets --accept-encoding gzip --runs 20 --json out.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("GOOGLE_AI_API_KEY", "benchmark-key")
+
+from app import app, assets  # noqa: E402
+
+ASSET_URL = re.compile(r'(?:src|href)="(/(?:static|assets)/[^"]+)"')
+
+
+def page_assets(client):
+    html = client.get("/").get_data(as_text=True)
+    return ASSET_URL.findall(html)
+
+
+def legacy_url(url):
+    # /assets/<hash>/css/style.css -> /static/css/style.css
+    if url.startswith(assets.url_prefix + "/"):
+        return "/static/" + url[len(assets.url_prefix) + 1:].split("/", 1)[1]
+    return url
+
+
+def visit(client, urls, accept_encoding, cached):
+    """Load the page and its assets; cached maps URL -> (etag, immutable) from an earlier visit."""
+    started = time.perf_counter()
+    page = client.get("/", headers={"Accept-Encoding": accept_encoding})
+    total_bytes, requests_sent = len(page.get_data()), 1
+    seen = {}
+    for url in urls:
+        etag, immutable = cached.get(url, (None, False))
+        if immutable:
+            continue
+        headers = {"Accept-Encoding": accept_encoding}
+        if etag:
+            headers["If-None-Match"] = etag
+        response = client.get(url, headers=headers)
+        requests_sent += 1
+        total_bytes += len(response.get_data())
+        seen[url] = (response.headers.get("ETag"), "immutable" in response.headers.get("Cache-Control", ""))
+        response.close()
+    return total_bytes, requests_sent, (time.perf_counter() - started) * 1000, seen
+
+
+def measure(client, urls, accept_encoding, runs):
+    first = [visit(client, urls, accept_encoding, {}) for _ in range(runs)]
+    cached = first[-1][3]
+    repeat = [visit(client, urls, accept_encoding, cached) for _ in range(runs)]
+    return {
+        "assets": len(urls),
+        "first_visit_bytes": first[-1][0],
+        "first_visit_requests": first[-1][1],
+        "first_visit_ms_p50": round(statistics.median(run[2] for run in first), 2),
+        "repeat_visit_bytes": repeat[-1][0],
+        "repeat_visit_requests": repeat[-1][1],
+        "repeat_visit_ms_p50": round(statistics.median(run[2] for run in repeat), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accept-encoding", default="gzip, deflate, br")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    client = app.test_client()
+    urls = page_assets(client)
+    results = {
+        "accept_encoding": args.accept_encoding,
+        "static": measure(client, [legacy_url(url) for url in urls], args.accept_encoding, args.runs),
+        "fingerprinted": measure(client, urls, args.accept_encoding, args.runs),
+        "vendored": assets.stats()["vendored"],
+    }
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
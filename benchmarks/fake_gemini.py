@@ -0,0 +1,163 @@
+"""
+Fake Gemini generativelanguage API server, so benchmarks use no quota.
+
+Serves ``:generateContent`` and ``:streamGenerateContent?alt=sse`` with
+configurable latency, error rate and stream chunks. Point the app at it
+with GEMINI_API_BASE:
+
+    python -m benchmarks.fake_gemini --port 8765 --latency 0.8 --jitter 0.2 --error-rate 0.02
+    GEMINI_API_BASE=http://127.0.0.1:8765 gunicorn main:app
+
+GET /stats returns the number of requests received by kind.
+"""
+import json
+import time
+import random
+import argparse
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    """
+    Fake Gemini HTTP server.
+
+    Args:
+        port: Port to listen on (0 picks a free one)
+        latency: Seconds before the answer (or the first stream chunk)
+        jitter: Extra random latency in [0, jitter] seconds
+        error_rate: Fraction of calls answered with 503 and Retry-After
+        stream_chunks: Number of SSE chunks per streamed answer
+        chunk_delay: Seconds between stream chunks
+        seed: Random seed for reproducible error and latency draws
+        answer_chars: Pad answers to at least this many characters, like a long worked solution
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0.5, jitter: float = 0.0, error_rate: float = 0.0,
+                 stream_chunks: int = 5, chunk_delay: float = 0.05, seed: int = 0, answer_chars: int = 0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.stream_chunks = max(stream_chunks, 1)
+        self.chunk_delay = chunk_delay
+        self.answer_chars = answer_chars
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counters = {"generate": 0, "stream": 0, "errors": 0, "with_image": 0}
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def draw(self):
+        """Return (delay, fail) for one call."""
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            fail = self._random.random() < self.error_rate
+        return delay, fail
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def start(self) -> "FakeGeminiServer":
+        """Serve on a daemon thread and return self."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith("/stats"):
+            with self.server._lock:
+                self._send_json(200, dict(self.server.counters))
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": "not found"}})
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        parts = body.get("contents", [{}])[0].get("parts", [])
+        if any("inline_data" in part for part in parts):
+            server.count("with_image")
+        streaming = ":streamGenerateContent" in self.path
+        server.count("stream" if streaming else "generate")
+
+        delay, fail = server.draw()
+        time.sleep(delay)
+        if fail:
+            server.count("errors")
+            self._send_json(503, {"error": {"code": 503, "message": "The model is overloaded.",
+                                            "status": "UNAVAILABLE"}}, {"Retry-After": "1"})
+            return
+
+        prompt = next((part.get("text", "") for part in parts if "text" in part), "")
+        answer = f"Đáp án giả lập cho: {prompt[:80]}"
+        if len(answer) < server.answer_chars:
+            # Lời giải dài: các bước lặp lại có công thức, gần với câu trả lời thật về độ nén
+            steps = (f"\n\n**Bước {step}:** Áp dụng công thức $a^2 + b^2 = c^2$ với $a = {step}$, "
+                     f"ta được $c = \\sqrt{{{step * step} + b^2}}$." for step in itertools.count(1))
+            while len(answer) < server.answer_chars:
+                answer += next(steps)
+        if not streaming:
+            self._send_json(200, {"candidates": [{"content": {"parts": [{"text": answer}], "role": "model"}}]})
+            return
+
+        # SSE: chia câu trả lời thành các đoạn, giữ kết nối cho tới đoạn cuối
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        size = max(len(answer) // server.stream_chunks, 1)
+        pieces = [answer[i:i + size] for i in range(0, len(answer), size)]
+        for index, piece in enumerate(pieces):
+            if index:
+                time.sleep(server.chunk_delay)
+            chunk = {"candidates": [{"content": {"parts": [{"text": piece}], "role": "model"}}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n".encode("utf-8"))
+            self.wfile.flush()
+        self.close_connection = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--stream-chunks", type=int, default=5)
+    parser.add_argument("--chunk-delay", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--answer-chars", type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeGeminiServer(args.port, args.latency, args.jitter, args.error_rate,
+                              args.stream_chunks, args.chunk_delay, args.seed, args.answer_chars)
+    print(f"Fake Gemini listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
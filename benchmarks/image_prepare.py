@@ -0,0 +1,82 @@
+"""
+Benchmark the size and encode time of preparing images before they are sent to Gemini.
+
+Runs on the sample images in static/uploads and attached_assets:
+
+    python -m benchmarks.image_prepare
+    python -m benchmarks.image_prepare --max-edge 1024 1600 2400 --quality 60 75 85 --json out.json
+"""
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.image_pipeline import prepare_for_gemini  # noqa: E402
+
+SAMPLE_DIRS = [os.path.join("static", "uploads"), "attached_assets"]
+IMAGE_PATTERNS = ("*.jpg", "*.jpeg", "*.png", "*.gif")
+
+
+def find_sample_images():
+    """List the repo's sample images."""
+    paths = []
+    for directory in SAMPLE_DIRS:
+        for pattern in IMAGE_PATTERNS:
+            paths.extend(glob.glob(os.path.join(directory, pattern)))
+    return sorted(paths)
+
+
+def run(max_edges, qualities, repeat):
+    images = [(path, open(path, "rb").read()) for path in find_sample_images()]
+    results = []
+    for max_edge in max_edges:
+        for quality in qualities:
+            original_bytes = 0
+            prepared_bytes = 0
+            timings = []
+            for _, data in images:
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    prepared = prepare_for_gemini(data, max_edge=max_edge,
+                                                  text_quality=quality, photo_quality=quality)
+                    timings.append((time.perf_counter() - started) * 1000)
+                original_bytes += len(data)
+                prepared_bytes += len(prepared.data)
+            results.append({
+                "max_edge": max_edge,
+                "quality": quality,
+                "images": len(images),
+                "original_bytes": original_bytes,
+                "prepared_bytes": prepared_bytes,
+                "ratio": round(prepared_bytes / original_bytes, 4) if original_bytes else 0,
+                "encode_ms_p50": round(statistics.median(timings), 2) if timings else 0,
+                "encode_ms_max": round(max(timings), 2) if timings else 0,
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-edge", type=int, nargs="+", default=[1024, 1600, 2400])
+    parser.add_argument("--quality", type=int, nargs="+", default=[60, 75, 85])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args.max_edge, args.quality, args.repeat)
+    print(f"{'max_edge':>8} {'quality':>7} {'original':>12} {'prepared':>12} {'ratio':>7} {'p50 ms':>8} {'max ms':>8}")
+    for row in results:
+        print(f"{row['max_edge']:>8} {row['quality']:>7} {row['original_bytes']:>12} {row['prepared_bytes']:>12} "
+              f"{row['ratio']:>7} {row['encode_ms_p50']:>8} {row['encode_ms_max']:>8}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""
+Load benchmark suite: real gunicorn plus the fake Gemini server, using no quota.
+
+Starts benchmarks.fake_gemini in this process, runs gunicorn with
+GEMINI_API_BASE pointed at it (DB, caches and single-flight in a temp
+directory, PERSIST_UPLOADS=0), then runs each scenario at each concurrency:
+
+  - send_message: text questions, bypass_cache=1
+  - send_message_stream: the same over SSE, timed to the last byte
+  - upload_image: the sample images in static/uploads and attached_assets
+  - upload_image_async: the same with async=1, from job id to the done event
+  - clear_history: POST /clear_history
+
+Reports p50/p95/p99, throughput and per-worker RSS (from /proc, Linux only)
+after each level:
+
+    python -m benchmarks.load_suite --json base.json
+    python -m benchmarks.load_suite --concurrency 10 50 --latency 0.8 --error-rate 0.02
+    python -m benchmarks.load_suite --baseline base.json --max-regression 0.2   # exit 1 when 20% slower
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import itertools
+import subprocess
+import tempfile
+import threading
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_gemini import FakeGeminiServer  # noqa: E402
+from benchmarks.image_prepare import find_sample_images  # noqa: E402
+from benchmarks.serving_load import run_level, send_message  # noqa: E402
+from benchmarks.startup import free_port  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ("send_message", "send_message_stream", "upload_image", "upload_image_async", "clear_history")
+
+# Số đo so với baseline: (khóa, True nếu lớn hơn là tệ hơn)
+GATED_METRICS = (("latency_ms_p95", True), ("latency_ms_p99", True), ("throughput_rps", False))
+
+
+def send_message_stream(session, url, timeout):
+    response = session.post(f"{url}/send_message", timeout=timeout, stream=True,
+                            headers={"Accept": "text/event-stream"}, json={
+                                "message": f"Tính 2 + 2 ({uuid.uuid4().hex[:8]})",
+                                "mode": "giải bài tập",
+                                "solution_mode": "hint",
+                                "bypass_cache": "1",
+                            })
+    with response:
+        body = b"".join(response.iter_content(chunk_size=None))
+    return response.status_code == 200 and b"event: error" not in body
+
+
+def make_upload_image(images, use_jobs=False):
+    # Các luồng lấy ảnh lần lượt theo vòng, mỗi request một ảnh
+    cycle = itertools.cycle(images)
+    lock = threading.Lock()
+
+    def upload_image(session, url, timeout):
+        with lock:
+            name, data = next(cycle)
+        response = session.post(f"{url}/upload_image", timeout=timeout,
+                                files={"image": (name, data)},
+                                data={"solution_mode": "hint", "bypass_cache": "1", "async": "1" if use_jobs else ""})
+        if not use_jobs:
+            return response.status_code == 200
+        if response.status_code != 202:
+            return False
+        # Đo tới khi có kết quả, không chỉ tới lúc nhận job id
+        events = session.get(f"{url}{response.json()['events_url']}", timeout=timeout, stream=True)
+        with events:
+            body = b"".join(events.iter_content(chunk_size=None))
+        return events.status_code == 200 and b"event: done" in body
+
+    return upload_image
+
+
+def clear_history(session, url, timeout):
+    return session.post(f"{url}/clear_history", timeout=timeout).status_code == 200
+
+
+def _children(pid):
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def _memory_kb(pid):
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    name, value = line.split(":", 1)
+                    values[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return values
+
+
+def worker_memory(master_pid):
+    """RSS and peak RSS (MB) of each gunicorn worker, plus its image pool processes."""
+    workers = []
+    for pid in _children(master_pid):
+        memory = _memory_kb(pid)
+        pool = [_memory_kb(child).get("VmRSS", 0) for child in _children(pid)]
+        workers.append({
+            "pid": pid,
+            "rss_mb": round(memory.get("VmRSS", 0) / 1024, 1),
+            "peak_rss_mb": round(memory.get("VmHWM", 0) / 1024, 1),
+            "pool_processes": len(pool),
+            "pool_rss_mb": round(sum(pool) / 1024, 1),
+        })
+    return workers
+
+
+def start_app(fake_url, workers, worker_class, data_dir, timeout):
+    port = free_port()
+    env = dict(os.environ,
+               GUNICORN_BIND=f"127.0.0.1:{port}",
+               GUNICORN_WORKERS=str(workers),
+               GUNICORN_WORKER_CLASS=worker_class,
+               GEMINI_API_BASE=fake_url,
+               GOOGLE_AI_API_KEY="benchmark-key",
+               GOOGLE_AI_API_KEYS="",
+               PERSIST_UPLOADS="0",
+               DATABASE_URL=f"sqlite:///{os.path.join(data_dir, 'history.db')}",
+               RESPONSE_CACHE_PATH=os.path.join(data_dir, "response_cache.db"),
+               SINGLE_FLIGHT_PATH=os.path.join(data_dir, "single_flight.db"),
+               NEAR_DUP_PATH=os.path.join(data_dir, "near_duplicates.db"),
+               IMAGE_INDEX_PATH=os.path.join(data_dir, "image_index.db"),
+               UPLOAD_JOBS_PATH=os.path.join(data_dir, "upload_jobs.db"))
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app"],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {server.returncode}")
+        try:
+            with urllib.request.urlopen(f"{url}/", timeout=timeout) as response:
+                if response.status == 200 and len(_children(server.pid)) >= workers:
+                    return server, url
+        except OSError:
+            time.sleep(0.05)
+    server.terminate()
+    raise TimeoutError(f"gunicorn did not answer within {timeout}s")
+
+
+def run_suite(args):
+    images = [(os.path.basename(path), open(path, "rb").read()) for path in find_sample_images()]
+    senders = {
+        "send_message": send_message,
+        "send_message_stream": send_message_stream,
+        "upload_image": make_upload_image(images) if images else None,
+        "upload_image_async": make_upload_image(images, use_jobs=True) if images else None,
+        "clear_history": clear_history,
+    }
+
+    fake = FakeGeminiServer(0, args.latency, args.jitter, args.error_rate, args.stream_chunks,
+                            args.chunk_delay, args.seed).start()
+    results = {
+        "config": {
+            "workers": args.workers, "worker_class": args.worker_class,
+            "latency_s": args.latency, "jitter_s": args.jitter, "error_rate": args.error_rate,
+            "stream_chunks": args.stream_chunks, "images": len(images),
+        },
+        "scenarios": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="load_suite_") as data_dir:
+        server, url = start_app(fake.base_url, args.workers, args.worker_class, data_dir, args.startup_timeout)
+        try:
+            results["idle_workers"] = worker_memory(server.pid)
+            for scenario in args.scenarios:
+                send = senders[scenario]
+                if send is None:
+                    print(f"Skipping {scenario}: no sample images", file=sys.stderr)
+                    continue
+                rows = []
+                for concurrency in args.concurrency:
+                    row = run_level(url, concurrency, args.requests or concurrency * 2, args.timeout, send)
+                    row["workers"] = worker_memory(server.pid)
+                    rows.append(row)
+                    print(f"{scenario:<20} {row['concurrency']:>5} {row['requests']:>5} {row['errors']:>6} "
+                          f"{row['throughput_rps']:>8} {row['latency_ms_p50']:>9} {row['latency_ms_p95']:>9} "
+                          f"{row['latency_ms_p99']:>9} "
+                          f"{max((w['rss_mb'] for w in row['workers']), default=0):>8}")
+                results["scenarios"][scenario] = rows
+        finally:
+            server.terminate()
+            server.wait()
+            fake.shutdown()
+    results["fake_gemini"] = dict(fake.counters)
+    return results
+
+
+def compare(results, baseline, max_regression):
+    """Return the list of metrics that got worse than baseline by more than max_regression."""
+    failures = []
+    for scenario, rows in results["scenarios"].items():
+        old_rows = {row["concurrency"]: row for row in baseline.get("scenarios", {}).get(scenario, [])}
+        for row in rows:
+            old = old_rows.get(row["concurrency"])
+            if old is None:
+                continue
+            checks = [(key, row[key], old[key], higher_is_worse) for key, higher_is_worse in GATED_METRICS]
+            old_rss = max((w["rss_mb"] for w in old.get("workers", [])), default=0)
+            new_rss = max((w["rss_mb"] for w in row.get("workers", [])), default=0)
+            checks.append(("max_worker_rss_mb", new_rss, old_rss, True))
+            for key, new_value, old_value, higher_is_worse in checks:
+                if not old_value:
+                    continue
+                change = (new_value - old_value) / old_value
+                if (change if higher_is_worse else -change) > max_regression:
+                    failures.append(f"{scenario} c={row['concurrency']} {key}: {old_value} -> {new_value} "
+                                    f"({change:+.0%})")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--requests", type=int, default=0,
+                        help="Requests per level (default: 2x the concurrency)")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--worker-class", default=os.environ.get("GUNICORN_WORKER_CLASS", "gevent"))
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake Gemini latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--stream-chunks", type=int, default=5)
+    parser.add_argument("--chunk-delay", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--json", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Earlier --json output to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Allowed relative slowdown/RSS growth vs the baseline (default 0.2)")
+    args = parser.parse_args()
+
+    print(f"{'scenario':<20} {'conc':>5} {'reqs':>5} {'errors':>6} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'rss MB':>8}")
+    results = run_suite(args)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(results, json.load(f), args.max_regression)
+        for failure in failures:
+            print(f"Regression: {failure}", file=sys.stderr)
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Compare the OCR path (send text) with the image path on the repo's sample images.
+
+For each image in static/uploads and attached_assets, measures local
+preparation time (OCR versus downscale/recompress) and the size of the
+Gemini JSON payload. --send also times the Gemini call (GOOGLE_AI_API_KEY
+and GEMINI_API_BASE, which may point at the fake server):
+
+    python -m benchmarks.ocr_path
+    python -m benchmarks.ocr_path --min-confidence 80 --send --json out.json
+
+Needs tesseract and the Vietnamese language pack (tesseract-ocr-vie).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.image_prepare import find_sample_images  # noqa: E402
+from utils.image_pipeline import prepare_for_gemini  # noqa: E402
+from utils.ocr import extract_text, ocr_prompt, OCR_MIN_CONFIDENCE, OCR_MIN_CHARS  # noqa: E402
+from utils.huggingface_api import _build_gemini_payload, call_gemini_api  # noqa: E402
+
+IMAGE_PROMPT = "Đây là ảnh chứa nội dung mà học sinh muốn hỏi. Hãy phân tích thông tin trong ảnh và trả lời câu hỏi liên quan."
+
+
+def payload_bytes(prompt, image=None):
+    return len(json.dumps(_build_gemini_payload(prompt, image), ensure_ascii=False).encode("utf-8"))
+
+
+def timed_call(prompt, image=None):
+    started = time.perf_counter()
+    call_gemini_api(prompt, os.environ.get("GOOGLE_AI_API_KEY"), image=image)
+    return (time.perf_counter() - started) * 1000
+
+
+def run(min_confidence, min_chars, send):
+    rows = []
+    for path in find_sample_images():
+        with open(path, "rb") as f:
+            data = f.read()
+
+        started = time.perf_counter()
+        image = prepare_for_gemini(data)
+        image_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        result = extract_text(data)
+        ocr_ms = (time.perf_counter() - started) * 1000
+
+        row = {
+            "image": os.path.basename(path),
+            "image_prepare_ms": round(image_ms, 1),
+            "image_payload_bytes": payload_bytes(IMAGE_PROMPT, image),
+            "ocr_ms": round(ocr_ms, 1),
+            "ocr_confidence": round(result.confidence, 1) if result else None,
+            "ocr_chars": len(result.text) if result else 0,
+            "text_payload_bytes": payload_bytes(ocr_prompt(result.text)) if result else None,
+        }
+        row["ocr_accepted"] = bool(result and len(result.text) >= min_chars and result.confidence >= min_confidence)
+        if send:
+            row["image_call_ms"] = round(timed_call(IMAGE_PROMPT, image), 1)
+            row["text_call_ms"] = round(timed_call(ocr_prompt(result.text)), 1) if result else None
+        rows.append(row)
+    return rows
+
+
+def summarize(rows, send):
+    accepted = [row for row in rows if row["ocr_accepted"]]
+    summary = {
+        "images": len(rows),
+        "ocr_accepted": len(accepted),
+        "image_payload_bytes_total": sum(row["image_payload_bytes"] for row in rows),
+        # Đường thực tế: ảnh đạt ngưỡng gửi chữ, còn lại gửi ảnh
+        "routed_payload_bytes_total": sum(row["text_payload_bytes"] if row["ocr_accepted"]
+                                          else row["image_payload_bytes"] for row in rows),
+        "image_prepare_ms_p50": round(statistics.median(row["image_prepare_ms"] for row in rows), 1) if rows else 0,
+        "ocr_ms_p50": round(statistics.median(row["ocr_ms"] for row in rows), 1) if rows else 0,
+    }
+    if send and accepted:
+        summary["image_call_ms_p50"] = round(statistics.median(row["image_call_ms"] for row in accepted), 1)
+        summary["text_call_ms_p50"] = round(statistics.median(row["text_call_ms"] for row in accepted), 1)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--min-confidence", type=float, default=OCR_MIN_CONFIDENCE)
+    parser.add_argument("--min-chars", type=int, default=OCR_MIN_CHARS)
+    parser.add_argument("--send", action="store_true", help="Also time the Gemini call for both paths")
+    parser.add_argument("--json", help="Write per-image rows and the summary to this JSON file")
+    args = parser.parse_args()
+
+    rows = run(args.min_confidence, args.min_chars, args.send)
+    print(f"{'image':<36} {'prep ms':>8} {'img bytes':>10} {'ocr ms':>8} {'conf':>6} {'txt bytes':>10} {'used':>5}")
+    for row in rows:
+        print(f"{row['image']:<36} {row['image_prepare_ms']:>8} {row['image_payload_bytes']:>10} "
+              f"{row['ocr_ms']:>8} {str(row['ocr_confidence']):>6} {str(row['text_payload_bytes']):>10} "
+              f"{'yes' if row['ocr_accepted'] else 'no':>5}")
+    summary = summarize(rows, args.send)
+    print(json.dumps(summary, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"rows": rows, "summary": summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
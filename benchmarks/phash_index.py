@@ -0,0 +1,177 @@
+"""
+Benchmark the image pHash index: lookup cost and false matches on the repo's sample images.
+
+Uses the images in static/uploads and attached_assets (mostly screenshots of
+the same UI, the hardest case for pHash):
+
+  - false match: every pair of different images, by pHash alone and with
+    the alignment check (match_score)
+  - recall: whether simulated retakes (rotation, perspective, lighting,
+    JPEG) find the original
+  - cost: fingerprinting, multi-index search versus a linear scan over
+    --entries hashes, and one match_score
+
+    python -m benchmarks.phash_index
+    python -m benchmarks.phash_index --max-distance 10 --min-score 0.8 --entries 5000 50000 --json out.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2  # noqa: E402
+import numpy as np  # noqa: E402
+
+from benchmarks.image_prepare import find_sample_images  # noqa: E402
+from utils.image_pipeline import fingerprint, match_score  # noqa: E402
+from utils.image_index import MultiIndexHash, hamming, IMAGE_INDEX_MAX_DISTANCE, IMAGE_INDEX_MIN_SCORE  # noqa: E402
+from utils.response_cache import hash_bytes  # noqa: E402
+
+
+def retake(image, rng):
+    """Simulate another student photographing the same page."""
+    height, width = image.shape[:2]
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), rng.uniform(-3, 3), rng.uniform(0.92, 1.08))
+    image = cv2.warpAffine(image, rotation, (width, height), borderMode=cv2.BORDER_REPLICATE)
+    shift = 0.03 * min(width, height)
+    corners = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    moved = corners + np.float32([[rng.uniform(-shift, shift), rng.uniform(-shift, shift)] for _ in range(4)])
+    image = cv2.warpPerspective(image, cv2.getPerspectiveTransform(corners, moved), (width, height),
+                                borderMode=cv2.BORDER_REPLICATE)
+    image = cv2.convertScaleAbs(image, alpha=rng.uniform(0.85, 1.15), beta=rng.uniform(-20, 20))
+    ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, rng.randint(60, 90)])
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+def load_images():
+    # Ảnh trùng byte (cùng một file ở hai thư mục) chỉ tính một lần; bản optimized_ do
+    # app tạo từ ảnh gốc là cùng một trang nên không đưa vào phép đo khớp nhầm
+    images, seen = [], set()
+    for path in find_sample_images():
+        if os.path.basename(path).startswith("optimized_"):
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None or hash_bytes(data) in seen:
+            continue
+        seen.add(hash_bytes(data))
+        images.append((os.path.basename(path), image))
+    return images
+
+
+def false_matches(prints, max_distance, min_score):
+    pairs = hash_only = verified = 0
+    scores = []
+    for (name_a, a), (name_b, b) in itertools.combinations(prints, 2):
+        pairs += 1
+        if hamming(a.phash, b.phash) > max_distance:
+            continue
+        hash_only += 1
+        score = match_score(a.thumbnail, b.thumbnail)
+        scores.append(score)
+        if score >= min_score:
+            verified += 1
+            print(f"False match: {name_a} ~ {name_b} (score {score:.3f})", file=sys.stderr)
+    return {
+        "pairs": pairs,
+        "hash_candidates": hash_only,
+        "false_match_rate_hash_only": round(hash_only / pairs, 4) if pairs else 0.0,
+        "false_matches_verified": verified,
+        "false_match_rate_verified": round(verified / pairs, 4) if pairs else 0.0,
+        "max_score_distinct": round(max(scores), 3) if scores else None,
+    }
+
+
+def recall(images, prints, retakes, max_distance, min_score, seed):
+    rng = random.Random(seed)
+    found = hash_found = 0
+    distances, scores = [], []
+    for (_, image), (_, original) in zip(images, prints):
+        for _ in range(retakes):
+            copy = fingerprint(retake(image, rng))
+            distance = hamming(copy.phash, original.phash)
+            distances.append(distance)
+            if distance > max_distance:
+                continue
+            hash_found += 1
+            score = match_score(copy.thumbnail, original.thumbnail)
+            scores.append(score)
+            found += score >= min_score
+    total = len(distances)
+    return {
+        "retakes": total,
+        "recall_hash_only": round(hash_found / total, 4) if total else 0.0,
+        "recall_verified": round(found / total, 4) if total else 0.0,
+        "retake_distance_p50": statistics.median(distances) if distances else None,
+        "retake_score_p50": round(statistics.median(scores), 3) if scores else None,
+    }
+
+
+def lookup_cost(entries, max_distance, queries, seed):
+    rng = random.Random(seed)
+    hashes = [rng.getrandbits(64) for _ in range(entries)]
+    index = MultiIndexHash(max_distance)
+    for item, value in enumerate(hashes):
+        index.add(value, item)
+    # Truy vấn gần một hash đã có, như ảnh chụp lại
+    probes = [hashes[rng.randrange(entries)] ^ sum(1 << bit for bit in rng.sample(range(64), max_distance // 2))
+              for _ in range(queries)]
+
+    started = time.perf_counter()
+    for probe in probes:
+        index.search(probe)
+    index_ms = (time.perf_counter() - started) * 1000 / queries
+
+    started = time.perf_counter()
+    for probe in probes:
+        [item for item, value in enumerate(hashes) if hamming(probe, value) <= max_distance]
+    linear_ms = (time.perf_counter() - started) * 1000 / queries
+    return {"entries": entries, "multi_index_ms": round(index_ms, 3), "linear_ms": round(linear_ms, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-distance", type=int, default=IMAGE_INDEX_MAX_DISTANCE)
+    parser.add_argument("--min-score", type=float, default=IMAGE_INDEX_MIN_SCORE)
+    parser.add_argument("--retakes", type=int, default=3, help="Simulated retakes per sample image")
+    parser.add_argument("--entries", type=int, nargs="+", default=[5000, 50000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    images = load_images()
+    started = time.perf_counter()
+    prints = [(name, fingerprint(image)) for name, image in images]
+    fingerprint_ms = (time.perf_counter() - started) * 1000 / max(len(images), 1)
+
+    started = time.perf_counter()
+    for (_, a), (_, b) in zip(prints, prints[1:]):
+        match_score(a.thumbnail, b.thumbnail)
+    match_ms = (time.perf_counter() - started) * 1000 / max(len(prints) - 1, 1)
+
+    results = {
+        "images": len(images),
+        "max_distance": args.max_distance,
+        "min_score": args.min_score,
+        "fingerprint_ms": round(fingerprint_ms, 2),
+        "match_score_ms": round(match_ms, 2),
+        "distinct": false_matches(prints, args.max_distance, args.min_score),
+        "retake": recall(images, prints, args.retakes, args.max_distance, args.min_score, args.seed),
+        "lookup": [lookup_cost(entries, args.max_distance, args.queries, args.seed) for entries in args.entries],
+    }
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
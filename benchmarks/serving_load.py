@@ -0,0 +1,120 @@
+"""
+Measure /send_message throughput and latency against a running server.
+
+Compares sync and gevent workers while Gemini answers slowly:
+
+    GUNICORN_WORKER_CLASS=sync gunicorn main:app
+    python -m benchmarks.serving_load --url http://127.0.0.1:5000 --concurrency 10 50 200
+
+    GUNICORN_WORKER_CLASS=gevent gunicorn main:app
+    python -m benchmarks.serving_load --url http://127.0.0.1:5000 --concurrency 10 50 200 --json gevent.json
+
+Each question gets a random number and bypass_cache=1 so it misses the
+answer cache. The full suite (fake Gemini, images, RSS) is benchmarks.load_suite.
+"""
+import json
+import time
+import uuid
+import argparse
+import statistics
+import threading
+
+import requests
+
+
+def percentile(values, fraction):
+    """Return the value at the given fraction (0-1) of the sorted samples."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def send_message(session, url, timeout):
+    """POST one uncached question to /send_message, return True on 200."""
+    response = session.post(f"{url}/send_message", timeout=timeout, json={
+        "message": f"Tính 1 + 1 ({uuid.uuid4().hex[:8]})",
+        "mode": "giải bài tập",
+        "solution_mode": "hint",
+        "bypass_cache": "1",
+    })
+    return response.status_code == 200
+
+
+def run_level(url, concurrency, total, timeout, send=send_message):
+    """
+    Run total requests with concurrency client threads.
+
+    send(session, url, timeout) makes one request and returns True on success;
+    each thread keeps its own requests.Session (and so its own cookie).
+    """
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    remaining = [total]
+
+    def worker():
+        nonlocal errors
+        session = requests.Session()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                ok = send(session, url, timeout)
+            except requests.exceptions.RequestException:
+                ok = False
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(latencies) / duration, 2) if duration else 0,
+        "latency_ms_p50": round(percentile(latencies, 0.50), 1),
+        "latency_ms_p95": round(percentile(latencies, 0.95), 1),
+        "latency_ms_p99": round(percentile(latencies, 0.99), 1),
+        "latency_ms_mean": round(statistics.mean(latencies), 1) if latencies else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--requests", type=int, default=0,
+                        help="Requests per level (default: 2x the concurrency)")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'conc':>5} {'reqs':>5} {'errors':>6} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for concurrency in args.concurrency:
+        row = run_level(args.url, concurrency, args.requests or concurrency * 2, args.timeout)
+        results.append(row)
+        print(f"{row['concurrency']:>5} {row['requests']:>5} {row['errors']:>6} {row['throughput_rps']:>8} "
+              f"{row['latency_ms_p50']:>9} {row['latency_ms_p95']:>9} {row['latency_ms_p99']:>9}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Cold start benchmark: time to import app and time to the first response.
+
+Each run uses a fresh Python process so no module is reused:
+
+  - import: time of ``import app`` and whether heavy libraries load eagerly
+  - first response: from starting gunicorn until ``--path`` returns 200
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --runs 5 --prewarm --json out.json
+    python -m benchmarks.startup --max-import-ms 900   # exit 1 when slower
+
+Point DATABASE_URL, RESPONSE_CACHE_PATH and SINGLE_FLIGHT_PATH at a temp
+directory to keep real data untouched.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Thư viện chỉ request ảnh mới cần; nạp lúc import là hồi quy
+HEAVY_MODULES = ("cv2", "numpy", "PIL", "pytesseract")
+
+IMPORT_SNIPPET = """
+import sys, time, json
+started = time.perf_counter()
+import app
+elapsed = time.perf_counter() - started
+print(json.dumps({"import_ms": elapsed * 1000, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def measure_import():
+    output = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=ROOT, capture_output=True,
+                            text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_first_response(path, workers, prewarm, timeout):
+    port = free_port()
+    env = dict(os.environ, GUNICORN_BIND=f"127.0.0.1:{port}", GUNICORN_WORKERS=str(workers),
+               GUNICORN_PREWARM="1" if prewarm else "0")
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app"],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = started + timeout
+        while time.perf_counter() < deadline:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=timeout) as response:
+                    if response.status == 200:
+                        return (time.perf_counter() - started) * 1000
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError(f"No 200 from {path} within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def summarize(values):
+    return {
+        "p50": round(statistics.median(values), 1),
+        "min": round(min(values), 1),
+        "max": round(max(values), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--path", default="/", help="Path polled for the first response")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--prewarm", action="store_true", help="Enable the gunicorn pre-warm hook")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--skip-server", action="store_true", help="Only measure the import")
+    parser.add_argument("--max-import-ms", type=float, help="Exit 1 if the median import is slower")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    imports = [measure_import() for _ in range(args.runs)]
+    results = {
+        "runs": args.runs,
+        "import_ms": summarize([run["import_ms"] for run in imports]),
+        "heavy_modules_loaded": sorted({name for run in imports for name in run["loaded"]}),
+    }
+    if not args.skip_server:
+        firsts = [measure_first_response(args.path, args.workers, args.prewarm, args.timeout)
+                  for _ in range(args.runs)]
+        results.update({"path": args.path, "prewarm": args.prewarm, "first_response_ms": summarize(firsts)})
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failed = False
+    if results["heavy_modules_loaded"]:
+        print(f"Heavy modules loaded at import: {', '.join(results['heavy_modules_loaded'])}", file=sys.stderr)
+        failed = True
+    if args.max_import_ms is not None and results["import_ms"]["p50"] > args.max_import_ms:
+        print(f"Import p50 {results['import_ms']['p50']} ms exceeds {args.max_import_ms} ms", file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Measure the size and build time of the upload_image and send_message JSON responses.
+
+Runs on the Flask test client with the fake Gemini server in the same
+process (DB, caches and indexes in a temp directory, bypass_cache=1) and compares:
+
+  - upload_image by image_response: url (default), thumbnail, inline
+    (optimized_image_b64 as before)
+  - send_message with an --answer-chars long answer
+  - each with Accept-Encoding identity, gzip and br
+
+Bytes are the received body size; base64/serialize/compress times come
+from this run's /metrics (app_phase_duration_seconds):
+
+    python -m benchmarks.upload_response
+    python -m benchmarks.upload_response --answer-chars 8000 --runs 5 --json out.json
+"""
+import io
+import os
+import re
+import sys
+import json
+import argparse
+import tempfile
+import itertools
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_gemini import FakeGeminiServer  # noqa: E402
+
+ENCODINGS = {"identity": "identity", "gzip": "gzip", "br": "br, gzip"}
+PHASE_LINE = re.compile(r'app_phase_duration_seconds_(sum|count)\{([^}]*)\} (\S+)')
+
+
+def phase_totals(client):
+    """Return {(route, phase): [seconds, count]} parsed from /metrics."""
+    totals = {}
+    for kind, labels, value in PHASE_LINE.findall(client.get("/metrics").get_data(as_text=True)):
+        labels = dict(re.findall(r'(\w+)="([^"]*)"', labels))
+        entry = totals.setdefault((labels.get("route"), labels.get("phase")), [0.0, 0])
+        entry[0 if kind == "sum" else 1] += float(value)
+    return totals
+
+
+def phase_ms(before, after, route, phases):
+    """Average milliseconds per request spent in each phase between two /metrics snapshots."""
+    result = {}
+    for phase in phases:
+        seconds = after.get((route, phase), [0.0, 0])[0] - before.get((route, phase), [0.0, 0])[0]
+        count = after.get((route, phase), [0.0, 0])[1] - before.get((route, phase), [0.0, 0])[1]
+        result[f"{phase}_ms"] = round(seconds * 1000 / count, 3) if count else None
+    return result
+
+
+def measure(client, route, send, accept_encoding, runs):
+    before = phase_totals(client)
+    sizes = []
+    for _ in range(runs):
+        response = send(accept_encoding)
+        assert response.status_code == 200, response.get_data(as_text=True)[:200]
+        sizes.append(len(response.get_data()))
+    after = phase_totals(client)
+    result = {"bytes_avg": round(sum(sizes) / len(sizes)), "content_encoding": response.headers.get("Content-Encoding")}
+    result.update(phase_ms(before, after, route, ("base64", "serialize", "compress")))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--answer-chars", type=int, default=4000, help="Length of the fake Gemini answers")
+    parser.add_argument("--runs", type=int, default=3, help="Requests per sample image and encoding")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    fake = FakeGeminiServer(latency=0.0, answer_chars=args.answer_chars).start()
+    data_dir = tempfile.mkdtemp(prefix="upload-response-")
+    # Phải đặt trước khi import app: cấu hình đọc từ biến môi trường lúc import
+    os.environ.update(GEMINI_API_BASE=fake.base_url, GOOGLE_AI_API_KEY="benchmark-key", GOOGLE_AI_API_KEYS="",
+                      DATABASE_URL=f"sqlite:///{os.path.join(data_dir, 'history.db')}",
+                      RESPONSE_CACHE_PATH=os.path.join(data_dir, "response_cache.db"),
+                      SINGLE_FLIGHT_PATH=os.path.join(data_dir, "single_flight.db"),
+                      NEAR_DUP_PATH=os.path.join(data_dir, "near_duplicates.db"),
+                      IMAGE_INDEX_PATH=os.path.join(data_dir, "image_index.db"))
+    os.environ.setdefault("PERSIST_UPLOADS", "0")
+    from app import app
+    from benchmarks.image_prepare import find_sample_images
+
+    client = app.test_client()
+    images = [(os.path.basename(path), open(path, "rb").read()) for path in find_sample_images()]
+    results = {"answer_chars": args.answer_chars, "images": len(images),
+               "persist_uploads": app.config["PERSIST_UPLOADS"], "upload_image": {}, "send_message": {}}
+
+    samples = itertools.cycle(images)
+    for image_response in ("url", "thumbnail", "inline"):
+        def send(accept_encoding, image_response=image_response):
+            name, data = next(samples)
+            return client.post("/upload_image", headers={"Accept-Encoding": accept_encoding}, data={
+                "image": (io.BytesIO(data), name), "bypass_cache": "1", "image_response": image_response})
+        results["upload_image"][image_response] = {
+            label: measure(client, "upload_image", send, header, args.runs * len(images))
+            for label, header in ENCODINGS.items()}
+
+    def send_message(accept_encoding):
+        return client.post("/send_message", headers={"Accept-Encoding": accept_encoding},
+                           json={"message": "Giải phương trình x^2 - 5x + 6 = 0", "bypass_cache": True})
+    results["send_message"] = {label: measure(client, "send_message", send_message, header, args.runs)
+                               for label, header in ENCODINGS.items()}
+
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+from flask_sqlalchemy import SQLAlchemy
+
+# Tạo riêng khỏi app.py để models.py import được mà không nạp lại app
+# (chạy "python app.py" thì app là __main__, "from app import db" sẽ tạo bản thứ hai)
+db = SQLAlchemy()
@@ -0,0 +1,37 @@
+# Cấu hình gunicorn - gunicorn tự đọc file này khi chạy từ thư mục gốc của dự án
+import os
+import time
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+
+# Worker gevent: mỗi request là một greenlet, trong lúc chờ Gemini trả lời
+# worker vẫn nhận request khác. Đặt GUNICORN_WORKER_CLASS=sync để quay về
+# chế độ cũ (mỗi worker xử lý một request tại một thời điểm).
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gevent")
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+# Số request đồng thời tối đa của một worker gevent
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+# Câu trả lời dạng stream có thể kéo dài quá 30 giây mặc định
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+# Làm nóng worker ngay sau khi nạp app: import OpenCV/numpy và khởi động pool
+# ảnh để request ảnh đầu tiên không phải chờ. Tắt mặc định vì worker sẽ sẵn
+# sàng chậm hơn, trong khi request chỉ có chữ không cần thư viện ảnh.
+prewarm = os.environ.get("GUNICORN_PREWARM", "0") != "0"
+
+
+def post_worker_init(worker):
+    if not prewarm:
+        return
+    started = time.perf_counter()
+    try:
+        from utils.image_pipeline import load_imaging
+        from utils.image_workers import image_workers
+        image_workers.warm(load_imaging)
+    except Exception as e:
+        worker.log.warning(f"Pre-warm failed: {e}")
+        return
+    worker.log.info(f"Worker pre-warmed in {(time.perf_counter() - started) * 1000:.0f} ms")
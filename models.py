@@ -1,19 +1,63 @@
 from datetime import datetime
-from app import db
+from extensions import db
 
 class SearchHistory(db.Model):
+    # Mỗi dòng là một lượt hỏi đáp, gắn với session qua session_id trong cookie
+    __table_args__ = (
+        db.Index('ix_search_history_session_id_id', 'session_id', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(32), nullable=False)
     query = db.Column(db.Text, nullable=False)
     response = db.Column(db.Text, nullable=False)
+    solution_mode = db.Column(db.String(20))
+    subject = db.Column(db.String(50))
+    mode = db.Column(db.String(20))
+    image_url = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    
+
     def __repr__(self):
         return f'<SearchHistory {self.query[:20]}...>'
-    
+
     def to_dict(self):
         return {
             'id': self.id,
             'query': self.query,
             'response': self.response,
+            'solution_mode': self.solution_mode,
+            'subject': self.subject,
+            'mode': self.mode,
+            'image_url': self.image_url,
             'timestamp': self.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-        }
\ No newline at end of file
+        }
+
+    @classmethod
+    def append(cls, session_id, entry):
+        """Insert one exchange; a single INSERT, nothing else is rewritten."""
+        db.session.add(cls(
+            session_id=session_id,
+            query=entry['user'],
+            response=entry['bot'],
+            solution_mode=entry.get('solution_mode'),
+            subject=entry.get('subject'),
+            mode=entry.get('mode'),
+            image_url=entry.get('image_url')
+        ))
+        db.session.commit()
+
+    @classmethod
+    def page(cls, session_id, before_id=None, limit=20):
+        """Return up to limit exchanges older than before_id, newest first."""
+        # Cột "query" che mất Model.query nên dùng db.select
+        statement = db.select(cls).filter_by(session_id=session_id)
+        if before_id is not None:
+            statement = statement.filter(cls.id < before_id)
+        return db.session.scalars(statement.order_by(cls.id.desc()).limit(limit)).all()
+
+    @classmethod
+    def clear(cls, session_id):
+        """Delete all exchanges of a session with one indexed DELETE."""
+        deleted = db.session.execute(db.delete(cls).filter_by(session_id=session_id)).rowcount
+        db.session.commit()
+        return deleted
@@ -336,32 +336,29 @@ document.addEventListener("DOMContentLoaded", function() {
             // Determine which endpoint to use
             const endpoint = imageFile ? '/upload_image' : '/send_message';
             
-            // Send request
+            // Send request - yêu cầu stream để hiển thị câu trả lời ngay khi có
             const response = await fetch(endpoint, {
                 method: 'POST',
+                headers: {
+                    'Accept': 'text/event-stream'
+                },
                 body: formData
             });
             
+            if (response.ok && isEventStream(response)) {
+                const aiContentDiv = createAiMessage();
+                await renderAnswerStream(response, aiContentDiv);
+                return;
+            }
+            
             const data = await response.json();
             
             // Hide loading overlay
             loadingOverlay.classList.add("d-none");
             
             if (response.ok) {
-                // Create AI message element
-                const aiMessageElement = document.createElement("div");
-                aiMessageElement.className = "message ai-message";
-                
-                const aiAvatarDiv = document.createElement("div");
-                aiAvatarDiv.className = "message-avatar ai-avatar";
-                
-                const aiContentDiv = document.createElement("div");
-                aiContentDiv.className = "message-content";
-                aiContentDiv.innerHTML = formatMessage(data.response);
-                
-                aiMessageElement.appendChild(aiAvatarDiv);
-                aiMessageElement.appendChild(aiContentDiv);
-                chatArea.appendChild(aiMessageElement);
+                const aiContentDiv = createAiMessage();
+                showAnswer(aiContentDiv, data);
                 
                 // Add special styling for code blocks for better readability
                 document.querySelectorAll('pre code').forEach(block => {
@@ -379,6 +376,100 @@ document.addEventListener("DOMContentLoaded", function() {
         }
     }
     
+    function isEventStream(response) {
+        const contentType = response.headers.get('Content-Type') || '';
+        return contentType.includes('text/event-stream') && response.body;
+    }
+    
+    function createAiMessage() {
+        // Create AI message element
+        const aiMessageElement = document.createElement("div");
+        aiMessageElement.className = "message ai-message";
+        
+        const aiAvatarDiv = document.createElement("div");
+        aiAvatarDiv.className = "message-avatar ai-avatar";
+        
+        const aiContentDiv = document.createElement("div");
+        aiContentDiv.className = "message-content";
+        
+        aiMessageElement.appendChild(aiAvatarDiv);
+        aiMessageElement.appendChild(aiContentDiv);
+        chatArea.appendChild(aiMessageElement);
+        
+        return aiContentDiv;
+    }
+    
+    async function renderAnswerStream(response, aiContentDiv) {
+        // Đọc các sự kiện SSE từ body và hiển thị văn bản ngay khi nhận được
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder("utf-8");
+        let buffer = "";
+        let answer = "";
+        let renderPending = false;
+        
+        function scheduleRender() {
+            // Gộp nhiều đoạn nhỏ vào một lần vẽ để tránh định dạng lại liên tục
+            if (renderPending) return;
+            renderPending = true;
+            requestAnimationFrame(() => {
+                renderPending = false;
+                aiContentDiv.innerHTML = formatMessage(answer);
+                scrollToBottom();
+            });
+        }
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            
+            let boundary;
+            while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                
+                let eventName = "message";
+                let dataText = "";
+                rawEvent.split("\n").forEach(line => {
+                    if (line.startsWith("event:")) {
+                        eventName = line.slice(6).trim();
+                    } else if (line.startsWith("data:")) {
+                        dataText += line.slice(5).trim();
+                    }
+                });
+                if (!dataText) continue;
+                
+                const data = JSON.parse(dataText);
+                loadingOverlay.classList.add("d-none");
+                
+                if (eventName === "error") {
+                    addErrorMessage(data.error || "Có lỗi xảy ra khi xử lý yêu cầu của bạn.");
+                } else if (eventName === "done") {
+                    answer = data.response;
+                    showAnswer(aiContentDiv, data);
+                    scrollToBottom();
+                } else {
+                    answer += data.text;
+                    scheduleRender();
+                }
+            }
+        }
+        
+        loadingOverlay.classList.add("d-none");
+        document.querySelectorAll('pre code').forEach(block => {
+            block.classList.add('p-2', 'bg-light', 'rounded');
+        });
+    }
+    
+    function showAnswer(aiContentDiv, data) {
+        // HTML dựng sẵn phía server (đã escape, công thức là MathML) chỉ cần chèn vào;
+        // server tắt tính năng này thì tự định dạng như trước
+        const started = performance.now();
+        aiContentDiv.innerHTML = data.response_html || formatMessage(data.response);
+        console.debug(`Answer rendered in ${(performance.now() - started).toFixed(1)} ms`
+            + ` (${data.response_html ? 'server' : 'client'} HTML)`);
+    }
+    
     function addErrorMessage(text) {
         const errorMessageElement = document.createElement("div");
         errorMessageElement.className = "alert alert-danger mt-3";
@@ -546,13 +637,19 @@ document.addEventListener("DOMContentLoaded", function() {
         try {
             const response = await fetch('/upload_image', {
                 method: 'POST',
+                headers: {
+                    'Accept': 'text/event-stream'
+                },
                 body: formData
             });
             
-            const data = await response.json();
+            const streaming = response.ok && isEventStream(response);
+            const data = streaming ? null : await response.json();
             
-            // Hide loading overlay
-            loadingOverlay.classList.add("d-none");
+            if (!streaming) {
+                // Hide loading overlay
+                loadingOverlay.classList.add("d-none");
+            }
             
             if (response.ok) {
                 // Create image message
@@ -577,27 +674,20 @@ document.addEventListener("DOMContentLoaded", function() {
                 userMessageElement.appendChild(userContentDiv);
                 chatArea.appendChild(userMessageElement);
                 
-                // Create AI response message
-                const aiMessageElement = document.createElement("div");
-                aiMessageElement.className = "message ai-message";
-                
-                const aiAvatarDiv = document.createElement("div");
-                aiAvatarDiv.className = "message-avatar ai-avatar";
-                
-                const aiContentDiv = document.createElement("div");
-                aiContentDiv.className = "message-content";
-                aiContentDiv.innerHTML = formatMessage(data.response);
-                
-                aiMessageElement.appendChild(aiAvatarDiv);
-                aiMessageElement.appendChild(aiContentDiv);
-                chatArea.appendChild(aiMessageElement);
-                
                 // Clear form
                 imageInput.value = "";
                 imagePreview.src = "";
                 imagePreviewContainer.classList.add("d-none");
                 document.getElementById("upload-container").classList.add("d-none");
                 
+                // Create AI response message
+                const aiContentDiv = createAiMessage();
+                if (streaming) {
+                    await renderAnswerStream(response, aiContentDiv);
+                } else {
+                    showAnswer(aiContentDiv, data);
+                }
+                
                 scrollToBottom();
             } else {
                 addErrorMessage(data.error || "Có lỗi xảy ra khi xử lý ảnh của bạn.");
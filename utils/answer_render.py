@@ -0,0 +1,277 @@
+import os
+import re
+import html
+import time
+import logging
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, deque
+from typing import Optional, Dict, Any, List, Tuple
+
+from utils.response_cache import hash_bytes
+
+try:
+    from latex2mathml.converter import convert as latex_to_mathml
+except ImportError:  # latex2mathml không bắt buộc, thiếu thì giữ nguyên công thức cho MathJax phía client
+    latex_to_mathml = None
+
+logger = logging.getLogger(__name__)
+
+# Dựng sẵn HTML cho câu trả lời phía server - có thể ghi đè bằng biến môi trường
+RENDER_ANSWERS = os.environ.get("RENDER_ANSWERS", "1") != "0"
+# Số câu trả lời và số công thức giữ trong bộ nhớ của mỗi worker
+RENDER_ANSWER_CACHE_SIZE = int(os.environ.get("RENDER_ANSWER_CACHE_SIZE", "512"))
+RENDER_MATH_CACHE_SIZE = int(os.environ.get("RENDER_MATH_CACHE_SIZE", "4096"))
+# Công thức quá dài thường là văn bản bị bọc nhầm trong $...$
+RENDER_MATH_MAX_CHARS = int(os.environ.get("RENDER_MATH_MAX_CHARS", "2000"))
+
+# Chỉ giữ các thẻ và thuộc tính trình bày của MathML; \href, \text{<b>...</b>} v.v. bị loại
+MATHML_TAGS = {
+    "math", "mrow", "mi", "mn", "mo", "ms", "mtext", "mspace", "mfrac", "msqrt", "mroot", "msub", "msup",
+    "msubsup", "munder", "mover", "munderover", "mtable", "mtr", "mtd", "mstyle", "mpadded", "mphantom",
+    "menclose", "merror", "mfenced", "mmultiscripts", "mprescripts", "none", "semantics", "annotation",
+}
+MATHML_ATTRIBUTES = {
+    "display", "displaystyle", "scriptlevel", "mathvariant", "mathsize", "stretchy", "fence", "separator",
+    "separators", "open", "close", "lspace", "rspace", "width", "height", "depth", "linethickness", "accent",
+    "accentunder", "movablelimits", "form", "symmetric", "largeop", "minsize", "maxsize", "notation",
+    "columnalign", "columnlines", "columnspacing", "rowalign", "rowlines", "rowspacing", "frame", "framespacing",
+    "columnspan", "rowspan", "encoding",
+}
+
+# Khối code được tách ra trước để không định dạng nội dung bên trong
+_CODE_BLOCK = re.compile(r"```(\w*)\n?([\s\S]*?)```")
+_INLINE_CODE = re.compile(r"`([^`\n]+)`")
+_DISPLAY_MATH = re.compile(r"\$\$([\s\S]+?)\$\$|\\\[([\s\S]+?)\\\]")
+# Như pandoc: không có khoảng trắng ngay trong hai dấu $ và không có chữ số sau dấu đóng,
+# nên "5$ và 10$" vẫn là tiền chứ không phải công thức
+_INLINE_MATH = re.compile(r"\$(?!\s)([^$\n]+?)(?<!\s)\$(?!\d)|\\\(([\s\S]+?)\\\)")
+_PLACEHOLDER = re.compile(r"\x00(\d+)\x00")
+_HEADING = re.compile(r"^(#{1,6})\s+(.*)$")
+_BULLET = re.compile(r"^\s*[*-]\s+(.*)$")
+_NUMBERED = re.compile(r"^\s*(\d+)\.\s+(.*)$")
+_BOLD = re.compile(r"\*\*(.+?)\*\*")
+_ITALIC = re.compile(r"(?<![*\w])\*(?!\s)(.+?)(?<!\s)\*(?![*\w])")
+SEPARATORS = {
+    "---GIẢI THÍCH---": '<div class="solution-separator">GIẢI THÍCH</div>',
+    "---GIẢI THÍCH TỪNG BƯỚC---": '<div class="solution-separator">GIẢI THÍCH TỪNG BƯỚC</div>',
+}
+
+
+def sanitize_mathml(markup: str) -> Optional[str]:
+    """
+    Keep only presentation MathML elements and attributes.
+
+    Args:
+        markup: MathML produced by the LaTeX converter
+
+    Returns:
+        The cleaned MathML, or None if it cannot be parsed
+    """
+    try:
+        root = ET.fromstring(markup)
+    except ET.ParseError:
+        return None
+
+    def clean(element):
+        element.tag = element.tag.rsplit("}", 1)[-1]
+        for name in list(element.attrib):
+            if name not in MATHML_ATTRIBUTES:
+                del element.attrib[name]
+        previous = None
+        for child in list(element):
+            if child.tag.rsplit("}", 1)[-1] in MATHML_TAGS:
+                clean(child)
+                previous = child
+                continue
+            # Thẻ lạ (ví dụ HTML trong \text{...}): giữ lại chữ, bỏ thẻ
+            text = "".join(child.itertext()) + (child.tail or "")
+            if previous is not None:
+                previous.tail = (previous.tail or "") + text
+            else:
+                element.text = (element.text or "") + text
+            element.remove(child)
+
+    if root.tag.rsplit("}", 1)[-1] != "math":
+        return None
+    # Trong HTML5 thẻ <math> không cần xmlns
+    clean(root)
+    return ET.tostring(root, encoding="unicode", short_empty_elements=False)
+
+
+class AnswerRenderer:
+    """
+    Render Gemini's Markdown + LaTeX answers to safe HTML on the server.
+
+    Text is escaped first and only the renderer's own tags are added; formulas
+    become MathML. Expressions and whole answers are kept in bounded LRU caches.
+    """
+
+    def __init__(self, enabled: bool = RENDER_ANSWERS, answer_cache_size: int = RENDER_ANSWER_CACHE_SIZE,
+                 math_cache_size: int = RENDER_MATH_CACHE_SIZE):
+        self.enabled = enabled
+        self.answer_cache_size = answer_cache_size
+        self.math_cache_size = math_cache_size
+        self._lock = threading.Lock()
+        self._answers: "OrderedDict[str, str]" = OrderedDict()
+        self._math: "OrderedDict[Tuple[str, bool], str]" = OrderedDict()
+        self._counters = {"answers": 0, "answer_hits": 0, "expressions": 0, "math_hits": 0, "math_errors": 0}
+        self._latencies_ms = deque(maxlen=1000)
+
+    def _cached(self, cache: OrderedDict, key, size: int, build):
+        with self._lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+                return value, True
+        value = build()
+        with self._lock:
+            cache[key] = value
+            while len(cache) > size:
+                cache.popitem(last=False)
+        return value, False
+
+    def render_math(self, latex: str, display: bool) -> str:
+        """Return the MathML of one expression, or the escaped source when it cannot be converted."""
+        latex = latex.strip()
+
+        def build():
+            markup = None
+            if latex_to_mathml is not None and len(latex) <= RENDER_MATH_MAX_CHARS:
+                try:
+                    markup = sanitize_mathml(latex_to_mathml(latex, display="block" if display else "inline"))
+                except Exception as e:
+                    logger.debug(f"LaTeX conversion failed for {latex[:50]!r}: {str(e)}")
+            if markup is None:
+                with self._lock:
+                    self._counters["math_errors"] += 1
+                # Giữ nguyên công thức để MathJax phía client (nếu có) vẫn xử lý được
+                delimiters = ("$$", "$$") if display else ("$", "$")
+                markup = html.escape(f"{delimiters[0]}{latex}{delimiters[1]}")
+            return f'<span class="math-{"display" if display else "inline"}">{markup}</span>'
+
+        markup, hit = self._cached(self._math, (latex, display), self.math_cache_size, build)
+        with self._lock:
+            self._counters["expressions"] += 1
+            self._counters["math_hits"] += hit
+        return markup
+
+    def _inline(self, text: str) -> str:
+        text = _BOLD.sub(r"<strong>\1</strong>", text)
+        return _ITALIC.sub(r"<em>\1</em>", text)
+
+    def _to_html(self, text: str) -> str:
+        fragments: List[str] = []
+
+        def stash(markup: str) -> str:
+            fragments.append(markup)
+            return f"\x00{len(fragments) - 1}\x00"
+
+        def code_block(match):
+            language = f' class="language-{match.group(1)}"' if match.group(1) else ""
+            return stash(f"<pre><code{language}>{html.escape(match.group(2))}</code></pre>")
+
+        # \x00 đánh dấu chỗ đặt fragment nên không được có trong câu trả lời
+        text = _CODE_BLOCK.sub(code_block, text.replace("\r\n", "\n").replace("\x00", ""))
+        text = _INLINE_CODE.sub(lambda m: stash(f"<code>{html.escape(m.group(1))}</code>"), text)
+        text = _DISPLAY_MATH.sub(lambda m: stash(self.render_math(m.group(1) or m.group(2), True)), text)
+        text = _INLINE_MATH.sub(lambda m: stash(self.render_math(m.group(1) or m.group(2), False)), text)
+        text = html.escape(text, quote=False)
+
+        blocks: List[str] = []
+        paragraph: List[str] = []
+        list_tag, items = None, []
+
+        def flush():
+            nonlocal list_tag, items
+            if paragraph:
+                blocks.append(f"<p>{'<br>'.join(paragraph)}</p>")
+                paragraph.clear()
+            if list_tag:
+                blocks.append(f"<{list_tag}>{''.join(items)}</{list_tag.split()[0]}>")
+                list_tag, items = None, []
+
+        for line in text.split("\n"):
+            stripped = line.strip()
+            heading = _HEADING.match(stripped)
+            bullet = _BULLET.match(line)
+            numbered = _NUMBERED.match(line)
+            if not stripped:
+                flush()
+            elif stripped in SEPARATORS:
+                flush()
+                blocks.append(SEPARATORS[stripped])
+            elif heading:
+                flush()
+                level = min(len(heading.group(1)) + 2, 6)
+                blocks.append(f"<h{level}>{self._inline(heading.group(2))}</h{level}>")
+            elif bullet or numbered:
+                tag = "ul" if bullet else ("ol" if numbered.group(1) == "1" else f'ol start="{numbered.group(1)}"')
+                if paragraph or (list_tag and list_tag.split()[0] != tag.split()[0]):
+                    flush()
+                if list_tag is None:
+                    list_tag = tag
+                items.append(f"<li>{self._inline((bullet or numbered).groups()[-1])}</li>")
+            elif _PLACEHOLDER.fullmatch(stripped) and fragments[int(stripped[1:-1])].startswith("<pre>"):
+                flush()
+                blocks.append(stripped)
+            else:
+                if list_tag:
+                    flush()
+                paragraph.append(self._inline(stripped))
+        flush()
+
+        result = "".join(blocks)
+        for separator, markup in SEPARATORS.items():
+            result = result.replace(separator, markup)
+        # Đưa code và công thức đã dựng trở lại; fragment không bao giờ chứa placeholder
+        return _PLACEHOLDER.sub(lambda m: fragments[int(m.group(1))], result)
+
+    def render(self, text: Optional[str]) -> Optional[str]:
+        """
+        Render an answer to sanitized HTML.
+
+        Args:
+            text: Answer text in the Markdown/LaTeX style Gemini replies with
+
+        Returns:
+            The HTML to insert as-is on the client, or None when rendering is disabled
+        """
+        if not self.enabled or text is None:
+            return None
+        started = time.perf_counter()
+        try:
+            markup, hit = self._cached(self._answers, hash_bytes(text.encode("utf-8")),
+                                       self.answer_cache_size, lambda: self._to_html(text))
+        except Exception as e:
+            # Lỗi dựng HTML không được làm hỏng câu trả lời: client tự định dạng như trước
+            logger.warning(f"Answer render failed: {str(e)}")
+            return None
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._counters["answers"] += 1
+            self._counters["answer_hits"] += hit
+            if not hit:
+                self._latencies_ms.append(elapsed)
+        return markup
+
+    def stats(self) -> Dict[str, Any]:
+        """Return cache hit rates and the cost of rendering an uncached answer in this worker."""
+        with self._lock:
+            result = dict(self._counters)
+            latencies = sorted(self._latencies_ms)
+            result["cached_answers"] = len(self._answers)
+            result["cached_expressions"] = len(self._math)
+        result["answer_hit_rate"] = round(result["answer_hits"] / result["answers"], 4) if result["answers"] else 0.0
+        result["math_hit_rate"] = round(result["math_hits"] / result["expressions"], 4) \
+            if result["expressions"] else 0.0
+        result["render_ms_avg"] = round(sum(latencies) / len(latencies), 3) if latencies else 0.0
+        result["render_ms_p95"] = round(latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)], 3) \
+            if latencies else 0.0
+        result.update({"enabled": self.enabled, "mathml": latex_to_mathml is not None,
+                       "answer_cache_size": self.answer_cache_size, "math_cache_size": self.math_cache_size})
+        return result
+
+
+# Renderer dùng chung cho cả module
+answer_renderer = AnswerRenderer()
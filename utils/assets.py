@@ -0,0 +1,176 @@
+import os
+import hashlib
+import logging
+import mimetypes
+import threading
+from typing import Optional, Dict, Any, List, Tuple
+
+from utils.compression import brotli, compress, negotiate_encoding
+
+logger = logging.getLogger(__name__)
+
+# URL tĩnh theo hash nội dung - có thể ghi đè bằng biến môi trường
+ASSETS_FINGERPRINT = os.environ.get("ASSETS_FINGERPRINT", "1") != "0"
+ASSETS_URL_PREFIX = os.environ.get("ASSETS_URL_PREFIX", "/assets")
+# File nhỏ hơn ngưỡng này nén không đáng (header gzip/br đã gần bằng phần tiết kiệm)
+ASSETS_MIN_COMPRESS_BYTES = int(os.environ.get("ASSETS_MIN_COMPRESS_BYTES", "512"))
+# Ảnh do người dùng tải lên không phải asset của trang
+ASSETS_EXCLUDE_DIRS = ("uploads",)
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml",
+                      "application/xml", "font/ttf", "font/otf")
+
+# Thư viện CDN trong template; chạy `python -m utils.assets --vendor` để tải về static/vendor.
+# Font Awesome và mathquill.css nạp font theo đường dẫn tương đối nên vẫn dùng CDN.
+# MathJax tự nạp thêm component (extension TeX, font) theo đường dẫn tương đối với file JS;
+# URL /assets/<hash>/ của bản local không có các file đó, nên template trỏ loader.paths.mathjax
+# về CDN và bản local chỉ tiết kiệm được file lớn nhất.
+VENDOR_ASSETS: Dict[str, Tuple[str, str]] = {
+    "mathjax": ("https://cdn.jsdelivr.net/npm/mathjax@3.2.2/es5/tex-mml-chtml.js",
+                "vendor/mathjax-3.2.2/tex-mml-chtml.js"),
+    "jquery": ("https://cdn.jsdelivr.net/npm/jquery@3.6.0/dist/jquery.min.js",
+               "vendor/jquery-3.6.0/jquery.min.js"),
+    "mathquill_js": ("https://cdn.jsdelivr.net/npm/mathquill@0.10.1/build/mathquill.min.js",
+                     "vendor/mathquill-0.10.1/mathquill.min.js"),
+    "bootstrap_css": ("https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/css/bootstrap.min.css",
+                      "vendor/bootstrap-5.3.0-alpha1/bootstrap.min.css"),
+    "bootstrap_js": ("https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/js/bootstrap.bundle.min.js",
+                     "vendor/bootstrap-5.3.0-alpha1/bootstrap.bundle.min.js"),
+}
+MATHJAX_COMPONENTS_URL = "https://cdn.jsdelivr.net/npm/mathjax@3.2.2/es5"
+
+
+class Asset:
+    """One file under static/, identified by the hash of its content."""
+
+    def __init__(self, path: str, digest: str, size: int, mime_type: str):
+        self.path = path
+        self.digest = digest
+        self.size = size
+        self.mime_type = mime_type
+        self.compressible = size >= ASSETS_MIN_COMPRESS_BYTES and mime_type.startswith(COMPRESSIBLE_TYPES)
+        # Bản nén theo encoding, tạo một lần khi có request đầu tiên cần nó
+        self.variants: Dict[str, bytes] = {}
+
+    def etag(self, encoding: Optional[str] = None) -> str:
+        # ETag mạnh, khác nhau theo encoding vì nội dung byte khác nhau
+        return f"{self.digest}-{encoding}" if encoding else self.digest
+
+
+class AssetManifest:
+    """
+    Map files under static/ to content-hashed /assets/<hash>/<path> URLs, built at startup.
+
+    Gzip/brotli variants are compressed once and served by Accept-Encoding.
+    """
+
+    def __init__(self, static_folder: str, url_prefix: str = ASSETS_URL_PREFIX, enabled: bool = ASSETS_FINGERPRINT):
+        self.static_folder = static_folder
+        self.url_prefix = url_prefix.rstrip("/")
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._assets: Dict[str, Asset] = {}
+        self._counters = {"requests": 0, "not_modified": 0, "stale_digest": 0, "br": 0, "gzip": 0, "identity": 0,
+                          "bytes_sent": 0}
+        if enabled:
+            self.build()
+
+    def build(self) -> None:
+        """Hash every file under the static folder; no build step, only reads the files once."""
+        assets = {}
+        for root, dirs, files in os.walk(self.static_folder):
+            if root == self.static_folder:
+                dirs[:] = [d for d in dirs if d not in ASSETS_EXCLUDE_DIRS]
+            for name in files:
+                full_path = os.path.join(root, name)
+                path = os.path.relpath(full_path, self.static_folder).replace(os.sep, "/")
+                with open(full_path, "rb") as f:
+                    data = f.read()
+                mime_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                assets[path] = Asset(path, hashlib.sha256(data).hexdigest()[:16], len(data), mime_type)
+        self._assets = assets
+        logger.info(f"Asset manifest: {len(assets)} files")
+
+    def get(self, path: str) -> Optional[Asset]:
+        return self._assets.get(path)
+
+    def url(self, path: str) -> Optional[str]:
+        """Return the fingerprinted URL of a static file, or None if it is not in the manifest."""
+        asset = self._assets.get(path) if self.enabled else None
+        return f"{self.url_prefix}/{asset.digest}/{path}" if asset else None
+
+    def read(self, asset: Asset, encoding: Optional[str]) -> bytes:
+        """Return the body of asset in the given encoding (None for identity)."""
+        if encoding is None:
+            with open(os.path.join(self.static_folder, asset.path), "rb") as f:
+                return f.read()
+        body = asset.variants.get(encoding)
+        if body is None:
+            body = compress(self.read(asset, None), encoding, brotli_quality=11, gzip_level=9)
+            with self._lock:
+                asset.variants[encoding] = body
+        return body
+
+    @staticmethod
+    def choose_encoding(asset: Asset, accept_encoding: str) -> Optional[str]:
+        """Pick br, then gzip, from the Accept-Encoding header (q=0 excludes a coding)."""
+        return negotiate_encoding(accept_encoding) if asset.compressible else None
+
+    def count(self, encoding: Optional[str], sent: int, not_modified: bool = False, stale: bool = False) -> None:
+        with self._lock:
+            self._counters["requests"] += 1
+            self._counters["bytes_sent"] += sent
+            self._counters["not_modified" if not_modified else (encoding or "identity")] += 1
+            if stale:
+                self._counters["stale_digest"] += 1
+
+    def vendor_url(self, name: str) -> str:
+        """URL of a CDN bundle: the local copy under static/vendor if present, otherwise the CDN."""
+        cdn_url, local_path = VENDOR_ASSETS[name]
+        return self.url(local_path) or cdn_url
+
+    def is_vendored(self, name: str) -> bool:
+        return VENDOR_ASSETS[name][1] in self._assets
+
+    def stats(self) -> Dict[str, Any]:
+        """Return manifest size and how assets were served in this worker."""
+        with self._lock:
+            result = dict(self._counters)
+            cached = sum(len(body) for asset in self._assets.values() for body in asset.variants.values())
+        result.update({
+            "enabled": self.enabled,
+            "files": len(self._assets),
+            "bytes": sum(asset.size for asset in self._assets.values()),
+            "compressed_variant_bytes": cached,
+            "brotli": brotli is not None,
+            "vendored": sorted(name for name in VENDOR_ASSETS if self.is_vendored(name)),
+        })
+        return result
+
+
+def vendor(static_folder: str, names: List[str]) -> None:
+    """Download the CDN bundles into static/vendor so the page loads without third-party hosts."""
+    import requests
+
+    for name in names:
+        cdn_url, local_path = VENDOR_ASSETS[name]
+        target = os.path.join(static_folder, local_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        response = requests.get(cdn_url, timeout=60)
+        response.raise_for_status()
+        with open(target, "wb") as f:
+            f.write(response.content)
+        print(f"{name}: {cdn_url} -> {target} ({len(response.content)} bytes)")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Download the CDN bundles used by the templates into static/vendor")
+    parser.add_argument("--vendor", nargs="*", choices=sorted(VENDOR_ASSETS), metavar="NAME",
+                        help=f"Bundles to download (default: all of {', '.join(sorted(VENDOR_ASSETS))})")
+    parser.add_argument("--static-folder", default="static")
+    args = parser.parse_args()
+    if args.vendor is not None:
+        vendor(args.static_folder, args.vendor or sorted(VENDOR_ASSETS))
+    else:
+        parser.print_help()
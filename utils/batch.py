@@ -0,0 +1,125 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, Dict, Any, Callable, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Cấu hình gửi nhiều câu hỏi một lượt - có thể ghi đè bằng biến môi trường
+BATCH_MAX_QUESTIONS = int(os.environ.get("BATCH_MAX_QUESTIONS", "50"))
+# Số lời gọi Gemini một lượt được chạy cùng lúc (bộ điều phối vẫn giới hạn theo session)
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+# Gộp các câu hỏi ngắn vào một lời gọi Gemini, tắt bằng BATCH_PACK_ENABLED=0
+BATCH_PACK_ENABLED = os.environ.get("BATCH_PACK_ENABLED", "1") != "0"
+BATCH_PACK_SIZE = int(os.environ.get("BATCH_PACK_SIZE", "5"))
+BATCH_PACK_MAX_CHARS = int(os.environ.get("BATCH_PACK_MAX_CHARS", "300"))
+
+
+class BatchRunner:
+    """
+    Answer many questions at once with a bounded number of concurrent Gemini calls.
+
+    Short questions are packed into one call per group; a group whose answer
+    comes back malformed is retried one question at a time.
+    """
+
+    def __init__(self, concurrency: int = BATCH_CONCURRENCY, pack_enabled: bool = BATCH_PACK_ENABLED,
+                 pack_size: int = BATCH_PACK_SIZE, pack_max_chars: int = BATCH_PACK_MAX_CHARS):
+        self.concurrency = max(concurrency, 1)
+        self.pack_enabled = pack_enabled
+        self.pack_size = max(pack_size, 1)
+        self.pack_max_chars = pack_max_chars
+        self._lock = threading.Lock()
+        self._counters = {"batches": 0, "questions": 0, "calls": 0, "packed_calls": 0, "packed_questions": 0,
+                          "pack_fallbacks": 0}
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += amount
+
+    def plan(self, questions: List[str], pack: Optional[bool] = None) -> List[List[int]]:
+        """
+        Group question indexes into upstream calls.
+
+        Args:
+            questions: The questions of the batch
+            pack: Override of the pack_enabled setting for this batch
+
+        Returns:
+            One list of indexes per call; lists longer than one are packed calls
+        """
+        pack = self.pack_enabled if pack is None else pack
+        groups, small = [], []
+        for index, question in enumerate(questions):
+            if pack and self.pack_size > 1 and len(question) <= self.pack_max_chars:
+                small.append(index)
+                if len(small) == self.pack_size:
+                    groups.append(small)
+                    small = []
+            else:
+                groups.append([index])
+        if small:
+            groups.append(small)
+        return sorted(groups)
+
+    def run(self, questions: List[str], answer_one: Callable[[str], str],
+            answer_packed: Callable[[List[str]], List[str]], pack: Optional[bool] = None,
+            concurrency: Optional[int] = None) -> Iterator[Tuple[int, str]]:
+        """
+        Answer every question, yielding results as they finish.
+
+        Args:
+            questions: The questions of the batch
+            answer_one: Answers one question
+            answer_packed: Answers several questions with one call; any
+                exception makes the group fall back to one call per question
+            pack: Override of the pack_enabled setting for this batch
+            concurrency: Lower per-batch limit on parallel calls
+
+        Yields:
+            (index, answer) pairs in completion order
+        """
+        groups = self.plan(questions, pack)
+        self._count("batches")
+        self._count("questions", len(questions))
+        if not groups:
+            return
+
+        def answer_group(group: List[int]) -> List[Tuple[int, str]]:
+            if len(group) == 1:
+                self._count("calls")
+                return [(group[0], answer_one(questions[group[0]]))]
+            self._count("calls")
+            self._count("packed_calls")
+            self._count("packed_questions", len(group))
+            try:
+                return list(zip(group, answer_packed([questions[i] for i in group])))
+            except Exception as e:
+                # Không tách được câu trả lời gộp (hay lỗi bất kỳ khi gộp): hỏi lại từng câu
+                logger.warning(f"Packed answer for {len(group)} questions unusable, asking one by one: {e}")
+                self._count("pack_fallbacks")
+                self._count("calls", len(group))
+                return [(i, answer_one(questions[i])) for i in group]
+
+        workers = min(self.concurrency, concurrency or self.concurrency, len(groups))
+        executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="batch")
+        try:
+            futures = [executor.submit(answer_group, group) for group in groups]
+            for future in as_completed(futures):
+                yield from future.result()
+        finally:
+            # Client ngắt giữa chừng thì bỏ các nhóm chưa chạy
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return batch counters of this worker."""
+        with self._lock:
+            result = dict(self._counters)
+        result.update({"concurrency": self.concurrency, "pack_enabled": self.pack_enabled,
+                       "pack_size": self.pack_size, "pack_max_chars": self.pack_max_chars})
+        return result
+
+
+# Bộ chạy lượt câu hỏi dùng chung cho cả module, mỗi worker gunicorn có một bản riêng
+batch_runner = BatchRunner()
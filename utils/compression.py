@@ -0,0 +1,116 @@
+import os
+import gzip
+import logging
+import threading
+from typing import Optional, Dict, Any
+
+try:
+    import brotli
+except ImportError:  # brotli không bắt buộc, thiếu thì chỉ nén gzip
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Nén response động (JSON, HTML) theo Accept-Encoding - có thể ghi đè bằng biến môi trường
+COMPRESS_RESPONSES = os.environ.get("COMPRESS_RESPONSES", "1") != "0"
+# Response nhỏ hơn ngưỡng này nén không đáng (header gzip/br đã gần bằng phần tiết kiệm)
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+# Mức nén vừa phải: nén mỗi request nên ưu tiên tốc độ hơn vài phần trăm dung lượng
+COMPRESS_BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", "5"))
+COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_MIMETYPES = ("application/json", "text/html", "text/plain")
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick br, then gzip, from an Accept-Encoding header (q=0 excludes a coding); None for identity."""
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    for encoding in (("br", "gzip") if brotli is not None else ("gzip",)):
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(data: bytes, encoding: str, brotli_quality: int = COMPRESS_BROTLI_QUALITY,
+             gzip_level: int = COMPRESS_GZIP_LEVEL) -> bytes:
+    """Compress data with the given content coding ("br" or "gzip")."""
+    if encoding == "br":
+        return brotli.compress(data, quality=brotli_quality)
+    # mtime=0 để cùng nội dung luôn cho cùng bytes
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+
+class ResponseCompressor:
+    """
+    Compress JSON/HTML responses above a size threshold by Accept-Encoding, in after_request.
+
+    Streams, direct-passthrough files, already encoded responses, errors and 304s are left as is.
+    """
+
+    def __init__(self, enabled: bool = COMPRESS_RESPONSES, min_bytes: int = COMPRESS_MIN_BYTES):
+        self.enabled = enabled
+        self.min_bytes = min_bytes
+        self._lock = threading.Lock()
+        self._counters = {"compressed": 0, "skipped_small": 0, "identity": 0, "br": 0, "gzip": 0,
+                          "bytes_in": 0, "bytes_out": 0}
+
+    def _eligible(self, response) -> bool:
+        return (self.enabled and 200 <= response.status_code < 300 and response.status_code != 204
+                and not response.direct_passthrough and not response.is_streamed
+                and "Content-Encoding" not in response.headers
+                and response.mimetype in COMPRESS_MIMETYPES)
+
+    def maybe_compress(self, response, accept_encoding: str):
+        """Compress response in place when it is eligible and the client accepts br or gzip."""
+        if not self._eligible(response):
+            return response
+        # Nội dung phụ thuộc Accept-Encoding kể cả khi lần này không nén
+        response.vary.add("Accept-Encoding")
+        data = response.get_data()
+        if len(data) < self.min_bytes:
+            self._count("skipped_small")
+            return response
+        encoding = negotiate_encoding(accept_encoding)
+        if encoding is None:
+            self._count("identity")
+            return response
+        body = compress(data, encoding)
+        if len(body) >= len(data):
+            self._count("identity")
+            return response
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+        # ETag mạnh của bản chưa nén không còn đúng với bytes đã nén
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(f"{etag}-{encoding}")
+        with self._lock:
+            self._counters["compressed"] += 1
+            self._counters[encoding] += 1
+            self._counters["bytes_in"] += len(data)
+            self._counters["bytes_out"] += len(body)
+        return response
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Return how many responses were compressed and the bytes saved in this worker."""
+        with self._lock:
+            result = dict(self._counters)
+        result["ratio"] = round(result["bytes_out"] / result["bytes_in"], 4) if result["bytes_in"] else 0.0
+        result.update({"enabled": self.enabled, "min_bytes": self.min_bytes, "brotli": brotli is not None})
+        return result
+
+
+# Bộ nén dùng chung cho cả module
+response_compressor = ResponseCompressor()
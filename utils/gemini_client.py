@@ -0,0 +1,128 @@
+import os
+import logging
+import threading
+import requests
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from typing import Optional, Dict, Any
+
+logger = logging.getLogger(__name__)
+
+# Cấu hình kết nối tới Gemini - có thể ghi đè bằng biến môi trường
+GEMINI_CONNECT_TIMEOUT = float(os.environ.get("GEMINI_CONNECT_TIMEOUT", "5"))
+GEMINI_READ_TIMEOUT = float(os.environ.get("GEMINI_READ_TIMEOUT", "60"))
+# Số lời gọi Gemini chạy đồng thời tối đa trong một worker; các request khác chờ slot
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "64"))
+# Mặc định pool đủ lớn cho mọi lời gọi được phép chạy cùng lúc
+GEMINI_POOL_MAXSIZE = int(os.environ.get("GEMINI_POOL_MAXSIZE", str(GEMINI_MAX_CONCURRENCY)))
+
+
+class GeminiClient:
+    """
+    HTTP client shared by every Gemini call in a worker.
+
+    Keeps a bounded keep-alive connection pool with connect/read timeouts and
+    caps concurrent calls with a semaphore.
+    """
+
+    def __init__(self, connect_timeout: float = GEMINI_CONNECT_TIMEOUT,
+                 read_timeout: float = GEMINI_READ_TIMEOUT,
+                 pool_maxsize: int = GEMINI_POOL_MAXSIZE,
+                 max_concurrency: int = GEMINI_MAX_CONCURRENCY):
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_maxsize = pool_maxsize
+        self.max_concurrency = max_concurrency
+        self._slots = None
+        self._in_flight = 0
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._session = None
+        self._adapter = None
+
+    def _get_session(self) -> requests.Session:
+        # Gunicorn fork worker sau khi import module, nên tạo session lười theo PID
+        # để các worker không dùng chung socket của tiến trình cha
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            with self._lock:
+                if self._session is None or self._pid != pid:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4,
+                                          pool_maxsize=self.pool_maxsize,
+                                          pool_block=True)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+                    self._adapter = adapter
+                    self._pid = pid
+        return self._session
+
+    def _get_slots(self) -> threading.BoundedSemaphore:
+        # Tạo lười để semaphore được tạo sau khi gevent monkey-patch threading
+        if self._slots is None:
+            with self._lock:
+                if self._slots is None:
+                    self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        return self._slots
+
+    @contextmanager
+    def upstream_slot(self):
+        """Hold a Gemini call slot for the whole block, including reading a stream."""
+        slots = self._get_slots()
+        with self._lock:
+            self._waiting += 1
+        slots.acquire()
+        with self._lock:
+            self._waiting -= 1
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            slots.release()
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """POST through the shared session with the client's default timeout."""
+        kwargs.setdefault("timeout", self.timeout)
+        return self._get_session().post(url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """GET through the shared session with the client's default timeout."""
+        kwargs.setdefault("timeout", self.timeout)
+        return self._get_session().get(url, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return connection pool counters of this worker.
+
+        Returns:
+            Requests sent, new connections opened (pool misses) and reused connections (pool hits)
+        """
+        requests_sent = 0
+        connections_opened = 0
+        if self._adapter is not None and self._pid == os.getpid():
+            pools = self._adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_sent += pool.num_requests
+                connections_opened += pool.num_connections
+        return {
+            "pid": os.getpid(),
+            "requests": requests_sent,
+            "pool_misses": connections_opened,
+            "pool_hits": max(requests_sent - connections_opened, 0),
+            "pool_maxsize": self.pool_maxsize,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "connect_timeout": self.timeout[0],
+            "read_timeout": self.timeout[1],
+        }
+
+
+# Client dùng chung cho cả module, mỗi worker gunicorn có một bản riêng
+gemini_client = GeminiClient()
@@ -1,11 +1,23 @@
 import os
+import time
 import logging
+import re
+import json
 import requests
 import base64
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterator, Tuple, List
+from utils.gemini_client import gemini_client
+from utils.response_cache import response_cache, hash_bytes
+from utils.single_flight import single_flight
+from utils.near_duplicates import near_duplicates
+from utils.image_index import image_index, ImageFingerprint
+from utils.scheduler import upstream_scheduler, SchedulerOverloaded
+from utils.resilience import upstream_guard, backoff_delay, parse_retry_after, RETRYABLE_STATUS_CODES
+from utils.key_pool import key_pool, KeyPoolExhausted
+from utils.metrics import metrics
+from utils.prompts import VIETNAMESE_INSTRUCTION, get_system_instruction, build_system_instruction
 
-# Set up logging - tăng mức log để dễ debug
-logging.basicConfig(level=logging.DEBUG)
+# Mức log do app cấu hình; module này không gọi basicConfig khi import
 logger = logging.getLogger(__name__)
 
 # Lời chào mở đầu
@@ -15,79 +27,397 @@ GREETING_MESSAGES = [
     "Xin chào! Tôi sẵn sàng hỗ trợ bạn trong việc học tập."
 ]
 
-def get_ai_response(prompt: str, context: Optional[str] = None, image_url: Optional[str] = None) -> str:
+# Thông báo lỗi dùng chung
+MISSING_API_KEY_MESSAGE = "Không thể kết nối với Google AI API. Vui lòng kiểm tra kết nối mạng hoặc thử lại sau. Nếu lỗi vẫn tiếp tục, hãy nhập lại API key trong trang cài đặt bằng cách truy cập /api_key"
+GENERIC_ERROR_MESSAGE = "Đã xảy ra lỗi khi xử lý yêu cầu của bạn. Vui lòng thử lại sau."
+UNEXPECTED_FORMAT_MESSAGE = "Lỗi khi xử lý phản hồi từ API. Định dạng phản hồi không đúng như mong đợi. Vui lòng thử lại sau."
+CIRCUIT_OPEN_MESSAGE = "Google AI API đang gặp sự cố. Vui lòng thử lại sau ít phút."
+QUOTA_EXHAUSTED_MESSAGE = "Tất cả API key đã hết hạn mức tạm thời. Vui lòng thử lại sau ít phút."
+
+# Cấu hình sinh văn bản và bộ lọc an toàn không đổi giữa các lời gọi
+GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_k": 40,
+    "top_p": 0.95,
+    "max_output_tokens": 1000,
+    # Kích thước đầu ra tối đa và số lượng phản hồi
+    "candidate_count": 1
+}
+
+# Lời gọi gộp nhiều câu hỏi cần nhiều token đầu ra hơn một câu trả lời đơn
+PACKED_MAX_OUTPUT_TOKENS = 8192
+# Dòng phân cách câu trả lời trong lời gọi gộp nhiều câu hỏi
+PACKED_MARKER = "=== CÂU {} ==="
+_PACKED_MARKER_LINE = re.compile(r"^[ \t*#]*=== CÂU (\d+) ===[ \t*]*$", re.MULTILINE)
+
+SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    }
+]
+
+class GeminiAPIError(Exception):
+    """Upstream failure carrying the Vietnamese message shown to the user."""
+    
+    def __init__(self, message: str, retryable: bool = False, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.message = message
+        # Lỗi tạm thời (429, 5xx, mất kết nối) thì được thử lại
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+def sniff_mime_type(data: bytes, default: str = "image/jpeg") -> str:
+    """
+    Detect the image MIME type from its magic bytes.
+    
+    Args:
+        data: Encoded image bytes
+        default: MIME type returned when the format is not recognised
+        
+    Returns:
+        The MIME type, e.g. image/png
+    """
+    header = bytes(data[:12])
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if header.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+        return "image/webp"
+    return default
+
+class InlineImage:
+    """Image bytes sent inline to Gemini, together with their MIME type."""
+    
+    def __init__(self, data: bytes, mime_type: Optional[str] = None, sha256: Optional[str] = None,
+                 fingerprint: Optional[ImageFingerprint] = None):
+        self.data = data
+        # Không truyền MIME thì nhận diện theo nội dung, không mặc định là JPEG
+        self.mime_type = mime_type or sniff_mime_type(data)
+        self._sha256 = sha256
+        # pHash tính lúc chuẩn bị ảnh, dùng để tìm ảnh chụp lại cùng một trang
+        self.fingerprint = fingerprint
+    
+    @property
+    def sha256(self) -> str:
+        """Content hash of the image, computed once on first use."""
+        if self._sha256 is None:
+            self._sha256 = hash_bytes(self.data)
+        return self._sha256
+
+IMAGE_ERROR_NOTE = " (Lưu ý: Không thể xử lý ảnh do lỗi kỹ thuật)"
+
+# Endpoint model gemini-1.5-flash theo phiên bản v1 (nhanh hơn).
+# GEMINI_API_BASE cho phép trỏ sang server giả lập khi kiểm thử
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
+GEMINI_MODEL_URL = f"{GEMINI_API_BASE}/v1/models/gemini-1.5-flash"
+
+def _resolve_api_key() -> Optional[str]:
+    """
+    Resolve the Google AI API key, preferring the environment over app config.
+    
+    Returns:
+        The API key, or None if no key is configured
+    """
+    # Get API key from Flask app config or environment
+    from flask import current_app
+    
+    api_key = None
+    
+    # Ưu tiên lấy từ environment variable trước (không ghi log key, kể cả dạng che)
+    env_key = os.environ.get("GOOGLE_AI_API_KEY")
+    if env_key:
+        api_key = env_key  # Luôn dùng env_key nếu có
+    
+    # Chỉ khi không có từ environment variable, mới lấy từ app config
+    if not api_key:
+        try:
+            app_key = current_app.config.get('GOOGLE_AI_API_KEY')
+            if app_key:
+                api_key = app_key
+        except Exception as e:
+            logger.debug(f"Error getting API key from app config: {e}")
+            # If Flask app context is not available, pass
+            pass
+    
+    return api_key
+
+def _generate_answer(prompt: str, system_instruction: str, image: Optional[InlineImage] = None,
+                     generation_config: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Resolve the API key and call Gemini, raising GeminiAPIError on failure.
+    
+    Args:
+        prompt: The user's message/query
+        system_instruction: The system instruction sent in its own field
+        image: Optional image sent inline with the prompt
+        generation_config: Optional override of GENERATION_CONFIG
+        
+    Returns:
+        AI response as string
+    """
+    logger.debug(f"Received prompt: {prompt}")
+    if image:
+        logger.debug(f"Image: {image.mime_type}, {len(image.data)} bytes")
+    
+    api_key = _resolve_api_key()
+    
+    # Final check - nhóm key đã cấu hình thì không cần key riêng
+    if not api_key and not key_pool.configured:
+        logger.error("API key not found in app config or environment")
+        raise GeminiAPIError(MISSING_API_KEY_MESSAGE)
+    
+    # Call Google Gemini API
+    return _generate_content(prompt, api_key, image, system_instruction, generation_config)
+
+def _stream_answer(prompt: str, system_instruction: str, image: Optional[InlineImage] = None) -> Iterator[str]:
+    """Streaming variant of _generate_answer; raises GeminiAPIError on failure."""
+    api_key = _resolve_api_key()
+    if not api_key and not key_pool.configured:
+        logger.error("API key not found in app config or environment")
+        raise GeminiAPIError(MISSING_API_KEY_MESSAGE)
+    
+    yield from _stream_content(prompt, api_key, image, system_instruction)
+
+def get_ai_response(prompt: str, context: Optional[str] = None, image_url: Optional[str] = None,
+                    image: Optional[InlineImage] = None) -> str:
     """
     Get AI response using Google Gemini API.
     
     Args:
         prompt: The user's message/query
-        context: Optional context like subject and mode
+        context: Optional context like subject and mode, sent as system instruction
         image_url: Optional URL to an image to include in the prompt
+        image: Optional image bytes already in memory, used instead of image_url
         
     Returns:
         AI response as string
     """
     try:
-        logger.debug(f"Received prompt: {prompt}")
-        if context:
-            logger.debug(f"Context: {context}")
-        if image_url:
-            logger.debug(f"Image URL: {image_url}")
-        
-        # Get API key from Flask app config or environment
-        from flask import current_app
+        prompt, image = _prepare_image(prompt, image_url, image)
+        system_instruction = build_system_instruction(context) if context else VIETNAMESE_INSTRUCTION
+        return _generate_answer(prompt, system_instruction, image)
+    
+    except GeminiAPIError as e:
+        return e.message
+    
+    except Exception as e:
+        logger.error(f"Error in get_ai_response: {str(e)}")
+        return GENERIC_ERROR_MESSAGE
+
+def stream_ai_response(prompt: str, context: Optional[str] = None, image_url: Optional[str] = None,
+                       image: Optional[InlineImage] = None) -> Iterator[str]:
+    """
+    Streaming variant of get_ai_response.
+    
+    Args:
+        prompt: The user's message/query
+        context: Optional context like subject and mode, sent as system instruction
+        image_url: Optional URL to an image to include in the prompt
+        image: Optional image bytes already in memory, used instead of image_url
         
-        # Get API key with additional debug info
-        api_key = None
-        app_key = None
-        env_key = None
+    Yields:
+        Text chunks of the AI response as they arrive
+    """
+    try:
+        prompt, image = _prepare_image(prompt, image_url, image)
+        system_instruction = build_system_instruction(context) if context else VIETNAMESE_INSTRUCTION
+        yield from _stream_answer(prompt, system_instruction, image)
+    
+    except GeminiAPIError as e:
+        yield e.message
+    
+    except Exception as e:
+        logger.error(f"Error in stream_ai_response: {str(e)}")
+        yield GENERIC_ERROR_MESSAGE
+
+def _cached_answer(prompt: str, cache_key: str, mode: str, solution_mode: str, subject: str,
+                   image: Optional[InlineImage] = None) -> Optional[str]:
+    """
+    Look up an answer in the response cache, falling back to the similarity indexes.
+    
+    Args:
+        prompt: The user's message/query
+        cache_key: Exact response cache key of the request
+        mode: The mode (trợ lý or giải bài tập)
+        solution_mode: The solution mode (full, step_by_step, or hint)
+        subject: The academic subject
+        image: The attached image, looked up by perceptual hash
         
-        # Ưu tiên lấy từ environment variable trước
-        env_key = os.environ.get("GOOGLE_AI_API_KEY")
-        if env_key:
-            logger.debug(f"API key found in environment (length: {len(env_key)})")
-            # Lấy vài ký tự đầu và cuối để debug
-            masked_env_key = f"{env_key[:4]}...{env_key[-4:]}" if len(env_key) > 8 else "***"
-            logger.debug(f"Environment API key (masked): {masked_env_key}")
-            api_key = env_key  # Luôn dùng env_key nếu có
+    Returns:
+        The cached answer, or None on a miss
+    """
+    # Cả hai lần đọc cache chỉ tính là một lượt tra cứu: một hit hoặc một miss
+    cached = response_cache.get(cache_key, record=False)
+    if cached is None:
+        if image is None:
+            # Câu hỏi viết lại (khác dấu, khoảng trắng, "giải giúp em"...) dùng câu trả lời của câu gốc
+            index = near_duplicates
+            similar_key = index.lookup(prompt, index.scope(mode, solution_mode, subject))
+        else:
+            # Ảnh chụp lại cùng một trang (góc, ánh sáng khác) dùng câu trả lời của ảnh trước
+            index = image_index
+            similar_key = index.lookup(image.fingerprint, index.scope(prompt, mode, solution_mode))
+        if similar_key is not None and similar_key != cache_key:
+            cached = response_cache.get(similar_key, record=False)
+            if cached is None:
+                # Câu trả lời đã hết hạn hoặc bị loại khỏi cache
+                index.forget(similar_key)
+    response_cache.record_lookup(cached is not None)
+    return cached
+
+def _store_answer(prompt: str, cache_key: str, mode: str, solution_mode: str, subject: str, response: str,
+                  image: Optional[InlineImage] = None) -> None:
+    """Cache an answer and index its question (or image) for similarity lookups."""
+    response_cache.set(cache_key, response)
+    if image is None:
+        near_duplicates.add(prompt, near_duplicates.scope(mode, solution_mode, subject), cache_key)
+    else:
+        image_index.add(image.fingerprint, image_index.scope(prompt, mode, solution_mode), cache_key)
+
+def get_specialized_ai_response(prompt: str, subject: str, mode: str, solution_mode: str = "full", image_url: Optional[str] = None, use_cache: bool = True, image: Optional[InlineImage] = None, session_id: Optional[str] = None) -> str:
+    """
+    Get a response from Google Gemini AI based on subject and mode.
+    
+    Args:
+        prompt: The user's message/query
+        subject: The academic subject
+        mode: The mode (trợ lý or giải bài tập)
+        solution_mode: The solution mode (full, step_by_step, or hint)
+        image_url: Optional URL to an image to include in the prompt
+        use_cache: Whether to read and store the answer in the response cache
+        image: Optional image bytes already in memory, used instead of image_url
+        session_id: Identity of the caller for fair scheduling of upstream calls
         
-        # Chỉ khi không có từ environment variable, mới lấy từ app config
-        if not api_key:
-            try:
-                app_key = current_app.config.get('GOOGLE_AI_API_KEY')
-                if app_key:
-                    logger.debug(f"API key found in app config (length: {len(app_key)})")
-                    # Lấy vài ký tự đầu và cuối để debug
-                    masked_app_key = f"{app_key[:4]}...{app_key[-4:]}" if len(app_key) > 8 else "***"
-                    logger.debug(f"App config API key (masked): {masked_app_key}")
-                    api_key = app_key
-            except Exception as e:
-                logger.debug(f"Error getting API key from app config: {e}")
-                # If Flask app context is not available, pass
-                pass
+    Returns:
+        The AI's response as a string
         
-        # Final check
-        if not api_key:
-            logger.error("API key not found in app config or environment")
-            return "Không thể kết nối với Google AI API. Vui lòng kiểm tra kết nối mạng hoặc thử lại sau. Nếu lỗi vẫn tiếp tục, hãy nhập lại API key trong trang cài đặt bằng cách truy cập /api_key"
+    Raises:
+        SchedulerOverloaded: If the upstream call could not be admitted
+    """
+    try:
+        prompt, image = _prepare_image(prompt, image_url, image)
+        cache_key = response_cache.make_key(prompt, mode, solution_mode, subject, image.sha256 if image else None)
+        # Khi mạch đang mở vẫn trả câu trả lời đã cache, kể cả khi được yêu cầu bỏ qua cache
+        if use_cache or upstream_guard.breaker.is_open():
+            cached = _cached_answer(prompt, cache_key, mode, solution_mode, subject, image)
+            if cached is not None:
+                logger.debug("Response cache hit")
+                return cached
         
-        # Prepare prompt with context if available
-        full_prompt = prompt
-        if context:
-            full_prompt = f"{context}\n\n{prompt}"
+        system_instruction = get_system_instruction(mode, solution_mode)
         
-        # Call Google Gemini API
-        response = call_gemini_api(full_prompt, api_key, image_url)
+        def generate():
+            # Chỉ lời gọi thật tới Gemini mới chiếm slot của bộ điều phối
+            with upstream_scheduler.slot(session_id, solution_mode):
+                response = _generate_answer(prompt, system_instruction, image)
+            # Chỉ lưu câu trả lời thành công, không lưu thông báo lỗi
+            if use_cache:
+                _store_answer(prompt, cache_key, mode, solution_mode, subject, response, image)
+            return response
         
-        return response
+        if not use_cache:
+            # Người dùng muốn câu trả lời mới, không dùng chung kết quả của lời gọi khác
+            return generate()
+        # Câu hỏi giống hệt đang chờ Gemini thì dùng chung kết quả của lời gọi đó
+        return single_flight.do(cache_key, generate)
+    
+    except GeminiAPIError as e:
+        return e.message
+    
+    except SchedulerOverloaded:
+        raise
     
     except Exception as e:
-        logger.error(f"Error in get_ai_response: {str(e)}")
-        return "Đã xảy ra lỗi khi xử lý yêu cầu của bạn. Vui lòng thử lại sau."
+        logger.error(f"Error in get_specialized_ai_response: {str(e)}")
+        return GENERIC_ERROR_MESSAGE
+
+def _pack_prompts(prompts: List[str]) -> str:
+    """Number several questions into one prompt that asks for answers separated by marker lines."""
+    numbered = "\n\n".join(f"Câu {i}: {prompt}" for i, prompt in enumerate(prompts, 1))
+    # Không dùng mảng JSON: công thức LaTeX (\frac, \times, \neq...) bị hỏng khi qua chuỗi JSON
+    return (f"Trả lời lần lượt {len(prompts)} câu hỏi dưới đây. Trước câu trả lời cho Câu i, viết riêng "
+            f"một dòng {PACKED_MARKER.format('i')} (ví dụ {PACKED_MARKER.format(1)}), rồi viết câu trả lời "
+            f"đầy đủ như bình thường. Không viết gì trước dòng {PACKED_MARKER.format(1)}.\n\n{numbered}")
 
-def get_specialized_ai_response(prompt: str, subject: str, mode: str, solution_mode: str = "full", image_url: Optional[str] = None) -> str:
+def _split_packed_answer(text: str, count: int) -> List[str]:
     """
-    Get a response from Google Gemini AI based on subject and mode.
+    Split a packed answer back into one answer per question at its marker lines.
+    
+    Raises:
+        ValueError: If the text does not hold exactly count answers numbered 1..count
+    """
+    parts = _PACKED_MARKER_LINE.split(text)
+    # parts = [phần trước dòng đầu, số 1, câu trả lời 1, số 2, câu trả lời 2, ...]
+    numbers = [int(number) for number in parts[1::2]]
+    answers = [answer.strip() for answer in parts[2::2]]
+    if numbers != list(range(1, count + 1)) or not all(answers):
+        raise ValueError(f"Packed answer does not hold {count} answers")
+    return answers
+
+def get_packed_ai_responses(prompts: List[str], subject: str, mode: str, solution_mode: str = "full",
+                            use_cache: bool = True, session_id: Optional[str] = None) -> List[str]:
+    """
+    Answer several short text questions with a single Gemini call.
+    
+    Questions already in the response cache are not sent; the others are
+    numbered into one prompt and the text that comes back is split at the
+    marker lines into one answer per question and cached like a normal answer.
+    
+    Args:
+        prompts: The questions, answered in this order
+        subject: The academic subject
+        mode: The mode (trợ lý or giải bài tập)
+        solution_mode: The solution mode (full, step_by_step, or hint)
+        use_cache: Whether to read and store the answers in the response cache
+        session_id: Identity of the caller for fair scheduling of upstream calls
+        
+    Returns:
+        One answer (or error message) per prompt
+        
+    Raises:
+        SchedulerOverloaded: If the upstream call could not be admitted
+        ValueError: If Gemini did not return one answer per question; the
+            caller should answer the questions one by one instead
+    """
+    keys = [response_cache.make_key(prompt, mode, solution_mode, subject) for prompt in prompts]
+    answers: List[Optional[str]] = [None] * len(prompts)
+    if use_cache or upstream_guard.breaker.is_open():
+        answers = [_cached_answer(prompt, key, mode, solution_mode, subject) for prompt, key in zip(prompts, keys)]
+    missing = [i for i, answer in enumerate(answers) if answer is None]
+    if not missing:
+        return answers
+    
+    try:
+        system_instruction = get_system_instruction(mode, solution_mode)
+        generation_config = dict(GENERATION_CONFIG, max_output_tokens=min(
+            GENERATION_CONFIG["max_output_tokens"] * len(missing), PACKED_MAX_OUTPUT_TOKENS))
+        with upstream_scheduler.slot(session_id, solution_mode):
+            text = _generate_answer(_pack_prompts([prompts[i] for i in missing]), system_instruction,
+                                    generation_config=generation_config)
+    except GeminiAPIError as e:
+        return [answer if answer is not None else e.message for answer in answers]
+    
+    for i, answer in zip(missing, _split_packed_answer(text, len(missing))):
+        answers[i] = answer
+        if use_cache:
+            _store_answer(prompts[i], keys[i], mode, solution_mode, subject, answer)
+    return answers
+
+def stream_specialized_ai_response(prompt: str, subject: str, mode: str, solution_mode: str = "full", image_url: Optional[str] = None, use_cache: bool = True, image: Optional[InlineImage] = None, session_id: Optional[str] = None) -> Iterator[str]:
+    """
+    Streaming variant of get_specialized_ai_response.
     
     Args:
         prompt: The user's message/query
@@ -95,360 +425,543 @@ def get_specialized_ai_response(prompt: str, subject: str, mode: str, solution_m
         mode: The mode (trợ lý or giải bài tập)
         solution_mode: The solution mode (full, step_by_step, or hint)
         image_url: Optional URL to an image to include in the prompt
+        use_cache: Whether to read and store the answer in the response cache
+        image: Optional image bytes already in memory, used instead of image_url
+        session_id: Identity of the caller for fair scheduling of upstream calls
+        
+    Yields:
+        Text chunks of the AI response as they arrive
+        
+    Raises:
+        SchedulerOverloaded: From the first chunk, if the upstream call could not be admitted
+    """
+    try:
+        prompt, image = _prepare_image(prompt, image_url, image)
+        cache_key = response_cache.make_key(prompt, mode, solution_mode, subject, image.sha256 if image else None)
+        # Khi mạch đang mở vẫn trả câu trả lời đã cache, kể cả khi được yêu cầu bỏ qua cache
+        if use_cache or upstream_guard.breaker.is_open():
+            cached = _cached_answer(prompt, cache_key, mode, solution_mode, subject, image)
+            if cached is not None:
+                logger.debug("Response cache hit")
+                yield cached
+                return
+        
+        # Câu hỏi giống hệt đang chờ Gemini: nhận trọn câu trả lời của leader.
+        # Người dùng muốn câu trả lời mới thì không dùng chung kết quả của lời gọi khác
+        flight = single_flight.join(cache_key) if use_cache else None
+        if flight is not None and not flight.leader:
+            shared = flight.wait()
+            if shared is not None:
+                yield shared
+                return
+        
+        system_instruction = get_system_instruction(mode, solution_mode)
+        parts = []
+        try:
+            with upstream_scheduler.slot(session_id, solution_mode):
+                for chunk in _stream_answer(prompt, system_instruction, image):
+                    parts.append(chunk)
+                    yield chunk
+        except BaseException as e:
+            if flight is not None and flight.leader:
+                flight.fail(e)
+            raise
+        
+        response = "".join(parts)
+        if flight is not None and flight.leader:
+            flight.publish(response)
+        if use_cache:
+            _store_answer(prompt, cache_key, mode, solution_mode, subject, response, image)
+    
+    except GeminiAPIError as e:
+        yield e.message
+    
+    except SchedulerOverloaded:
+        raise
+    
+    except Exception as e:
+        logger.error(f"Error in stream_specialized_ai_response: {str(e)}")
+        yield GENERIC_ERROR_MESSAGE
+
+def _resolve_image_path(image_url: str) -> Optional[str]:
+    """
+    Map an image URL or relative path to the file on this server.
+    
+    Args:
+        image_url: Full URL or relative path to an uploaded image
         
     Returns:
-        The AI's response as a string
+        Absolute file path, or None if the URL does not point into static/
     """
-    # Xử lý mọi loại câu hỏi
-    general_instruction = """Bạn là trợ lý AI học tập thông minh, có thể trả lời mọi câu hỏi từ học sinh.
-Hãy trả lời hoàn toàn bằng tiếng Việt, sử dụng ngôn ngữ dễ hiểu và phù hợp.
-Với các câu hỏi mở như văn học, lịch sử, hoặc các chủ đề xã hội, hãy đưa ra câu trả lời đầy đủ, khách quan và có tính giáo dục.
-Với câu hỏi yêu cầu viết văn, hãy cung cấp bài văn hoàn chỉnh theo yêu cầu, tuân thủ cấu trúc bài văn và phong cách văn học phù hợp."""
-    
-    if mode == "giải bài tập":
-        if solution_mode == "step_by_step":
-            system_prompt = f"""Bạn là trợ lý AI học tập thông minh, hỗ trợ mọi môn học và chủ đề. 
-Bạn đang hoạt động ở chế độ giải bài tập CHI TIẾT.
-Hãy trả lời câu hỏi của học sinh THCS hoàn toàn bằng tiếng Việt.
-Tất cả các thuật ngữ chuyên môn cần được dịch sang tiếng Việt.
-Không sử dụng các từ tiếng Anh trừ khi thật sự cần thiết.
-
-Nhiệm vụ của bạn là giải quyết bài tập TỪNG BƯỚC MỘT cách chi tiết nhất, giải thích mỗi bước thực hiện.
-Đặc biệt chú ý:
-1. Chia quá trình giải thành các bước rõ ràng, đánh số từng bước.
-2. Ở mỗi bước, giải thích lý do tại sao thực hiện bước đó.
-3. Đưa ra công thức cụ thể và cách áp dụng (nếu có).
-4. Với các bài tập khó, hãy đưa ra phân tích chi tiết bằng từ ngữ.
-
-{general_instruction}
-
-Phản hồi của bạn phải tuân theo định dạng sau đây:
-1. Đầu tiên, hãy nêu đáp án cuối cùng một cách ngắn gọn, không quá 1-3 dòng.
-2. Tiếp theo, trên một dòng riêng biệt, hãy viết dòng văn bản: "---GIẢI THÍCH TỪNG BƯỚC---"
-3. Sau đó, cung cấp phần giải thích chi tiết và quá trình giải theo từng bước.
-
-Ví dụ:
-"Đáp án: 42m^2
-
----GIẢI THÍCH TỪNG BƯỚC---
-Bước 1: Xác định công thức tính diện tích hình chữ nhật
-- Công thức: S = a × b (với a, b là chiều dài và chiều rộng)
-- Lý do sử dụng: Đề bài cho biết hình là hình chữ nhật
-
-Bước 2: Xác định các giá trị đã biết
-- Chiều dài a = 6m 
-- Chiều rộng b = 7m
-
-Bước 3: Áp dụng công thức tính diện tích
-- S = a × b = 6m × 7m = 42m²
-
-Bước 4: Kiểm tra kết quả
-- Kết quả hợp lý vì diện tích luôn dương
-- Đơn vị đo đã đúng là m²
-
-Vậy diện tích hình chữ nhật là 42m²."
-"""
-        elif solution_mode == "hint":
-            system_prompt = f"""Bạn là trợ lý AI học tập thông minh, hỗ trợ mọi môn học và chủ đề. 
-Bạn đang hoạt động ở chế độ GỢI Ý giải bài tập.
-Hãy trả lời câu hỏi của học sinh THCS hoàn toàn bằng tiếng Việt.
-Tất cả các thuật ngữ chuyên môn cần được dịch sang tiếng Việt.
-Không sử dụng các từ tiếng Anh trừ khi thật sự cần thiết.
-
-Nhiệm vụ của bạn là chỉ đưa ra GỢI Ý giúp học sinh TỰ GIẢI, không đưa ra đáp án trực tiếp.
-Đặc biệt chú ý:
-1. Chỉ đưa ra gợi ý về hướng tiếp cận, KHÔNG giải toàn bộ bài tập.
-2. Gợi ý nên bao gồm các kiến thức cần áp dụng, các bước cần thực hiện.
-3. Nên đặt câu hỏi gợi mở để học sinh tự suy nghĩ.
-4. KHÔNG đưa ra đáp án cuối cùng.
-
-{general_instruction}
-
-Phản hồi của bạn phải tuân theo định dạng sau đây:
-1. Đầu tiên, xác định loại bài tập và kiến thức liên quan.
-2. Tiếp theo, đưa ra hướng tiếp cận và các gợi ý theo thứ tự từ cơ bản đến nâng cao.
-3. Kết thúc bằng câu khuyến khích học sinh tự giải.
-
-Ví dụ:
-"Đây là bài toán về diện tích hình chữ nhật. Để giải bài này, em cần:
-
-Gợi ý 1: Nhớ lại công thức tính diện tích hình chữ nhật là gì?
-Gợi ý 2: Đề bài đã cho biết chiều dài và chiều rộng, hãy xác định chúng.
-Gợi ý 3: Thay các giá trị vào công thức và tính toán kết quả.
-Gợi ý 4: Đừng quên đơn vị đo diện tích là gì?
-
-Hãy thử giải bài toán với các gợi ý trên và kiểm tra lại kết quả của mình."
-"""
-        else:  # full solution mode (default)
-            system_prompt = f"""Bạn là trợ lý AI học tập thông minh, hỗ trợ mọi môn học và chủ đề. 
-Bạn đang hoạt động ở chế độ giải bài tập.
-Hãy trả lời câu hỏi của học sinh THCS hoàn toàn bằng tiếng Việt.
-Tất cả các thuật ngữ chuyên môn cần được dịch sang tiếng Việt.
-Không sử dụng các từ tiếng Anh trừ khi thật sự cần thiết.
-
-Hỗ trợ đa dạng loại bài tập từ tất cả các môn học:
-- Toán học: đại số, hình học, giải tích, xác suất thống kê
-- Ngữ văn: phân tích văn bản, viết bài văn, tìm hiểu tác phẩm
-- Vật lý, hóa học, sinh học và các môn khoa học tự nhiên
-- Lịch sử, địa lý và các môn khoa học xã hội
-- Tiếng Anh và các môn ngoại ngữ khác
-- Các câu hỏi tổng quát, kiến thức đời sống
-
-{general_instruction}
-
-Phản hồi của bạn phải tuân theo định dạng sau đây:
-1. Đầu tiên, hãy nêu đáp án cuối cùng một cách ngắn gọn, không quá 1-3 dòng.
-2. Tiếp theo, trên một dòng riêng biệt, hãy viết dòng văn bản: "---GIẢI THÍCH---"
-3. Sau đó, cung cấp phần giải thích chi tiết và quá trình giải.
-
-Ví dụ cho bài toán:
-"Đáp án: 42m^2
-
----GIẢI THÍCH---
-Để tính diện tích hình chữ nhật, ta dùng công thức S = a × b
-Với a = 6m và b = 7m
-S = 6 × 7 = 42 (m^2)
-Vậy diện tích hình chữ nhật là 42m^2."
-
-Ví dụ cho bài văn:
-"Bài văn: Cảm nhận về bài thơ "Đất Nước" của Nguyễn Khoa Điềm
-
----GIẢI THÍCH---
-Bài thơ "Đất Nước" được trích từ chương V của trường ca "Mặt đường khát vọng" của Nguyễn Khoa Điềm, viết năm 1971. Bài thơ thể hiện tình yêu đất nước sâu sắc thông qua góc nhìn dân gian, đời thường...
-[Nội dung bài văn đầy đủ]"
-"""
-    else:
-        system_prompt = f"""Bạn là trợ lý AI học tập thông minh, hỗ trợ mọi môn học và chủ đề.
-Bạn đang hoạt động ở chế độ trợ lý.
-Hãy trả lời câu hỏi của học sinh THCS bằng tiếng Việt.
-Hãy giải thích chi tiết và giúp học sinh hiểu vấn đề.
+    # Kiểm tra nếu đây là URL đầy đủ
+    if image_url.startswith(('http://', 'https://')):
+        # Xử lý URL, lấy đường dẫn tương đối
+        parts = image_url.split('/static/')
+        if len(parts) > 1:
+            relative_path = 'static/' + parts[1]
+            return os.path.join(os.getcwd(), relative_path)
+        return None
+    
+    # Có thể là đường dẫn tương đối
+    return os.path.join(os.getcwd(), image_url.lstrip('/'))
 
-{general_instruction}
+def _load_image(image_url: str) -> InlineImage:
+    """
+    Load an image referenced by URL, from this server's disk or over HTTP.
+    
+    Args:
+        image_url: Full URL or relative path to an image
+        
+    Returns:
+        The image bytes
+    """
+    # Đường dẫn tuyệt đối tới file ảnh trên server
+    image_file_path = _resolve_image_path(image_url)
+    
+    logger.debug(f"Looking for image at path: {image_file_path}")
+    
+    # Kiểm tra file có tồn tại không
+    if image_file_path and os.path.exists(image_file_path):
+        # Đọc file ảnh trực tiếp từ hệ thống file
+        with open(image_file_path, 'rb') as img_file:
+            return InlineImage(img_file.read())
+    
+    # Không tìm thấy file, thử tải từ URL
+    logger.debug(f"File not found, trying to download from URL: {image_url}")
+    
+    # Nếu đây là URL đầy đủ, thử tải về
+    if image_url.startswith(('http://', 'https://')):
+        image_response = gemini_client.get(image_url)
+        image_response.raise_for_status()
+        logger.debug("Image successfully downloaded")
+        return InlineImage(image_response.content)
+    
+    # Không phải URL và không tìm thấy file
+    raise FileNotFoundError(f"Image file not found: {image_file_path}")
 
-Khi học sinh đặt câu hỏi:
-- Về bất kỳ môn học nào, hãy cung cấp thông tin chính xác và đầy đủ
-- Về viết văn, hãy cung cấp các bài văn mẫu hoặc hướng dẫn viết
-- Về các vấn đề xã hội, hãy đưa ra góc nhìn đa chiều, khách quan
-- Về các lĩnh vực hướng nghiệp, hãy cung cấp thông tin hữu ích
+def _prepare_image(prompt: str, image_url: Optional[str] = None,
+                   image: Optional[InlineImage] = None) -> Tuple[str, Optional[InlineImage]]:
+    """
+    Resolve the image for a request, preferring bytes already in memory.
+    
+    Args:
+        prompt: The user's message/query
+        image_url: Optional URL to an image to include in the prompt
+        image: Optional image bytes already in memory
+        
+    Returns:
+        The prompt (with a note appended if the image could not be loaded) and the image
+    """
+    if image is not None or not image_url:
+        return prompt, image
+    
+    logger.debug(f"Including image URL in request: {image_url}")
+    try:
+        return prompt, _load_image(image_url)
+    except Exception as e:
+        logger.error(f"Error processing image: {str(e)}")
+        # Nếu có lỗi với ảnh, trở lại text-only request
+        return prompt + IMAGE_ERROR_NOTE, None
 
-Không giới hạn loại câu hỏi, có thể trả lời mọi thắc mắc miễn là phù hợp với lứa tuổi học sinh."""
+def _build_gemini_payload(prompt: str, image: Optional[InlineImage] = None,
+                          system_instruction: Optional[str] = None,
+                          generation_config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Build the generateContent request body shared by the blocking and streaming calls.
+    
+    Args:
+        prompt: The user's prompt, sent as the only user turn
+        image: Optional image sent inline with the prompt
+        system_instruction: Static instructions sent in the systemInstruction field;
+            defaults to the Vietnamese-only instruction
+        generation_config: Optional override of GENERATION_CONFIG
+        
+    Returns:
+        The JSON payload as a dict
+    """
+    # Prompt hệ thống đi qua systemInstruction, phần user chỉ còn câu hỏi
+    parts = [
+        {
+            "text": prompt
+        }
+    ]
+    
+    # Nếu có ảnh, gửi kèm dưới dạng inline_data (base64 đúng một lần)
+    if image is not None:
+        parts.append({
+            "inline_data": {
+                "mime_type": image.mime_type,
+                "data": base64.b64encode(image.data).decode('ascii')
+            }
+        })
+    
+    # Định dạng payload theo đúng API v1 của Gemini
+    payload = {
+        "system_instruction": {
+            "parts": [
+                {
+                    "text": system_instruction or VIETNAMESE_INSTRUCTION
+                }
+            ]
+        },
+        "contents": [
+            {
+                "parts": parts
+            }
+        ],
+        "generation_config": generation_config or GENERATION_CONFIG,
+        "safety_settings": SAFETY_SETTINGS
+    }
+    
+    return payload
 
-    context = f"{system_prompt}\nChế độ: {mode}"
-    return get_ai_response(prompt, context, image_url)
+def _gemini_error_message(response: requests.Response) -> str:
+    """
+    Turn a non-200 Gemini response into a user-facing Vietnamese error message.
+    
+    Args:
+        response: The HTTP response returned by the API
+        
+    Returns:
+        The error message to show to the user
+    """
+    error_detail = ""
+    try:
+        error_data = response.json()
+        if "error" in error_data:
+            error_detail = f"Mã lỗi: {error_data.get('error', {}).get('code')}, " \
+                           f"Lý do: {error_data.get('error', {}).get('message')}"
+            logger.error(f"API error response: {error_detail}")
+    except:
+        error_detail = f"Lỗi HTTP {response.status_code}"
+        logger.error(f"API error response status code: {response.status_code}")
+    
+    # Đối với lỗi 400, có thể là do API key không hợp lệ
+    if response.status_code == 400:
+        return f"Lỗi kết nối đến API: API key không hợp lệ hoặc đã hết hạn. Vui lòng kiểm tra lại API key của bạn."
+    elif response.status_code == 403:
+        return f"Lỗi quyền truy cập API: API key không có quyền sử dụng dịch vụ này. Vui lòng kiểm tra quyền của API key."
+    else:
+        return f"Lỗi kết nối đến API: {error_detail}. Vui lòng thử lại sau hoặc kiểm tra cài đặt API key."
 
-def call_gemini_api(prompt: str, api_key: str, image_url: Optional[str] = None) -> str:
+def _generate_content(prompt: str, api_key: str, image: Optional[InlineImage] = None,
+                      system_instruction: Optional[str] = None,
+                      generation_config: Optional[Dict[str, Any]] = None) -> str:
     """
-    Call the Google Gemini API and return the response.
+    Call generateContent, raising GeminiAPIError instead of returning error text.
+    
+    Each attempt takes the least-loaded healthy key from the key pool; api_key
+    is only used when no pool keys are configured.
     
     Args:
-        prompt: The full prompt to send to the API
+        prompt: The user's prompt to send to the API
         api_key: The Google AI API key
-        image_url: Optional URL to an image to include in the prompt
+        image: Optional image sent inline with the prompt
+        system_instruction: Optional system instruction sent in its own field
+        generation_config: Optional override of GENERATION_CONFIG
         
     Returns:
         The text response from the API
     """
     # Xác minh API key
-    if not api_key:
+    if not api_key and not key_pool.configured:
         logger.error("API key is empty or None")
-        return "Không thể kết nối với Google AI API. API key không được cung cấp."
+        raise GeminiAPIError("Không thể kết nối với Google AI API. API key không được cung cấp.")
+    
+    url = f"{GEMINI_MODEL_URL}:generateContent"
+    with metrics.span("gemini", "payload"):
+        payload = _build_gemini_payload(prompt, image, system_instruction, generation_config)
     
-    # Ghi log API key (chỉ vài ký tự đầu và cuối để bảo mật)
-    key_len = len(api_key)
-    masked_key = f"{api_key[:4]}...{api_key[-4:]}" if key_len > 8 else "***"
-    logger.debug(f"Using API key: {masked_key} (length: {key_len})")
+    # Chỉ tính kích thước payload (có thể chứa cả ảnh base64) khi log debug thật sự bật
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Sending request to {url}, payload size: {len(str(payload))} bytes")
     
-    # URL theo phiên bản v1 với model gemini-1.5-flash (nhanh hơn)
-    url = "https://generativelanguage.googleapis.com/v1/models/gemini-1.5-flash:generateContent"
-    headers = {
-        "Content-Type": "application/json"
+    def attempt():
+        return _post_generate_content(url, api_key, payload)
+    
+    return _with_retries(lambda: upstream_guard.run(attempt))
+
+def _upstream_error(response: requests.Response) -> GeminiAPIError:
+    """Build the GeminiAPIError for a non-200 response, marking transient statuses as retryable."""
+    return GeminiAPIError(_gemini_error_message(response),
+                          retryable=response.status_code in RETRYABLE_STATUS_CODES,
+                          retry_after=parse_retry_after(response.headers.get("Retry-After")))
+
+def _acquire_key(api_key: Optional[str]):
+    """Lease a key from the pool, mapping an exhausted pool to a retryable GeminiAPIError."""
+    try:
+        return key_pool.acquire(api_key)
+    except KeyPoolExhausted as e:
+        raise GeminiAPIError(QUOTA_EXHAUSTED_MESSAGE, retryable=True, retry_after=e.retry_after)
+    except ValueError:
+        raise GeminiAPIError(MISSING_API_KEY_MESSAGE)
+
+def _request_headers(api_key: str) -> Dict[str, str]:
+    # Gửi key qua header thay vì query string để key không lọt vào URL, log và thông báo lỗi
+    return {
+        "Content-Type": "application/json",
+        "x-goog-api-key": api_key
     }
+
+def _rotate_on_quota(error: GeminiAPIError, status_code: int, api_key: str) -> GeminiAPIError:
+    # Retry-After của 429 chỉ áp dụng cho key vừa lỗi; còn key khỏe khác thì thử lại ngay với key đó
+    if status_code == 429 and key_pool.has_healthy(exclude=api_key):
+        error.retry_after = None
+    return error
+
+def _post_generate_content(url: str, api_key: Optional[str], payload: Dict[str, Any]) -> str:
+    """
+    Make one generateContent request with a pooled key and extract the answer text.
     
-    # Add API key as query parameter
-    url = f"{url}?key={api_key}"
+    Raises:
+        GeminiAPIError: On any failure; retryable for transient ones
+    """
+    lease = _acquire_key(api_key)
+    started = time.monotonic()
+    try:
+        # Send request to API qua client dùng chung (keep-alive, có timeout),
+        # trong giới hạn số lời gọi đồng thời
+        with gemini_client.upstream_slot(), metrics.span("gemini", "upstream"):
+            response = gemini_client.post(url, headers=_request_headers(lease.key), json=payload)
     
-    # Thêm yêu cầu trả lời bằng tiếng Việt cho tất cả các trường hợp
-    vietnamese_instruction = ("Trả lời hoàn toàn bằng tiếng Việt. "
-                           "Tất cả các thuật ngữ toán học, khoa học và các giải thích phải được viết bằng tiếng Việt. "
-                           "Không sử dụng tiếng Anh trong câu trả lời. "
-                           "Phân tích và giải bài toán hoặc trả lời câu hỏi sau: ")
+    except requests.exceptions.RequestException as e:
+        lease.release(None)
+        raise GeminiAPIError(_request_error_message(e), retryable=True)
     
-    enhanced_prompt = vietnamese_instruction + prompt
+    # Check for HTTP errors and provide detailed error information
+    error = _upstream_error(response) if response.status_code != 200 else None
+    lease.release(response.status_code, error.retry_after if error else None)
+    if error:
+        raise _rotate_on_quota(error, response.status_code, lease.key)
     
-    # Prepare request payload theo định dạng API v1
-    contents = []
+    # Parse response data
+    with metrics.span("gemini", "decode"):
+        data = response.json()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Received response: {str(data)[:200]}...")
+    
+    # Extract text from response
+    # Câu trả lời bị chặn (vd. finishReason SAFETY) không có "content"
+    if "candidates" in data and len(data["candidates"]) > 0:
+        content = data["candidates"][0].get("content", {})
+        if "parts" in content and len(content["parts"]) > 0 and "text" in content["parts"][0]:
+            upstream_guard.record_latency(time.monotonic() - started)
+            return content["parts"][0]["text"]
+    
+    # If we can't extract text properly, return error
+    logger.error(f"Unexpected API response format: {data}")
+    raise GeminiAPIError(UNEXPECTED_FORMAT_MESSAGE)
+
+def _with_retries(call):
+    """
+    Run call with bounded, jittered retries behind the circuit breaker.
     
-    # Nếu có ảnh, xác định kiểu yêu cầu multimodal
-    if image_url:
-        logger.debug(f"Including image URL in request: {image_url}")
+    Args:
+        call: Makes one attempt and raises GeminiAPIError on failure
         
+    Returns:
+        The result of the first successful attempt
+    """
+    breaker = upstream_guard.breaker
+    for attempt in range(upstream_guard.attempts):
+        if not breaker.allow():
+            raise GeminiAPIError(CIRCUIT_OPEN_MESSAGE)
         try:
-            # Đường dẫn tuyệt đối tới file ảnh trên server
-            image_file_path = None
-            
-            # Kiểm tra nếu đây là URL đầy đủ
-            if image_url.startswith(('http://', 'https://')):
-                # Xử lý URL, lấy đường dẫn tương đối
-                parts = image_url.split('/static/')
-                if len(parts) > 1:
-                    relative_path = 'static/' + parts[1]
-                    image_file_path = os.path.join(os.getcwd(), relative_path)
-            else:
-                # Có thể là đường dẫn tương đối
-                image_file_path = os.path.join(os.getcwd(), image_url.lstrip('/'))
-            
-            logger.debug(f"Looking for image at path: {image_file_path}")
-            
-            # Kiểm tra file có tồn tại không
-            if image_file_path and os.path.exists(image_file_path):
-                # Đọc file ảnh trực tiếp từ hệ thống file
-                with open(image_file_path, 'rb') as img_file:
-                    image_data = img_file.read()
-                    
-                # Mã hóa ảnh thành base64
-                image_base64 = base64.b64encode(image_data).decode('utf-8')
-                
-                # Thêm ảnh vào request
-                contents.append({
-                    "parts": [
-                        {
-                            "text": enhanced_prompt
-                        },
-                        {
-                            "inline_data": {
-                                "mime_type": "image/jpeg",
-                                "data": image_base64
-                            }
-                        }
-                    ]
-                })
-                logger.debug("Image successfully encoded and added to request")
-            else:
-                # Không tìm thấy file, thử tải từ URL
-                logger.debug(f"File not found, trying to download from URL: {image_url}")
-                
-                # Nếu đây là URL đầy đủ, thử tải về
-                if image_url.startswith(('http://', 'https://')):
-                    image_response = requests.get(image_url)
-                    image_response.raise_for_status()
-                    
-                    # Mã hóa ảnh thành base64
-                    image_base64 = base64.b64encode(image_response.content).decode('utf-8')
-                    
-                    # Thêm ảnh vào request
-                    contents.append({
-                        "parts": [
-                            {
-                                "text": enhanced_prompt
-                            },
-                            {
-                                "inline_data": {
-                                    "mime_type": "image/jpeg",
-                                    "data": image_base64
-                                }
-                            }
-                        ]
-                    })
-                    logger.debug("Image successfully downloaded and encoded")
-                else:
-                    # Không phải URL và không tìm thấy file
-                    raise FileNotFoundError(f"Image file not found: {image_file_path}")
-                    
-        except Exception as e:
-            logger.error(f"Error processing image: {str(e)}")
-            # Nếu có lỗi với ảnh, trở lại text-only request
-            contents.append({
-                "parts": [
-                    {
-                        "text": enhanced_prompt + " (Lưu ý: Không thể xử lý ảnh do lỗi kỹ thuật)"
-                    }
-                ]
-            })
-    else:
-        # Nếu không có ảnh, sử dụng text-only request
-        contents.append({
-            "parts": [
-                {
-                    "text": enhanced_prompt
-                }
-            ]
-        })
-    
-    # Định dạng payload theo đúng API v1 của Gemini
-    payload = {
-        "contents": contents,
-        "generation_config": {
-            "temperature": 0.7,
-            "top_k": 40,
-            "top_p": 0.95,
-            "max_output_tokens": 1000,
-            # Kích thước đầu ra tối đa và số lượng phản hồi
-            "candidate_count": 1
-        },
-        "safety_settings": [
-            {
-                "category": "HARM_CATEGORY_HATE_SPEECH",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-            },
-            {
-                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-            },
-            {
-                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-            }
-        ]
-    }
+            result = call()
+        except GeminiAPIError as e:
+            if not e.retryable:
+                # Gemini vẫn trả lời (vd. lỗi 400), mạch không có vấn đề
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt == upstream_guard.attempts - 1:
+                raise
+            delay = backoff_delay(attempt, e.retry_after)
+            logger.warning(f"Gemini call failed, retrying in {delay:.2f}s (attempt {attempt + 1})")
+            upstream_guard.count("retries")
+            # Nhả slot của bộ điều phối trong lúc chờ để request khác gọi Gemini
+            with upstream_scheduler.paused():
+                time.sleep(delay)
+            continue
+        except Exception:
+            # Lỗi ngoài dự kiến khi đọc phản hồi cũng tính là một lần Gemini lỗi
+            breaker.record_failure()
+            raise
+        except BaseException:
+            # Bị hủy giữa chừng (vd. gevent Timeout): không kết luận được, nhả lượt thăm dò
+            breaker.release_probe()
+            raise
+        breaker.record_success()
+        return result
+
+def call_gemini_api(prompt: str, api_key: str, image_url: Optional[str] = None,
+                    system_instruction: Optional[str] = None, image: Optional[InlineImage] = None) -> str:
+    """
+    Call the Google Gemini API and return the response.
     
-    try:
-        # Log payload size for debugging
-        payload_size = len(str(payload))
-        logger.debug(f"Sending request to {url}, payload size: {payload_size} bytes")
+    Args:
+        prompt: The user's prompt to send to the API
+        api_key: The Google AI API key
+        image_url: Optional URL to an image to include in the prompt
+        system_instruction: Optional system instruction sent in its own field
+        image: Optional image bytes already in memory, used instead of image_url
         
-        # Send request to API
-        response = requests.post(url, headers=headers, json=payload)
+    Returns:
+        The text response from the API
+    """
+    try:
+        prompt, image = _prepare_image(prompt, image_url, image)
+        return _generate_content(prompt, api_key, image, system_instruction)
+    except GeminiAPIError as e:
+        return e.message
+
+def _request_error_message(e: requests.exceptions.RequestException) -> str:
+    """
+    Turn a transport-level request failure into a user-facing Vietnamese error message.
+    
+    Args:
+        e: The exception raised by requests
         
-        # Check for HTTP errors and provide detailed error information
-        if response.status_code != 200:
-            error_detail = ""
-            try:
-                error_data = response.json()
-                if "error" in error_data:
-                    error_detail = f"Mã lỗi: {error_data.get('error', {}).get('code')}, " \
-                                   f"Lý do: {error_data.get('error', {}).get('message')}"
-                    logger.error(f"API error response: {error_detail}")
-            except:
-                error_detail = f"Lỗi HTTP {response.status_code}"
-                logger.error(f"API error response status code: {response.status_code}")
-            
-            # Đối với lỗi 400, có thể là do API key không hợp lệ
-            if response.status_code == 400:
-                return f"Lỗi kết nối đến API: API key không hợp lệ hoặc đã hết hạn. Vui lòng kiểm tra lại API key của bạn."
-            elif response.status_code == 403:
-                return f"Lỗi quyền truy cập API: API key không có quyền sử dụng dịch vụ này. Vui lòng kiểm tra quyền của API key."
-            else:
-                return f"Lỗi kết nối đến API: {error_detail}. Vui lòng thử lại sau hoặc kiểm tra cài đặt API key."
+    Returns:
+        The error message to show to the user
+    """
+    if isinstance(e, requests.exceptions.Timeout):
+        logger.error(f"API request timed out: {str(e)}")
+        return "Google AI API phản hồi quá lâu. Vui lòng thử lại sau."
+    
+    logger.error(f"API request failed: {str(e)}")
+    if "Invalid API key" in str(e):
+        return "Lỗi API key không hợp lệ. Vui lòng kiểm tra và cập nhật API key của bạn."
+    elif "Forbidden" in str(e):
+        return "API key không có quyền truy cập. Vui lòng kiểm tra quyền của API key."
+    else:
+        return f"Không thể kết nối với Google AI API: {str(e)}. Vui lòng kiểm tra kết nối mạng hoặc thử lại sau."
+
+def _stream_content(prompt: str, api_key: str, image: Optional[InlineImage] = None,
+                    system_instruction: Optional[str] = None) -> Iterator[str]:
+    """
+    Call streamGenerateContent and yield text as it arrives, raising GeminiAPIError on failure.
+    
+    Args:
+        prompt: The user's prompt to send to the API
+        api_key: The Google AI API key
+        image: Optional image sent inline with the prompt
+        system_instruction: Optional system instruction sent in its own field
         
-        # Parse response data
-        data = response.json()
-        logger.debug(f"Received response: {str(data)[:200]}...")
+    Yields:
+        Text chunks of the response
+    """
+    if not api_key and not key_pool.configured:
+        logger.error("API key is empty or None")
+        raise GeminiAPIError("Không thể kết nối với Google AI API. API key không được cung cấp.")
+    
+    # alt=sse để Gemini trả về từng đoạn dưới dạng server-sent events
+    url = f"{GEMINI_MODEL_URL}:streamGenerateContent?alt=sse"
+    with metrics.span("gemini_stream", "payload"):
+        payload = _build_gemini_payload(prompt, image, system_instruction)
+    
+    # Chỉ thử lại khi chưa gửi đoạn nào cho client; đã stream dở thì báo lỗi luôn
+    breaker = upstream_guard.breaker
+    for attempt in range(upstream_guard.attempts):
+        if not breaker.allow():
+            raise GeminiAPIError(CIRCUIT_OPEN_MESSAGE)
+        upstream_guard.count("attempts")
+        produced = False
+        try:
+            lease = _acquire_key(api_key)
+            # Giữ slot suốt thời gian đọc stream vì kết nối vẫn mở tới khi đọc xong
+            with gemini_client.upstream_slot():
+                try:
+                    # Thời gian tới khi Gemini trả header, trước đoạn đầu tiên
+                    with metrics.span("gemini_stream", "upstream"):
+                        response = gemini_client.post(url, headers=_request_headers(lease.key), json=payload,
+                                                      stream=True)
+                except requests.exceptions.RequestException as e:
+                    lease.release(None)
+                    raise GeminiAPIError(_request_error_message(e), retryable=True)
+                
+                # Kết quả báo cho pool key, trả một lần duy nhất trong finally
+                status_code, retry_after = response.status_code, None
+                try:
+                    if response.status_code != 200:
+                        error = _upstream_error(response)
+                        retry_after = error.retry_after
+                        raise _rotate_on_quota(error, response.status_code, lease.key)
+                    
+                    response.encoding = "utf-8"
+                    for line in response.iter_lines(decode_unicode=True):
+                        # Mỗi sự kiện có dạng "data: {...}", bỏ qua dòng trống và comment
+                        if not line or not line.startswith("data:"):
+                            continue
+                        try:
+                            chunk = json.loads(line[5:].strip())
+                        except ValueError:
+                            logger.warning(f"Skipping malformed stream chunk: {line[:200]}")
+                            continue
+                        
+                        for candidate in chunk.get("candidates", [])[:1]:
+                            for part in candidate.get("content", {}).get("parts", []):
+                                text = part.get("text")
+                                if text:
+                                    produced = True
+                                    yield text
+                    
+                    if not produced:
+                        logger.error("Stream finished without any text")
+                        raise GeminiAPIError(UNEXPECTED_FORMAT_MESSAGE)
+                
+                except requests.exceptions.RequestException as e:
+                    # Mất kết nối giữa stream: báo cho pool như lỗi mạng
+                    status_code = None
+                    raise GeminiAPIError(_request_error_message(e), retryable=True)
+                
+                finally:
+                    # Trả kết nối và key về pool kể cả khi client ngắt giữa chừng
+                    response.close()
+                    lease.release(status_code, retry_after)
         
-        # Extract text from response
-        if "candidates" in data and len(data["candidates"]) > 0:
-            content = data["candidates"][0]["content"]
-            if "parts" in content and len(content["parts"]) > 0:
-                return content["parts"][0]["text"]
+        except GeminiAPIError as e:
+            if not e.retryable:
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if produced or attempt == upstream_guard.attempts - 1:
+                raise
+            delay = backoff_delay(attempt, e.retry_after)
+            logger.warning(f"Gemini stream failed before the first chunk, retrying in {delay:.2f}s")
+            upstream_guard.count("retries")
+            # Nhả slot của bộ điều phối trong lúc chờ để request khác gọi Gemini
+            with upstream_scheduler.paused():
+                time.sleep(delay)
+            continue
+        except Exception:
+            breaker.record_failure()
+            raise
+        except BaseException:
+            # Client ngắt stream (GeneratorExit) hoặc request bị hủy: nhả lượt thăm dò
+            breaker.release_probe()
+            raise
         
-        # If we can't extract text properly, return error
-        logger.error(f"Unexpected API response format: {data}")
-        return "Lỗi khi xử lý phản hồi từ API. Định dạng phản hồi không đúng như mong đợi. Vui lòng thử lại sau."
+        breaker.record_success()
+        return
+
+def stream_gemini_api(prompt: str, api_key: str, image_url: Optional[str] = None,
+                      system_instruction: Optional[str] = None, image: Optional[InlineImage] = None) -> Iterator[str]:
+    """
+    Call the streamGenerateContent endpoint and yield text as it arrives.
     
-    except requests.exceptions.RequestException as e:
-        logger.error(f"API request failed: {str(e)}")
-        if "Invalid API key" in str(e):
-            return "Lỗi API key không hợp lệ. Vui lòng kiểm tra và cập nhật API key của bạn."
-        elif "Forbidden" in str(e):
-            return "API key không có quyền truy cập. Vui lòng kiểm tra quyền của API key."
-        else:
-            return f"Không thể kết nối với Google AI API: {str(e)}. Vui lòng kiểm tra kết nối mạng hoặc thử lại sau."
+    Args:
+        prompt: The user's prompt to send to the API
+        api_key: The Google AI API key
+        image_url: Optional URL to an image to include in the prompt
+        system_instruction: Optional system instruction sent in its own field
+        image: Optional image bytes already in memory, used instead of image_url
+        
+    Yields:
+        Text chunks of the response; on failure a single error message
+    """
+    try:
+        prompt, image = _prepare_image(prompt, image_url, image)
+        yield from _stream_content(prompt, api_key, image, system_instruction)
+    except GeminiAPIError as e:
+        yield e.message
@@ -0,0 +1,241 @@
+import os
+import time
+import hashlib
+import logging
+import sqlite3
+import itertools
+import threading
+from collections import deque
+from typing import Optional, Dict, Any, List, Tuple
+
+from utils.sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+# Chỉ mục hash cảm nhận của ảnh tải lên - có thể ghi đè bằng biến môi trường
+IMAGE_INDEX_ENABLED = os.environ.get("IMAGE_INDEX_ENABLED", "1") != "0"
+IMAGE_INDEX_PATH = os.environ.get("IMAGE_INDEX_PATH", os.path.join("instance", "image_index.db"))
+# Khoảng cách Hamming tối đa (trên 64 bit pHash) để một ảnh cũ được xét là ứng viên
+IMAGE_INDEX_MAX_DISTANCE = int(os.environ.get("IMAGE_INDEX_MAX_DISTANCE", "12"))
+# Số ứng viên gần nhất được kiểm tra lại bằng căn chỉnh ảnh
+IMAGE_INDEX_MAX_CANDIDATES = int(os.environ.get("IMAGE_INDEX_MAX_CANDIDATES", "3"))
+# Tương quan (0-1) tối thiểu giữa ảnh mới và ảnh cũ sau khi căn chỉnh để dùng lại câu trả lời
+IMAGE_INDEX_MIN_SCORE = float(os.environ.get("IMAGE_INDEX_MIN_SCORE", "0.85"))
+# Không cần lớn hơn response cache: câu trả lời bị loại khỏi cache thì mục chỉ mục cũng vô dụng
+IMAGE_INDEX_MAX_ENTRIES = int(os.environ.get("IMAGE_INDEX_MAX_ENTRIES", "5000"))
+
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS images (
+        id INTEGER PRIMARY KEY,
+        scope TEXT NOT NULL,
+        phash INTEGER NOT NULL,
+        cache_key TEXT NOT NULL UNIQUE,
+        thumbnail BLOB NOT NULL,
+        created_at REAL NOT NULL
+    )""",
+)
+
+
+class ImageFingerprint:
+    """64-bit pHash of an upload plus the small grayscale JPEG used to verify a match."""
+
+    def __init__(self, phash: int, thumbnail: bytes):
+        self.phash = phash
+        self.thumbnail = thumbnail
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class MultiIndexHash:
+    """
+    Multi-index hashing for Hamming-distance search over 64-bit hashes.
+
+    Each 16-bit chunk has its own table; two hashes within r bits share at
+    least one chunk within r // chunks bits, so only those neighbours are probed.
+    """
+
+    def __init__(self, radius: int, chunks: int = 4):
+        self.radius = radius
+        self.chunks = chunks
+        self.bits = 64 // chunks
+        self._tables: List[Dict[int, List[Tuple[int, int]]]] = [{} for _ in range(chunks)]
+        chunk_radius = radius // chunks
+        # Mọi mặt nạ có tối đa chunk_radius bit trong một đoạn
+        self._masks = [sum(1 << bit for bit in bits)
+                       for count in range(chunk_radius + 1)
+                       for bits in itertools.combinations(range(self.bits), count)]
+        self.size = 0
+
+    def _parts(self, value: int) -> List[int]:
+        mask = (1 << self.bits) - 1
+        return [(value >> (i * self.bits)) & mask for i in range(self.chunks)]
+
+    def add(self, value: int, item: int) -> None:
+        self.size += 1
+        for table, part in zip(self._tables, self._parts(value)):
+            table.setdefault(part, []).append((value, item))
+
+    def search(self, value: int) -> List[Tuple[int, int]]:
+        """Return (distance, item) for every stored hash within radius of value, nearest first."""
+        found = {}
+        for table, part in zip(self._tables, self._parts(value)):
+            for mask in self._masks:
+                for stored, item in table.get(part ^ mask, ()):
+                    if item not in found:
+                        distance = hamming(value, stored)
+                        if distance <= self.radius:
+                            found[item] = distance
+        return sorted((distance, item) for item, distance in found.items())
+
+
+class PerceptualHashIndex:
+    """
+    Index of answered exercise images by perceptual hash (pHash).
+
+    Rows live in SQLite shared by all workers; each worker keeps a multi-index
+    hash per scope. Candidates are only accepted after ORB alignment in the image pool.
+    """
+
+    def __init__(self, path: str = IMAGE_INDEX_PATH, max_distance: int = IMAGE_INDEX_MAX_DISTANCE,
+                 max_candidates: int = IMAGE_INDEX_MAX_CANDIDATES, min_score: float = IMAGE_INDEX_MIN_SCORE,
+                 max_entries: int = IMAGE_INDEX_MAX_ENTRIES, enabled: bool = IMAGE_INDEX_ENABLED):
+        self.path = path
+        self.max_distance = max_distance
+        self.max_candidates = max_candidates
+        self.min_score = min_score
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._db = SqliteStore(path, _SCHEMA)
+        self._lock = threading.Lock()
+        self._tables: Dict[str, MultiIndexHash] = {}
+        self._dead: set = set()
+        self._last_id = 0
+        self._pid = None
+        self._counters = {"lookups": 0, "hits": 0, "misses": 0, "candidates": 0, "rejected": 0,
+                          "stale": 0, "added": 0}
+        self._latencies_ms = deque(maxlen=1000)
+
+    def _sync(self, conn: sqlite3.Connection) -> None:
+        # Nạp các ảnh mà worker khác (hoặc lần chạy trước) đã thêm; id chỉ tăng
+        with self._lock:
+            # Dựng lại khi sang tiến trình mới hoặc khi quá nhiều mục đã bị xóa ở worker khác
+            indexed = sum(table.size for table in self._tables.values())
+            if self._pid != os.getpid() or len(self._dead) > max(indexed // 2, 100):
+                self._tables, self._dead, self._last_id, self._pid = {}, set(), 0, os.getpid()
+            rows = conn.execute("SELECT id, scope, phash FROM images WHERE id > ? ORDER BY id",
+                                (self._last_id,)).fetchall()
+            for image_id, scope, phash in rows:
+                self._tables.setdefault(scope, MultiIndexHash(self.max_distance)).add(phash + (1 << 63), image_id)
+                self._last_id = image_id
+
+    @staticmethod
+    def scope(prompt: str, mode: str, solution_mode: str) -> str:
+        """Images only match others sent with the same prompt, mode and solution mode."""
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+        return f"{mode}|{solution_mode}|{digest}"
+
+    def lookup(self, fingerprint: Optional[ImageFingerprint], scope: str) -> Optional[str]:
+        """
+        Find an earlier upload of the same page.
+
+        Args:
+            fingerprint: Fingerprint computed while preparing the upload
+            scope: Value of scope() for the request
+
+        Returns:
+            The response cache key of the matching upload, or None
+        """
+        if not self.enabled or fingerprint is None:
+            return None
+        from utils.image_pipeline import match_score
+        from utils.image_workers import image_workers
+
+        started = time.perf_counter()
+        match, checked, rejected = None, 0, 0
+        try:
+            conn = self._db.connect()
+            self._sync(conn)
+            with self._lock:
+                table = self._tables.get(scope)
+                found = table.search(fingerprint.phash) if table else []
+                ids = [image_id for _, image_id in found if image_id not in self._dead][:self.max_candidates]
+            if ids:
+                rows = dict((row[0], row[1:]) for row in conn.execute(
+                    f"SELECT id, cache_key, thumbnail FROM images WHERE id IN ({','.join('?' * len(ids))})", ids))
+                with self._lock:
+                    self._dead.update(image_id for image_id in ids if image_id not in rows)
+                candidates = [rows[image_id] for image_id in ids if image_id in rows]
+                # Căn chỉnh và so ảnh tốn CPU nên chạy song song trong pool
+                futures = [(cache_key, image_workers.submit(match_score, fingerprint.thumbnail, thumbnail))
+                           for cache_key, thumbnail in candidates]
+                for cache_key, future in futures:
+                    checked += 1
+                    score = future.result()
+                    if match is None and score >= self.min_score:
+                        match = cache_key
+                    elif score < self.min_score:
+                        rejected += 1
+        except sqlite3.Error as e:
+            logger.warning(f"Image index lookup failed: {e}")
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._counters["lookups"] += 1
+            self._counters["hits" if match else "misses"] += 1
+            self._counters["candidates"] += checked
+            self._counters["rejected"] += rejected
+            self._latencies_ms.append(elapsed)
+        return match
+
+    def add(self, fingerprint: Optional[ImageFingerprint], scope: str, cache_key: str) -> None:
+        """Index an answered upload so later photos of the same page resolve to cache_key."""
+        if not self.enabled or fingerprint is None:
+            return
+        try:
+            conn = self._db.connect()
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO images (scope, phash, cache_key, thumbnail, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                # SQLite lưu số nguyên 64 bit có dấu
+                (scope, fingerprint.phash - (1 << 63), cache_key, fingerprint.thumbnail, time.time()))
+            if cursor.rowcount == 1:
+                # Xóa ảnh cũ nhất khi vượt giới hạn; id tăng dần theo thời gian thêm
+                conn.execute("DELETE FROM images WHERE id <= ?", (cursor.lastrowid - self.max_entries,))
+                with self._lock:
+                    self._counters["added"] += 1
+        except sqlite3.Error as e:
+            logger.warning(f"Image index write failed: {e}")
+
+    def forget(self, cache_key: str) -> None:
+        """Drop the upload pointing at cache_key, used when its answer left the response cache."""
+        with self._lock:
+            self._counters["stale"] += 1
+        try:
+            self._db.connect().execute("DELETE FROM images WHERE cache_key = ?", (cache_key,))
+        except sqlite3.Error as e:
+            logger.warning(f"Image index delete failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit rate, verification rejections and lookup latency in this worker."""
+        with self._lock:
+            result = dict(self._counters)
+            latencies = sorted(self._latencies_ms)
+            result["indexed"] = sum(table.size for table in self._tables.values())
+        result["hit_rate"] = round(result["hits"] / result["lookups"], 4) if result["lookups"] else 0.0
+        result["lookup_ms_avg"] = round(sum(latencies) / len(latencies), 2) if latencies else 0.0
+        result["lookup_ms_p95"] = round(latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)], 2) \
+            if latencies else 0.0
+        result.update({"enabled": self.enabled, "max_distance": self.max_distance, "min_score": self.min_score,
+                       "entries": 0, "max_entries": self.max_entries})
+        if self.enabled:
+            try:
+                result["entries"] = self._db.connect().execute("SELECT COUNT(*) FROM images").fetchone()[0]
+            except sqlite3.Error as e:
+                logger.warning(f"Image index stats failed: {e}")
+        return result
+
+
+# Chỉ mục dùng chung cho cả module
+image_index = PerceptualHashIndex()
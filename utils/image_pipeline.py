@@ -0,0 +1,254 @@
+import os
+import time
+import logging
+from typing import Optional, TYPE_CHECKING
+from utils.response_cache import hash_bytes
+from utils.huggingface_api import InlineImage
+from utils.image_index import ImageFingerprint
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Cấu hình chuẩn bị ảnh trước khi gửi Gemini - có thể ghi đè bằng biến môi trường
+GEMINI_IMAGE_PREPARE = os.environ.get("GEMINI_IMAGE_PREPARE", "1") != "0"
+GEMINI_IMAGE_MAX_EDGE = int(os.environ.get("GEMINI_IMAGE_MAX_EDGE", "1600"))
+GEMINI_IMAGE_TEXT_QUALITY = int(os.environ.get("GEMINI_IMAGE_TEXT_QUALITY", "85"))
+GEMINI_IMAGE_PHOTO_QUALITY = int(os.environ.get("GEMINI_IMAGE_PHOTO_QUALITY", "75"))
+
+# Ngưỡng phân loại ảnh chụp tài liệu/chữ so với ảnh thường
+TEXT_MAX_SATURATION = 40
+TEXT_MIN_BRIGHT_FRACTION = 0.5
+
+# Ảnh xám nhỏ lưu trong chỉ mục pHash để kiểm tra lại ứng viên
+FINGERPRINT_THUMBNAIL_EDGE = 512
+FINGERPRINT_THUMBNAIL_QUALITY = 80
+
+# Ảnh thu nhỏ trả về trong JSON của upload_image khi client chọn image_response=thumbnail
+DISPLAY_THUMBNAIL_EDGE = int(os.environ.get("DISPLAY_THUMBNAIL_EDGE", "320"))
+DISPLAY_THUMBNAIL_QUALITY = int(os.environ.get("DISPLAY_THUMBNAIL_QUALITY", "70"))
+
+
+def load_imaging() -> None:
+    """Import OpenCV and numpy ahead of the first image request, e.g. from the gunicorn pre-warm hook."""
+    import cv2  # noqa: F401
+    import numpy  # noqa: F401
+
+
+def decode_grayscale(data: bytes) -> "np.ndarray":
+    """
+    Decode image bytes straight to a grayscale matrix without touching disk.
+
+    Args:
+        data: Encoded image bytes as received in the request
+
+    Returns:
+        The grayscale image
+    """
+    import cv2
+    import numpy as np
+
+    # np.frombuffer trên memoryview không sao chép dữ liệu
+    buffer = np.frombuffer(memoryview(data), dtype=np.uint8)
+    # Giải mã thẳng sang ảnh xám, bỏ qua bản BGR trung gian
+    image = cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError("Không thể giải mã ảnh")
+    return image
+
+
+def optimize_for_display(data: bytes) -> bytes:
+    """
+    Run the display-optimization pipeline (CLAHE) on an upload in memory.
+
+    Args:
+        data: Encoded image bytes as received in the request
+
+    Returns:
+        The optimized image encoded as JPEG
+    """
+    import cv2
+
+    gray = decode_grayscale(data)
+
+    # Tự động điều chỉnh độ sáng và tương phản để tối ưu hiển thị
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    optimized = clahe.apply(gray)
+
+    ok, buffer = cv2.imencode('.jpg', optimized)
+    if not ok:
+        raise ValueError("Không thể mã hóa ảnh đã tối ưu")
+
+    # Trả bytes (không phải memoryview) để kết quả gửi được qua pool tiến trình
+    return buffer.tobytes()
+
+
+def thumbnail_for_display(data: bytes, max_edge: int = DISPLAY_THUMBNAIL_EDGE,
+                          quality: int = DISPLAY_THUMBNAIL_QUALITY) -> bytes:
+    """
+    Build a small CLAHE-optimized JPEG preview of an upload to inline in a JSON reply.
+
+    Args:
+        data: Encoded image bytes as received in the request
+        max_edge: Longest edge of the preview in pixels
+        quality: JPEG quality of the preview
+
+    Returns:
+        The preview encoded as JPEG
+    """
+    import cv2
+
+    gray = decode_grayscale(data)
+    height, width = gray.shape[:2]
+    scale = max_edge / max(height, width)
+    if scale < 1:
+        gray = cv2.resize(gray, (max(int(width * scale), 1), max(int(height * scale), 1)),
+                          interpolation=cv2.INTER_AREA)
+
+    # Cùng bước tăng tương phản như optimize_for_display, nhưng trên ảnh đã thu nhỏ
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    ok, buffer = cv2.imencode('.jpg', clahe.apply(gray), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Không thể mã hóa ảnh thu nhỏ")
+    return buffer.tobytes()
+
+
+def is_text_heavy(image: "np.ndarray") -> bool:
+    """Guess whether a BGR image is a worksheet rather than a photo, from saturation and brightness."""
+    import cv2
+
+    height, width = image.shape[:2]
+    scale = 256 / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (max(int(width * scale), 1), max(int(height * scale), 1)),
+                           interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    mean_saturation = float(hsv[:, :, 1].mean())
+    bright_fraction = float((hsv[:, :, 2] > 160).mean())
+    return mean_saturation < TEXT_MAX_SATURATION and bright_fraction > TEXT_MIN_BRIGHT_FRACTION
+
+
+def fingerprint(image: "np.ndarray") -> ImageFingerprint:
+    """Compute the perceptual hash (DCT pHash) of a decoded BGR image."""
+    import cv2
+    import numpy as np
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    low = cv2.dct(cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32))[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    phash = int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+    height, width = gray.shape[:2]
+    scale = FINGERPRINT_THUMBNAIL_EDGE / max(height, width)
+    if scale < 1:
+        gray = cv2.resize(gray, (max(int(width * scale), 1), max(int(height * scale), 1)),
+                          interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode('.jpg', gray, [cv2.IMWRITE_JPEG_QUALITY, FINGERPRINT_THUMBNAIL_QUALITY])
+    if not ok:
+        raise ValueError("Không thể mã hóa ảnh thu nhỏ")
+    return ImageFingerprint(phash, buffer.tobytes())
+
+
+def match_score(query: bytes, candidate: bytes) -> float:
+    """
+    Check whether two fingerprint thumbnails show the same page, run in the image worker pool.
+
+    Returns:
+        Normalized correlation in [-1, 1] of the aligned edge maps, or -1 when the images cannot be aligned
+    """
+    import cv2
+    import numpy as np
+
+    a = cv2.imdecode(np.frombuffer(query, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    b = cv2.imdecode(np.frombuffer(candidate, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if a is None or b is None:
+        return -1.0
+    orb = cv2.ORB_create(nfeatures=500)
+    points_a, descriptors_a = orb.detectAndCompute(a, None)
+    points_b, descriptors_b = orb.detectAndCompute(b, None)
+    if descriptors_a is None or descriptors_b is None or len(descriptors_a) < 8 or len(descriptors_b) < 8:
+        return -1.0
+    # Lowe ratio test bỏ các cặp điểm mơ hồ
+    pairs = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(descriptors_a, descriptors_b, k=2)
+    good = [m for m, n in (pair for pair in pairs if len(pair) == 2) if m.distance < 0.75 * n.distance]
+    if len(good) < 8:
+        return -1.0
+    source = np.float32([points_a[m.queryIdx].pt for m in good])
+    target = np.float32([points_b[m.trainIdx].pt for m in good])
+    homography, _ = cv2.findHomography(source, target, cv2.RANSAC, 5.0)
+    if homography is None:
+        return -1.0
+
+    warped = cv2.warpPerspective(a, homography, (b.shape[1], b.shape[0]), borderMode=cv2.BORDER_REPLICATE)
+    edges_a = cv2.GaussianBlur(cv2.Canny(warped, 50, 150), (9, 9), 0).astype(np.float32)
+    edges_b = cv2.GaussianBlur(cv2.Canny(b, 50, 150), (9, 9), 0).astype(np.float32)
+    return float(cv2.matchTemplate(edges_a, edges_b, cv2.TM_CCOEFF_NORMED)[0][0])
+
+
+def prepare_for_gemini(data: bytes, sha256: Optional[str] = None,
+                       max_edge: int = GEMINI_IMAGE_MAX_EDGE,
+                       text_quality: int = GEMINI_IMAGE_TEXT_QUALITY,
+                       photo_quality: int = GEMINI_IMAGE_PHOTO_QUALITY,
+                       enabled: bool = GEMINI_IMAGE_PREPARE) -> InlineImage:
+    """
+    Downscale and recompress an image before it is sent to Gemini.
+
+    Args:
+        data: Encoded image bytes as uploaded
+        sha256: Content hash of the original bytes, kept as the cache identity
+        max_edge: Maximum length of the long edge in pixels
+        text_quality: JPEG quality for text-heavy images
+        photo_quality: JPEG quality for photos
+        enabled: When False, the original bytes are sent unchanged
+
+    Returns:
+        The image to send (the original if recompressing does not shrink it),
+        with its real MIME type and perceptual fingerprint
+
+    Raises:
+        ValueError: If the bytes are not a decodable image
+    """
+    original = InlineImage(data, sha256=sha256 or hash_bytes(data))
+    if not enabled:
+        return original
+
+    import cv2
+    import numpy as np
+
+    started = time.perf_counter()
+    image = cv2.imdecode(np.frombuffer(memoryview(data), dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        if original.mime_type != "image/gif":
+            raise ValueError("Không thể giải mã ảnh")
+        # GIF mà bản OpenCV này không đọc được: gửi nguyên bản với đúng MIME
+        logger.debug(f"Cannot decode {original.mime_type} for preparation, sending original")
+        return original
+
+    height, width = image.shape[:2]
+    scale = max_edge / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (max(int(width * scale), 1), max(int(height * scale), 1)),
+                           interpolation=cv2.INTER_AREA)
+
+    # Tính pHash ngay trên ảnh đã giải mã, không giải mã lại lần nữa
+    original.fingerprint = fingerprint(image)
+
+    text_heavy = is_text_heavy(image)
+    if text_heavy:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        quality = text_quality
+    else:
+        quality = photo_quality
+
+    ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if not ok or (scale >= 1 and buffer.size >= len(data)):
+        logger.info(f"Image prepared: kept original {original.mime_type} ({len(data)} bytes, {elapsed_ms:.1f} ms)")
+        return original
+
+    prepared = InlineImage(buffer.tobytes(), "image/jpeg", original.sha256, original.fingerprint)
+    logger.info(f"Image prepared: {original.mime_type} {len(data)} -> image/jpeg {buffer.size} bytes "
+                f"(saved {len(data) - buffer.size} bytes, {'text' if text_heavy else 'photo'}, "
+                f"q={quality}, {elapsed_ms:.1f} ms)")
+    return prepared
@@ -0,0 +1,105 @@
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import Callable, Dict, Any
+
+logger = logging.getLogger(__name__)
+
+# Số tiến trình xử lý ảnh cho mỗi worker gunicorn; 0 = chạy ngay trên thread của request
+IMAGE_POOL_SIZE = int(os.environ.get("IMAGE_POOL_SIZE", str(min(2, os.cpu_count() or 1))))
+# spawn an toàn hơn fork khi tiến trình cha đang có nhiều thread
+IMAGE_POOL_START_METHOD = os.environ.get("IMAGE_POOL_START_METHOD", "spawn")
+
+
+def _gevent_patched() -> bool:
+    """Return True when gevent has monkey-patched threading (gunicorn gevent worker)."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+class ImageWorkerPool:
+    """
+    Bounded pool for CPU-heavy OpenCV steps, created lazily per worker process.
+
+    Uses processes normally and real threads under gevent workers.
+    """
+
+    def __init__(self, size: int = IMAGE_POOL_SIZE, start_method: str = IMAGE_POOL_START_METHOD):
+        self.size = size
+        self.start_method = start_method
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0, "pending": 0}
+
+    def _get_executor(self) -> Executor:
+        pid = os.getpid()
+        if self._executor is None or self._pid != pid:
+            with self._lock:
+                if self._executor is None or self._pid != pid:
+                    if _gevent_patched():
+                        # Thread nội bộ của ProcessPoolExecutor thành greenlet và ghi pipe kiểu chặn,
+                        # có thể treo cả worker; OpenCV nhả GIL nên thread thật của gevent vẫn song song
+                        from gevent.threadpool import ThreadPoolExecutor
+                        self._executor = ThreadPoolExecutor(max_workers=self.size)
+                    else:
+                        context = multiprocessing.get_context(self.start_method)
+                        self._executor = ProcessPoolExecutor(max_workers=self.size, mp_context=context)
+                    self._pid = pid
+        return self._executor
+
+    def _on_done(self, future: Future) -> None:
+        with self._lock:
+            self._counters["pending"] -= 1
+            if future.cancelled() or future.exception() is not None:
+                self._counters["failed"] += 1
+            else:
+                self._counters["completed"] += 1
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Run fn(*args, **kwargs) in the pool, or inline when the pool size is 0.
+
+        Returns:
+            A future for the result
+        """
+        with self._lock:
+            self._counters["submitted"] += 1
+            self._counters["pending"] += 1
+
+        if self.size <= 0:
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            future = self._get_executor().submit(fn, *args, **kwargs)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def warm(self, fn: Callable) -> None:
+        """Start the pool and run fn once in each worker, e.g. to import OpenCV."""
+        fn()
+        if self.size > 0:
+            futures = [self._get_executor().submit(fn) for _ in range(self.size)]
+            for future in futures:
+                future.result()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return pool size and queue depth of this worker."""
+        with self._lock:
+            result = dict(self._counters)
+        result["pool_size"] = self.size
+        # Số việc đang chờ vượt quá số tiến trình chính là độ sâu hàng đợi
+        result["queue_depth"] = max(result["pending"] - self.size, 0)
+        return result
+
+
+# Pool dùng chung cho cả module
+image_workers = ImageWorkerPool()
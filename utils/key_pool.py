@@ -0,0 +1,181 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import deque
+from typing import Optional, Dict, Any, List
+
+logger = logging.getLogger(__name__)
+
+# Danh sách API key cách nhau bởi dấu phẩy, dùng cùng GOOGLE_AI_API_KEY
+GOOGLE_AI_API_KEYS = os.environ.get("GOOGLE_AI_API_KEYS", "")
+# Thời gian cách ly key khi hết hạn mức (429) nếu Gemini không gửi Retry-After
+GEMINI_KEY_QUOTA_QUARANTINE = float(os.environ.get("GEMINI_KEY_QUOTA_QUARANTINE", "60"))
+# Key bị từ chối quyền (403) thường không tự hết lỗi nên cách ly lâu hơn
+GEMINI_KEY_DENIED_QUARANTINE = float(os.environ.get("GEMINI_KEY_DENIED_QUARANTINE", "600"))
+# Số kết quả gần nhất dùng để tính tỉ lệ lỗi của mỗi key
+KEY_STATS_WINDOW = 50
+
+
+def key_fingerprint(key: str) -> str:
+    """Short, non-reversible id of an API key, safe for logs and stats."""
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:8]
+
+
+def configured_keys() -> List[str]:
+    """Keys from GOOGLE_AI_API_KEYS and GOOGLE_AI_API_KEY, without duplicates."""
+    keys = [key.strip() for key in GOOGLE_AI_API_KEYS.split(",") if key.strip()]
+    single = os.environ.get("GOOGLE_AI_API_KEY", "").strip()
+    if single:
+        keys.append(single)
+    return list(dict.fromkeys(keys))
+
+
+class KeyPoolExhausted(Exception):
+    """Raised when every key is quarantined; retry_after is the time until the first one returns."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"All API keys are quarantined for another {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class _KeyState:
+    def __init__(self, key: str):
+        self.key = key
+        self.fingerprint = key_fingerprint(key)
+        self.in_flight = 0
+        self.outcomes = deque(maxlen=KEY_STATS_WINDOW)
+        self.latency = None
+        self.quarantined_until = 0.0
+        self.requests = 0
+        self.rate_limited = 0
+
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+
+class KeyLease:
+    """One call's use of a key; report the outcome with ``release``."""
+
+    def __init__(self, pool: "KeyPool", state: _KeyState):
+        self._pool = pool
+        self._state = state
+        self._started = time.monotonic()
+        self._released = False
+        self.key = state.key
+        self.fingerprint = state.fingerprint
+
+    def release(self, status_code: Optional[int] = None, retry_after: Optional[float] = None) -> None:
+        """
+        Return the key to the pool.
+
+        Args:
+            status_code: HTTP status of the call, or None for a transport error
+            retry_after: Seconds from the Retry-After header of a 429, if any
+        """
+        if not self._released:
+            self._released = True
+            self._pool._release(self._state, status_code, retry_after, time.monotonic() - self._started)
+
+
+class KeyPool:
+    """
+    Pool of Gemini API keys that sends each call to the least loaded healthy key.
+
+    Keys that return 429 or 403 are quarantined for a while; keys are only logged by fingerprint.
+    """
+
+    def __init__(self, keys: Optional[List[str]] = None):
+        self._lock = threading.Lock()
+        self._states: Dict[str, _KeyState] = {}
+        for key in keys if keys is not None else configured_keys():
+            self._state_for(key)
+        self.configured = len(self._states)
+
+    def _state_for(self, key: str) -> _KeyState:
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _KeyState(key)
+        return state
+
+    def acquire(self, fallback_key: Optional[str] = None) -> KeyLease:
+        """
+        Pick the least-loaded healthy key.
+
+        Args:
+            fallback_key: Key to use when no keys are configured (e.g. one entered on /api_key)
+
+        Returns:
+            A lease that must be released with the call's outcome
+
+        Raises:
+            KeyPoolExhausted: If every key is quarantined
+            ValueError: If there is no key at all
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.configured:
+                candidates = list(self._states.values())
+            elif fallback_key:
+                candidates = [self._state_for(fallback_key)]
+            else:
+                raise ValueError("No API key configured")
+
+            healthy = [state for state in candidates if state.quarantined_until <= now]
+            if not healthy:
+                raise KeyPoolExhausted(min(state.quarantined_until for state in candidates) - now)
+
+            state = min(healthy, key=lambda s: (s.in_flight, round(s.error_rate(), 1), s.latency or 0.0))
+            state.in_flight += 1
+            state.requests += 1
+        return KeyLease(self, state)
+
+    def has_healthy(self, exclude: Optional[str] = None) -> bool:
+        """True if some key other than exclude is not quarantined, i.e. a retry can go elsewhere now."""
+        now = time.monotonic()
+        with self._lock:
+            return any(state.quarantined_until <= now and state.key != exclude for state in self._states.values())
+
+    def _release(self, state: _KeyState, status_code: Optional[int], retry_after: Optional[float],
+                 elapsed: float) -> None:
+        with self._lock:
+            state.in_flight -= 1
+            ok = status_code is not None and status_code < 500 and status_code not in (429, 403)
+            state.outcomes.append(ok)
+            if status_code == 200:
+                state.latency = elapsed if state.latency is None else 0.8 * state.latency + 0.2 * elapsed
+            if status_code == 429:
+                state.rate_limited += 1
+                now = time.monotonic()
+                # Key khỏe cuối cùng không bị cách ly: một lần 429 không được chặn mọi lời gọi trong cả
+                # phút, lần thử lại tự chờ theo Retry-After trong vòng thử lại
+                if not any(other is not state and other.quarantined_until <= now for other in self._states.values()):
+                    logger.warning(f"API key {state.fingerprint} hit its quota; last healthy key, not quarantined")
+                    return
+                window = retry_after if retry_after is not None else GEMINI_KEY_QUOTA_QUARANTINE
+                state.quarantined_until = now + window
+                logger.warning(f"API key {state.fingerprint} hit its quota, quarantined for {window:.0f}s")
+            elif status_code == 403:
+                state.quarantined_until = time.monotonic() + GEMINI_KEY_DENIED_QUARANTINE
+                logger.warning(f"API key {state.fingerprint} was denied, quarantined for "
+                               f"{GEMINI_KEY_DENIED_QUARANTINE:.0f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-key load and health, identified by fingerprint only."""
+        now = time.monotonic()
+        with self._lock:
+            keys = [{
+                "key": state.fingerprint,
+                "in_flight": state.in_flight,
+                "requests": state.requests,
+                "rate_limited": state.rate_limited,
+                "error_rate": round(state.error_rate(), 3),
+                "latency_ms": round(state.latency * 1000, 1) if state.latency is not None else None,
+                "quarantined_for_s": round(max(state.quarantined_until - now, 0.0), 1),
+            } for state in self._states.values()]
+        return {"configured": self.configured, "keys": keys}
+
+
+# Nhóm key dùng chung cho cả module, mỗi worker gunicorn có một bản riêng
+key_pool = KeyPool()
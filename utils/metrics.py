@@ -0,0 +1,151 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Callable, Iterable, Iterator, List, Tuple
+
+# Mốc histogram (giây): từ thao tác bộ nhớ vài ms tới lời gọi Gemini vài chục giây
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PHASE_METRIC = "app_phase_duration_seconds"
+REQUEST_METRIC = "app_request_duration_seconds"
+STATS_METRIC = "app_stats"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense; not thread-safe on its own."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        # Mốc đầu tiên >= value, khớp với ngữ nghĩa le (<=) của Prometheus
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _flatten_stats(stats: Dict[str, Any], prefix: str = "") -> Iterator[Tuple[Dict[str, str], float]]:
+    """Yield ({"stat": ..., "item": ...}, value) for every number in a stats() dict; text values are skipped."""
+    for name, value in stats.items():
+        stat = f"{prefix}{name}"
+        if isinstance(value, bool):
+            yield {"stat": stat}, int(value)
+        elif isinstance(value, (int, float)):
+            yield {"stat": stat}, value
+        elif isinstance(value, dict):
+            yield from _flatten_stats(value, f"{stat}_")
+        elif isinstance(value, list):
+            # Danh sách mục (vd. từng API key) được phân biệt bằng trường "key" hoặc vị trí
+            for index, item in enumerate(value):
+                if isinstance(item, dict):
+                    label = str(item.get("key", index))
+                    for labels, number in _flatten_stats({k: v for k, v in item.items() if k != "key"},
+                                                         f"{stat}_"):
+                        yield dict(labels, item=label), number
+
+
+class Metrics:
+    """Per-worker request phase timings and gauges in Prometheus format."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._help: Dict[str, str] = {
+            PHASE_METRIC: "Time spent in each phase of request handling",
+            REQUEST_METRIC: "Time from request start until the response (or first stream chunk) is returned",
+        }
+        self._gauges: List[Tuple[str, str, Callable[[], Iterable[Tuple[Dict[str, str], float]]]]] = []
+        self._stats: List[Tuple[str, Callable[[], Dict[str, Any]]]] = []
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def span(self, route: str, phase: str):
+        """Time the block as one phase of route, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(PHASE_METRIC, time.perf_counter() - started, route=route, phase=phase)
+
+    def register_gauge(self, name: str, help_text: str,
+                       collect: Callable[[], Iterable[Tuple[Dict[str, str], float]]]) -> None:
+        """
+        Expose a gauge whose samples are read at render time.
+
+        Args:
+            name: Metric name
+            help_text: HELP line
+            collect: Returns (labels, value) pairs
+        """
+        self._gauges.append((name, help_text, collect))
+
+    def register_stats(self, module: str, stats: Callable[[], Dict[str, Any]]) -> None:
+        """
+        Expose every number of a module's stats() dict as app_stats{module,stat} at render time.
+
+        Args:
+            module: Value of the module label
+            stats: Returns the module's counters, e.g. response_cache.stats
+        """
+        self._stats.append((module, stats))
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        with self._lock:
+            snapshot = {name: {labels: (list(h.counts), h.sum, h.count) for labels, h in series.items()}
+                        for name, series in self._histograms.items()}
+        for name, series in sorted(snapshot.items()):
+            lines.append(f"# HELP {name} {self._help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, (counts, total, count) in sorted(series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    bucket_labels = _format_labels(labels, 'le="%s"' % bound)
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                inf_labels = _format_labels(labels, 'le="+Inf"')
+                lines.append(f"{name}_bucket{inf_labels} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+        for name, help_text, collect in self._gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in collect():
+                lines.append(f"{name}{_format_labels(tuple(sorted(labels.items())))} {value}")
+
+        if self._stats:
+            lines.append(f"# HELP {STATS_METRIC} Counters and settings reported by each module's stats()")
+            lines.append(f"# TYPE {STATS_METRIC} gauge")
+            for module, stats in self._stats:
+                for labels, value in _flatten_stats(stats()):
+                    labels = tuple(sorted(dict(labels, module=module).items()))
+                    lines.append(f"{STATS_METRIC}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# Số đo dùng chung cho cả module, mỗi worker gunicorn có một bản riêng
+metrics = Metrics()
@@ -0,0 +1,301 @@
+import os
+import re
+import time
+import random
+import struct
+import hashlib
+import logging
+import sqlite3
+import threading
+import unicodedata
+from collections import deque
+from typing import Optional, Dict, Any, List, Tuple, FrozenSet
+
+from utils.sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+# Chỉ mục câu hỏi gần giống nhau (MinHash/LSH) - có thể ghi đè bằng biến môi trường
+# Bật mặc định; chỉ dùng lại câu trả lời khi hai câu hỏi chỉ khác nhau ở các từ trung tính bên dưới
+NEAR_DUP_ENABLED = os.environ.get("NEAR_DUP_ENABLED", "1") == "1"
+NEAR_DUP_PATH = os.environ.get("NEAR_DUP_PATH", os.path.join("instance", "near_duplicates.db"))
+# Độ giống Jaccard (0-1) tối thiểu giữa hai câu hỏi đã chuẩn hóa để dùng lại câu trả lời
+NEAR_DUP_THRESHOLD = float(os.environ.get("NEAR_DUP_THRESHOLD", "0.95"))
+# bands x rows = số hàm băm MinHash; 16 x 4 đưa hầu hết cặp có Jaccard >= 0.7 vào cùng bucket
+NEAR_DUP_BANDS = int(os.environ.get("NEAR_DUP_BANDS", "16"))
+NEAR_DUP_ROWS = int(os.environ.get("NEAR_DUP_ROWS", "4"))
+# Độ dài shingle (ký tự) và độ dài tối thiểu của câu hỏi; câu ngắn hơn chỉ dùng cache khớp chính xác
+NEAR_DUP_SHINGLE = int(os.environ.get("NEAR_DUP_SHINGLE", "5"))
+NEAR_DUP_MIN_CHARS = int(os.environ.get("NEAR_DUP_MIN_CHARS", "20"))
+NEAR_DUP_MAX_ENTRIES = int(os.environ.get("NEAR_DUP_MAX_ENTRIES", "300000"))
+
+# Số nguyên tố Mersenne 2^61 - 1 cho họ hàm băm (a*x + b) mod p
+_PRIME = (1 << 61) - 1
+
+# Câu nhờ vả không đổi nội dung bài. "ạ" bị bỏ trước khi bỏ dấu (sau đó nó trùng với biến "a"),
+# các cụm còn lại so khớp trên chữ đã bỏ dấu để bắt cả câu gõ không dấu
+_TONED_FILLER = re.compile(r"\b(?:với\s+)?ạ\b")
+_FILLER = re.compile(r"\b(?:giai giup|giai ho|giup|ho|cho)\s+(?:em|minh|toi)(?:\s+(?:hoi|voi|nhe|nha|nhanh))*\b"
+                     r"|\b(?:em\s+|minh\s+)?(?:xin\s+)?cam on(?:\s+(?:nhieu|nhe))*\b"
+                     r"|\b(?:nhe|nha)\b")
+# Từ được phép có/không giữa hai câu hỏi khớp nhau (đã bỏ dấu); mọi từ khác phải trùng,
+# vì một từ khác như "it hon"/"nhieu hon" đã đủ đổi đáp án dù Jaccard vẫn cao.
+# Chỉ giữ từ mà mọi cách thêm dấu đều không mang nghĩa trong đề toán ("hay"/"hãy", "giúp");
+# "sau" có thể là "sáu", "a" là tên biến, "cau" có thể là "cầu", "voi"/"oi" có thể là con vật/quả
+_WORD = re.compile(r"\d+(?:\.\d+)?|\w+|[^\w\s]")
+_NEUTRAL_WORDS = frozenset(["hay", "giup"])
+# "2.000.000" là cách viết số nghìn kiểu Việt Nam, "1,5" là số thập phân
+_NUMBER = re.compile(r"\d{1,3}(?:\.\d{3})+(?![\d,])|\d+(?:[.,]\d+)?")
+# Giữ lại toán tử và dấu ngoặc vì chúng đổi nghĩa bài toán; bỏ dấu câu, trừ dấu thập phân
+_PUNCTUATION = re.compile(r"(?<!\d)\.|\.(?!\d)|[,?!;:\"'“”‘’…`]")
+
+
+def _canonical_number(match: "re.Match") -> str:
+    # Bỏ dấu chấm phân cách nghìn, dấu phẩy thập phân -> dấu chấm; bỏ số 0 thừa ở đầu và ở cuối
+    number = match.group(0)
+    if number.count(".") > 1 or (number.count(".") == 1 and "," not in number
+                                 and len(number.partition(".")[2]) == 3):
+        number = number.replace(".", "")
+    integer, _, fraction = number.replace(",", ".").partition(".")
+    integer = integer.lstrip("0") or "0"
+    fraction = fraction.rstrip("0")
+    return f"{integer}.{fraction}" if fraction else integer
+
+
+def _fold_tones(text: str) -> str:
+    """Strip Vietnamese tone and vowel marks: "giải phương trình" -> "giai phuong trinh"."""
+    decomposed = unicodedata.normalize("NFD", text.replace("đ", "d").replace("Đ", "D"))
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def normalize_question(text: str) -> str:
+    """
+    Normalize a question for near-duplicate matching.
+
+    NFC, lowercase, drop filler phrases ("giải giúp em", "ạ", ...), fold
+    tone marks, canonicalize numbers ("1,50" -> "1.5") and drop punctuation
+    other than math operators, then collapse whitespace.
+    """
+    text = unicodedata.normalize("NFC", text or "").lower()
+    text = _TONED_FILLER.sub(" ", text)
+    text = _fold_tones(text)
+    text = _FILLER.sub(" ", text)
+    text = _NUMBER.sub(_canonical_number, text)
+    text = _PUNCTUATION.sub(" ", text)
+    return " ".join(text.split())
+
+
+def _numbers(normalized: str) -> str:
+    # Hai đề chỉ khác nhau một con số là hai bài khác nhau, dù gần giống về chữ
+    return " ".join(_NUMBER.findall(normalized))
+
+
+def _shingles(normalized: str, size: int) -> FrozenSet[str]:
+    # Bỏ khoảng trắng để "1+1" và "1 + 1" cho cùng shingle
+    compact = normalized.replace(" ", "")
+    if len(compact) <= size:
+        return frozenset([compact])
+    return frozenset(compact[i:i + size] for i in range(len(compact) - size + 1))
+
+
+def _hash64(value: bytes) -> int:
+    return struct.unpack("<Q", hashlib.blake2b(value, digest_size=8).digest())[0]
+
+
+def _words(normalized: str) -> FrozenSet[str]:
+    # Toán tử là từ riêng để "x^2-5x" và "x^2 - 5x" cho cùng tập từ
+    return frozenset(_WORD.findall(normalized))
+
+
+def _same_words(a: str, b: str) -> bool:
+    # Hai câu đã chuẩn hóa chỉ được khác nhau ở từ đệm trong _NEUTRAL_WORDS
+    return (_words(a) ^ _words(b)) <= _NEUTRAL_WORDS
+
+
+def _jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS questions (
+        id INTEGER PRIMARY KEY,
+        normalized TEXT NOT NULL,
+        numbers TEXT NOT NULL,
+        cache_key TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS buckets (
+        bucket INTEGER NOT NULL,
+        question_id INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_buckets_bucket ON buckets (bucket)",
+    "CREATE INDEX IF NOT EXISTS idx_buckets_question ON buckets (question_id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_questions_cache_key ON questions (cache_key)",
+)
+
+
+class NearDuplicateIndex:
+    """
+    MinHash/LSH index of answered questions, stored in SQLite shared by all workers.
+
+    Candidates must also pass exact Jaccard and have the same numbers and words.
+    Only cache keys are stored; answers stay in the response cache.
+    """
+
+    def __init__(self, path: str = NEAR_DUP_PATH, threshold: float = NEAR_DUP_THRESHOLD,
+                 bands: int = NEAR_DUP_BANDS, rows: int = NEAR_DUP_ROWS, shingle: int = NEAR_DUP_SHINGLE,
+                 min_chars: int = NEAR_DUP_MIN_CHARS, max_entries: int = NEAR_DUP_MAX_ENTRIES,
+                 enabled: bool = NEAR_DUP_ENABLED):
+        self.path = path
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self.shingle = shingle
+        self.min_chars = min_chars
+        self.max_entries = max_entries
+        self.enabled = enabled
+        # Hệ số cố định để mọi tiến trình tính ra cùng chữ ký
+        rng = random.Random(20240601)
+        self._permutations = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(bands * rows)]
+        self._db = SqliteStore(path, _SCHEMA)
+        self._lock = threading.Lock()
+        self._counters = {"lookups": 0, "hits": 0, "misses": 0, "skipped": 0, "stale": 0, "added": 0}
+        self._latencies_ms = deque(maxlen=1000)
+
+    def _signature(self, shingles: FrozenSet[str]) -> List[int]:
+        hashes = [_hash64(s.encode("utf-8")) for s in shingles]
+        return [min((a * x + b) % _PRIME for x in hashes) for a, b in self._permutations]
+
+    def _buckets(self, scope: str, signature: List[int]) -> List[int]:
+        # Mỗi band -> một số nguyên 63 bit có dấu (kiểu INTEGER của SQLite); scope nằm trong khóa
+        buckets = []
+        for band in range(self.bands):
+            values = signature[band * self.rows:(band + 1) * self.rows]
+            raw = f"{scope}|{band}|{','.join(map(str, values))}".encode("utf-8")
+            buckets.append(_hash64(raw) - (1 << 63))
+        return buckets
+
+    def _prepare(self, prompt: str) -> Optional[Tuple[str, FrozenSet[str]]]:
+        normalized = normalize_question(prompt)
+        if len(normalized) < self.min_chars:
+            return None
+        return normalized, _shingles(normalized, self.shingle)
+
+    @staticmethod
+    def scope(mode: str, solution_mode: str, subject: str) -> str:
+        """Questions only match others asked with the same mode, solution mode and subject."""
+        return f"{mode}|{solution_mode}|{subject}"
+
+    def lookup(self, prompt: str, scope: str) -> Optional[str]:
+        """
+        Find an earlier question similar enough to prompt.
+
+        Args:
+            prompt: The user's message/query
+            scope: Value of scope() for the request
+
+        Returns:
+            The response cache key of the most similar stored question, or
+            None if no stored question reaches the threshold
+        """
+        if not self.enabled:
+            return None
+        started = time.perf_counter()
+        prepared = self._prepare(prompt)
+        if prepared is None:
+            self._count("skipped")
+            return None
+        normalized, shingles = prepared
+        numbers = _numbers(normalized)
+        best_key, best_score = None, self.threshold
+        try:
+            buckets = self._buckets(scope, self._signature(shingles))
+            rows = self._db.connect().execute(
+                "SELECT normalized, cache_key FROM questions WHERE numbers = ? AND id IN "
+                f"(SELECT question_id FROM buckets WHERE bucket IN ({','.join('?' * len(buckets))}))",
+                [numbers] + buckets).fetchall()
+            for candidate, cache_key in rows:
+                if not _same_words(normalized, candidate):
+                    continue
+                score = _jaccard(shingles, _shingles(candidate, self.shingle))
+                if score >= best_score:
+                    best_key, best_score = cache_key, score
+        except sqlite3.Error as e:
+            logger.warning(f"Near-duplicate lookup failed: {e}")
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._counters["lookups"] += 1
+            self._counters["hits" if best_key else "misses"] += 1
+            self._latencies_ms.append(elapsed)
+        return best_key
+
+    def add(self, prompt: str, scope: str, cache_key: str) -> None:
+        """Index prompt so later rewordings of it resolve to cache_key."""
+        if not self.enabled:
+            return
+        prepared = self._prepare(prompt)
+        if prepared is None:
+            return
+        normalized, shingles = prepared
+        buckets = self._buckets(scope, self._signature(shingles))
+        try:
+            conn = self._db.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO questions (normalized, numbers, cache_key, created_at) "
+                    "VALUES (?, ?, ?, ?)", (normalized, _numbers(normalized), cache_key, time.time()))
+                question_id = cursor.lastrowid
+                # Cùng khóa cache đã có trong chỉ mục thì không thêm bucket nữa
+                if cursor.rowcount == 1:
+                    conn.executemany("INSERT INTO buckets (bucket, question_id) VALUES (?, ?)",
+                                     [(bucket, question_id) for bucket in buckets])
+                    # Xóa câu cũ nhất khi vượt giới hạn; id tăng dần theo thời gian thêm
+                    overflow_below = question_id - self.max_entries
+                    if overflow_below > 0:
+                        conn.execute("DELETE FROM buckets WHERE question_id <= ?", (overflow_below,))
+                        conn.execute("DELETE FROM questions WHERE id <= ?", (overflow_below,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            self._count("added")
+        except sqlite3.Error as e:
+            logger.warning(f"Near-duplicate index write failed: {e}")
+
+    def forget(self, cache_key: str) -> None:
+        """Drop the entry pointing at cache_key, used when its answer left the response cache."""
+        self._count("stale")
+        try:
+            conn = self._db.connect()
+            conn.execute("DELETE FROM buckets WHERE question_id IN (SELECT id FROM questions WHERE cache_key = ?)",
+                         (cache_key,))
+            conn.execute("DELETE FROM questions WHERE cache_key = ?", (cache_key,))
+        except sqlite3.Error as e:
+            logger.warning(f"Near-duplicate index delete failed: {e}")
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit rate and lookup latency in this worker, and the size of the shared index."""
+        with self._lock:
+            result = dict(self._counters)
+            latencies = sorted(self._latencies_ms)
+        result["hit_rate"] = round(result["hits"] / result["lookups"], 4) if result["lookups"] else 0.0
+        result["lookup_ms_avg"] = round(sum(latencies) / len(latencies), 2) if latencies else 0.0
+        result["lookup_ms_p95"] = round(latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)], 2) \
+            if latencies else 0.0
+        result.update({"enabled": self.enabled, "threshold": self.threshold, "bands": self.bands,
+                       "rows": self.rows, "entries": 0, "max_entries": self.max_entries})
+        if self.enabled:
+            try:
+                result["entries"] = self._db.connect().execute("SELECT COUNT(*) FROM questions").fetchone()[0]
+            except sqlite3.Error as e:
+                logger.warning(f"Near-duplicate stats failed: {e}")
+        return result
+
+
+# Chỉ mục dùng chung cho cả module
+near_duplicates = NearDuplicateIndex()
@@ -0,0 +1,185 @@
+import os
+import time
+import shutil
+import logging
+import threading
+from typing import Optional, Dict, Any
+from utils.image_pipeline import is_text_heavy
+
+logger = logging.getLogger(__name__)
+
+# Nhận dạng chữ tại chỗ trước khi gửi ảnh cho Gemini - có thể ghi đè bằng biến môi trường
+# "auto" = bật khi máy có lệnh tesseract; "1"/"0" bật/tắt hẳn
+OCR_ENABLED = os.environ.get("OCR_ENABLED", "auto")
+# Giới hạn cứng (giây) cho một lần chạy Tesseract và cho request chờ kết quả OCR
+OCR_TIMEOUT = float(os.environ.get("OCR_TIMEOUT", "5"))
+OCR_LANG = os.environ.get("OCR_LANG", "vie")
+# Độ tin cậy trung bình (0-100) tối thiểu để gửi chữ thay cho ảnh
+OCR_MIN_CONFIDENCE = float(os.environ.get("OCR_MIN_CONFIDENCE", "85"))
+# Quá ít chữ thì nhiều khả năng ảnh là hình vẽ/đồ thị, gửi ảnh an toàn hơn
+OCR_MIN_CHARS = int(os.environ.get("OCR_MIN_CHARS", "20"))
+# Tesseract đọc tốt nhất khi chữ cao khoảng 30px; ảnh lớn hơn chỉ làm chậm
+OCR_MAX_EDGE = int(os.environ.get("OCR_MAX_EDGE", "2000"))
+OCR_TESSERACT_CMD = os.environ.get("OCR_TESSERACT_CMD", "tesseract")
+
+# Thiếu tesseract hoặc gói ngôn ngữ thì tiến trình này bỏ qua OCR từ đó về sau
+_tesseract_unavailable = False
+
+
+class OcrResult:
+    """Text recognized in an upload, with Tesseract's mean word confidence (0-100)."""
+
+    def __init__(self, text: str, confidence: float, words: int, elapsed_ms: float):
+        self.text = text
+        self.confidence = confidence
+        self.words = words
+        self.elapsed_ms = elapsed_ms
+
+
+def tesseract_installed() -> bool:
+    """Return True if the tesseract command can be found."""
+    return shutil.which(OCR_TESSERACT_CMD) is not None
+
+
+def binarize_for_ocr(data: bytes, max_edge: int = OCR_MAX_EDGE) -> Optional["np.ndarray"]:
+    """
+    Decode, downscale and binarize an upload for Tesseract, run in the image worker pool.
+
+    Returns:
+        The black-and-white image, or None for photos and undecodable images
+    """
+    # Nạp thư viện ảnh khi dùng lần đầu, request chỉ có chữ không phải chờ import
+    import cv2
+    import numpy as np
+
+    image = cv2.imdecode(np.frombuffer(memoryview(data), dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None or not is_text_heavy(image):
+        return None
+
+    height, width = image.shape[:2]
+    scale = max_edge / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (max(int(width * scale), 1), max(int(height * scale), 1)),
+                           interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # Nhị phân hóa Otsu giúp Tesseract tách chữ khỏi nền giấy không đều
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return binary
+
+
+def recognize_text(binary: "np.ndarray", lang: str = OCR_LANG, timeout: float = OCR_TIMEOUT) -> Optional[OcrResult]:
+    """
+    Run Tesseract on an image from binarize_for_ocr() in the calling request.
+
+    Under gevent workers subprocess is monkey-patched, so waiting on tesseract
+    yields to other greenlets instead of blocking the worker.
+
+    Returns:
+        The recognized text, or None when Tesseract or the language pack is
+        not installed, or it timed out
+    """
+    global _tesseract_unavailable
+    if _tesseract_unavailable:
+        return None
+    import pytesseract
+
+    started = time.perf_counter()
+    pytesseract.pytesseract.tesseract_cmd = OCR_TESSERACT_CMD
+    try:
+        ocr = pytesseract.image_to_data(binary, lang=lang, output_type=pytesseract.Output.DICT,
+                                        timeout=timeout)
+    except pytesseract.TesseractNotFoundError as e:
+        _tesseract_unavailable = True
+        logger.warning(f"Tesseract OCR unavailable, sending images to Gemini: {e}")
+        return None
+    except pytesseract.TesseractError as e:
+        if "Failed loading language" in str(e):
+            _tesseract_unavailable = True
+        logger.warning(f"Tesseract OCR failed, sending image to Gemini: {e}")
+        return None
+    except RuntimeError as e:
+        # pytesseract báo hết thời gian bằng RuntimeError sau khi đã kill tesseract
+        logger.warning(f"Tesseract OCR timed out, sending image to Gemini: {e}")
+        return None
+
+    # Ghép lại theo dòng như trong ảnh; độ tin cậy tính theo số ký tự của mỗi từ
+    lines: Dict[tuple, list] = {}
+    weighted, chars = 0.0, 0
+    for i, word in enumerate(ocr["text"]):
+        word = word.strip()
+        confidence = float(ocr["conf"][i])
+        if not word or confidence < 0:
+            continue
+        line = (ocr["block_num"][i], ocr["par_num"][i], ocr["line_num"][i])
+        lines.setdefault(line, []).append(word)
+        weighted += confidence * len(word)
+        chars += len(word)
+
+    text = "\n".join(" ".join(words) for _, words in sorted(lines.items()))
+    confidence = weighted / chars if chars else 0.0
+    words = sum(len(words) for words in lines.values())
+    return OcrResult(text, confidence, words, (time.perf_counter() - started) * 1000)
+
+
+def extract_text(data: bytes, lang: str = OCR_LANG, max_edge: int = OCR_MAX_EDGE,
+                 timeout: float = OCR_TIMEOUT) -> Optional[OcrResult]:
+    """Recognize the text of a printed exercise in one call; None for photos."""
+    binary = binarize_for_ocr(data, max_edge)
+    return recognize_text(binary, lang, timeout) if binary is not None else None
+
+
+def ocr_prompt(text: str) -> str:
+    """Text-only prompt sent to Gemini in place of the uploaded image."""
+    return ("Đây là nội dung bài tập học sinh chụp, đã được nhận dạng chữ từ ảnh:\n\n"
+            f"{text}\n\n"
+            "Hãy trả lời câu hỏi trong nội dung trên. Nếu nội dung bị lỗi nhận dạng, hãy thông báo.")
+
+
+class OcrGate:
+    """Decide whether an upload is sent to Gemini as recognized text or as the image."""
+
+    def __init__(self, enabled: Optional[bool] = None if OCR_ENABLED == "auto" else OCR_ENABLED != "0",
+                 min_confidence: float = OCR_MIN_CONFIDENCE, min_chars: int = OCR_MIN_CHARS):
+        self._enabled = enabled
+        self.min_confidence = min_confidence
+        self.min_chars = min_chars
+        self._lock = threading.Lock()
+        self._counters = {"text_path": 0, "image_path": 0, "skipped": 0, "low_confidence": 0}
+        self._ocr_ms_total = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether uploads run OCR; None at construction means on when tesseract is installed."""
+        if self._enabled is None:
+            self._enabled = tesseract_installed()
+        return self._enabled and not _tesseract_unavailable
+
+    def accept(self, result: Optional[OcrResult]) -> bool:
+        """Return True if result is good enough to replace the image with its text."""
+        with self._lock:
+            if result is None:
+                self._counters["skipped"] += 1
+                self._counters["image_path"] += 1
+                return False
+            self._ocr_ms_total += result.elapsed_ms
+            if len(result.text) < self.min_chars or result.confidence < self.min_confidence:
+                self._counters["low_confidence"] += 1
+                self._counters["image_path"] += 1
+                return False
+            self._counters["text_path"] += 1
+            return True
+
+    def stats(self) -> Dict[str, Any]:
+        """Return how often uploads took the text path in this worker."""
+        with self._lock:
+            result = dict(self._counters)
+            recognized = result["text_path"] + result["low_confidence"]
+            result["ocr_ms_avg"] = round(self._ocr_ms_total / recognized, 1) if recognized else 0.0
+        result.update({"enabled": self.enabled, "min_confidence": self.min_confidence,
+                       "min_chars": self.min_chars, "lang": OCR_LANG,
+                       "timeout": OCR_TIMEOUT})
+        return result
+
+
+# Bộ chọn đường OCR dùng chung cho cả module, mỗi worker gunicorn có một bản riêng
+ocr_gate = OcrGate()
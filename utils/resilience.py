@@ -0,0 +1,231 @@
+import os
+import time
+import queue
+import random
+import logging
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Any, Callable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Thử lại khi Gemini lỗi tạm thời - có thể ghi đè bằng biến môi trường
+GEMINI_RETRY_ATTEMPTS = int(os.environ.get("GEMINI_RETRY_ATTEMPTS", "3"))
+GEMINI_RETRY_BASE_DELAY = float(os.environ.get("GEMINI_RETRY_BASE_DELAY", "0.5"))
+GEMINI_RETRY_MAX_DELAY = float(os.environ.get("GEMINI_RETRY_MAX_DELAY", "8"))
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Gửi thêm một request dự phòng khi request đầu chậm hơn phân vị độ trễ này
+GEMINI_HEDGE_ENABLED = os.environ.get("GEMINI_HEDGE_ENABLED", "0") != "0"
+GEMINI_HEDGE_PERCENTILE = float(os.environ.get("GEMINI_HEDGE_PERCENTILE", "0.95"))
+GEMINI_HEDGE_MIN_DELAY = float(os.environ.get("GEMINI_HEDGE_MIN_DELAY", "0.5"))
+# Chưa đủ mẫu để tính phân vị thì dùng độ trễ cố định này
+GEMINI_HEDGE_DEFAULT_DELAY = float(os.environ.get("GEMINI_HEDGE_DEFAULT_DELAY", "5"))
+GEMINI_HEDGE_MIN_SAMPLES = 20
+
+# Ngắt mạch khi Gemini lỗi liên tiếp
+GEMINI_BREAKER_THRESHOLD = int(os.environ.get("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_RESET_TIMEOUT = float(os.environ.get("GEMINI_BREAKER_RESET_TIMEOUT", "30"))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None,
+                  base: float = GEMINI_RETRY_BASE_DELAY, cap: float = GEMINI_RETRY_MAX_DELAY) -> float:
+    """
+    Delay before retry number attempt (0-based): full-jitter exponential backoff.
+
+    Args:
+        attempt: Index of the failed attempt
+        retry_after: Delay requested by the server, honoured up to cap
+        base: Delay ceiling of the first retry
+        cap: Upper bound of any delay
+
+    Returns:
+        Seconds to sleep
+    """
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return min(delay, cap)
+
+
+class CircuitBreaker:
+    """
+    Per-worker circuit breaker for Gemini calls.
+
+    Opens after ``threshold`` consecutive failures, then lets one probe call
+    through after ``reset_timeout`` seconds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int = GEMINI_BREAKER_THRESHOLD, reset_timeout: float = GEMINI_BREAKER_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._counters = {"opened": 0, "short_circuited": 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def is_open(self) -> bool:
+        """True while calls are being failed fast."""
+        return self.state == self.OPEN
+
+    def allow(self) -> bool:
+        """Return True if a call may be sent now; counts short-circuited calls."""
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self._counters["short_circuited"] += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """Let the next call probe again when a call ended without telling whether Gemini is healthy."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.threshold:
+                if self._state != self.OPEN:
+                    self._counters["opened"] += 1
+                    logger.warning(f"Gemini circuit breaker opened after {self._failures} failures")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        state = self.state
+        with self._lock:
+            result = dict(self._counters)
+            result.update({"state": state, "consecutive_failures": self._failures,
+                           "threshold": self.threshold, "reset_timeout": self.reset_timeout})
+        return result
+
+
+class UpstreamGuard:
+    """
+    Retry, hedging and circuit breaker policy for Gemini calls.
+
+    Hedging sends a second generateContent request when the first is slower than
+    the configured latency percentile; streams are never hedged.
+    """
+
+    def __init__(self, attempts: int = GEMINI_RETRY_ATTEMPTS, hedge_enabled: bool = GEMINI_HEDGE_ENABLED,
+                 hedge_percentile: float = GEMINI_HEDGE_PERCENTILE, hedge_min_delay: float = GEMINI_HEDGE_MIN_DELAY,
+                 hedge_default_delay: float = GEMINI_HEDGE_DEFAULT_DELAY, breaker: Optional[CircuitBreaker] = None):
+        self.attempts = max(attempts, 1)
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.breaker = breaker or CircuitBreaker()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=200)
+        self._counters = {"attempts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0}
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += amount
+
+    def record_latency(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def hedge_delay(self) -> float:
+        """Latency percentile of recent successful calls, used as the hedge trigger."""
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < GEMINI_HEDGE_MIN_SAMPLES:
+            return self.hedge_default_delay
+        index = min(int(len(samples) * self.hedge_percentile), len(samples) - 1)
+        return max(samples[index], self.hedge_min_delay)
+
+    def run(self, fn: Callable[[], T]) -> T:
+        """Run one attempt, hedged with a second copy if hedging is enabled."""
+        self.count("attempts")
+        if not self.hedge_enabled:
+            return fn()
+
+        results = queue.Queue()
+
+        def run_copy(copy: int):
+            try:
+                results.put((copy, True, fn()))
+            except Exception as e:
+                results.put((copy, False, e))
+
+        threading.Thread(target=run_copy, args=(0,), daemon=True).start()
+        try:
+            copy, ok, value = results.get(timeout=self.hedge_delay())
+            launched = 1
+        except queue.Empty:
+            # Request đầu chậm bất thường: gửi bản dự phòng, bản nào xong trước thắng
+            self.count("hedges")
+            threading.Thread(target=run_copy, args=(1,), daemon=True).start()
+            copy, ok, value = results.get()
+            launched = 2
+
+        if not ok and launched == 2:
+            # Bản đầu lỗi thì đợi bản còn lại trước khi bỏ cuộc
+            copy, ok, value = results.get()
+        if ok and copy == 1:
+            self.count("hedge_wins")
+        if ok:
+            return value
+        raise value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            result = dict(self._counters)
+        result.update({
+            "hedge_enabled": self.hedge_enabled,
+            "hedge_delay_s": round(self.hedge_delay(), 3),
+            "max_attempts": self.attempts,
+            "breaker": self.breaker.stats(),
+        })
+        return result
+
+
+# Chính sách dùng chung cho cả module, mỗi worker gunicorn có một bản riêng
+upstream_guard = UpstreamGuard()
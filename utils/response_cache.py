@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+import unicodedata
+from typing import Optional, Dict, Any
+
+from utils.sqlite_store import SqliteStore, STATS_TABLE
+
+logger = logging.getLogger(__name__)
+
+# Cấu hình cache - có thể ghi đè bằng biến môi trường
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "1") != "0"
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", os.path.join("instance", "response_cache.db"))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+# Bộ đếm hit/miss gom trong bộ nhớ và ghi vào SQLite tối đa một lần mỗi khoảng này (giây)
+RESPONSE_CACHE_STATS_FLUSH = float(os.environ.get("RESPONSE_CACHE_STATS_FLUSH", "5"))
+# Dọn mục hết hạn và mục thừa sau mỗi bấy nhiêu lần ghi của một worker, không đếm bảng mỗi lần ghi;
+# cache có thể tạm vượt giới hạn tối đa số worker x giá trị này mục
+RESPONSE_CACHE_EVICT_EVERY = int(os.environ.get("RESPONSE_CACHE_EVICT_EVERY", "100"))
+
+# Tăng khi thay đổi prompt hệ thống để các câu trả lời cũ không còn khớp
+CACHE_KEY_VERSION = 2
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalize a prompt for cache lookups: Unicode NFC and collapsed whitespace."""
+    return " ".join(unicodedata.normalize("NFC", prompt or "").split())
+
+
+def hash_bytes(data: bytes) -> str:
+    """Return the content hash used for images in cache keys."""
+    return hashlib.sha256(data).hexdigest()
+
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS responses (
+        key TEXT PRIMARY KEY,
+        response TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        last_access REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)",
+    "CREATE INDEX IF NOT EXISTS idx_responses_created_at ON responses (created_at)",
+    STATS_TABLE,
+)
+
+
+class ResponseCache:
+    """Cache of Gemini answers in SQLite shared by all gunicorn workers, with TTL and LRU eviction."""
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, ttl: int = RESPONSE_CACHE_TTL,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, enabled: bool = RESPONSE_CACHE_ENABLED,
+                 stats_flush: float = RESPONSE_CACHE_STATS_FLUSH, evict_every: int = RESPONSE_CACHE_EVICT_EVERY):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.stats_flush = stats_flush
+        self.evict_every = max(evict_every, 1)
+        self._db = SqliteStore(path, _SCHEMA)
+        self._lock = threading.Lock()
+        self._pending: Dict[str, int] = {}
+        self._last_flush = time.monotonic()
+        self._writes = 0
+
+    def _bump(self, name: str, amount: int = 1) -> None:
+        if not amount:
+            return
+        with self._lock:
+            self._pending[name] = self._pending.get(name, 0) + amount
+            due = time.monotonic() - self._last_flush >= self.stats_flush
+        if due:
+            self._flush_stats()
+
+    def _flush_stats(self) -> None:
+        """Add the counters gathered in this worker to the shared stats table."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            self._db.connect().executemany("INSERT INTO stats (name, value) VALUES (?, ?) "
+                                           "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                                           list(pending.items()))
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache stats update failed: {e}")
+            # Giữ lại để ghi ở lần sau
+            with self._lock:
+                for name, amount in pending.items():
+                    self._pending[name] = self._pending.get(name, 0) + amount
+
+    def record_lookup(self, hit: bool) -> None:
+        """Count one lookup made of get() calls with record=False."""
+        if self.enabled:
+            self._bump("hits" if hit else "misses")
+
+    @staticmethod
+    def make_key(prompt: str, mode: str, solution_mode: str, subject: str,
+                 image_hash: Optional[str] = None) -> str:
+        """
+        Build the cache key for a request.
+
+        Args:
+            prompt: The user's message/query
+            mode: The mode (trợ lý or giải bài tập)
+            solution_mode: The solution mode (full, step_by_step, or hint)
+            subject: The academic subject
+            image_hash: Optional content hash of the attached image
+
+        Returns:
+            Hex digest identifying the request
+        """
+        raw = json.dumps([CACHE_KEY_VERSION, normalize_prompt(prompt), mode, solution_mode, subject, image_hash],
+                         ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str, record: bool = True) -> Optional[str]:
+        """
+        Return the cached response for key, or None on a miss or expired entry.
+
+        Args:
+            key: Value of make_key() for the request
+            record: Count the result as a hit or miss; callers that try
+                several keys for one request pass False and call
+                record_lookup() once with the overall result
+        """
+        if not self.enabled:
+            return None
+        response = None
+        try:
+            conn = self._db.connect()
+            now = time.time()
+            row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._bump("expirations")
+            elif row is not None:
+                conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                response = row[0]
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache read failed: {e}")
+        if record:
+            self.record_lookup(response is not None)
+        return response
+
+    def set(self, key: str, response: str) -> None:
+        """Store a response; every evict_every writes, evict expired and least recently used entries."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._writes += 1
+            due = self._writes % self.evict_every == 0
+        try:
+            now = time.time()
+            self._db.connect().execute("INSERT OR REPLACE INTO responses (key, response, created_at, last_access) "
+                                       "VALUES (?, ?, ?, ?)", (key, response, now, now))
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache write failed: {e}")
+            return
+        if due:
+            self.evict()
+
+    def evict(self) -> None:
+        """Delete expired entries, then the least recently used ones above max_entries."""
+        try:
+            conn = self._db.connect()
+            expired = conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,)).rowcount
+            self._bump("expirations", expired)
+            overflow = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                evicted = conn.execute("DELETE FROM responses WHERE key IN "
+                                       "(SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                                       (overflow,)).rowcount
+                self._bump("evictions", evicted)
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache eviction failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss/eviction counters shared by all workers (other workers' last few seconds may be missing)."""
+        result = {"enabled": self.enabled, "hits": 0, "misses": 0, "evictions": 0, "expirations": 0,
+                  "entries": 0, "max_entries": self.max_entries, "ttl": self.ttl}
+        if not self.enabled:
+            return result
+        self._flush_stats()
+        try:
+            conn = self._db.connect()
+            for name, value in conn.execute("SELECT name, value FROM stats"):
+                result[name] = value
+            result["entries"] = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache stats failed: {e}")
+        lookups = result["hits"] + result["misses"]
+        result["hit_rate"] = round(result["hits"] / lookups, 4) if lookups else 0.0
+        return result
+
+
+# Cache dùng chung cho cả module
+response_cache = ResponseCache()
@@ -0,0 +1,219 @@
+import os
+import math
+import time
+import logging
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List
+
+logger = logging.getLogger(__name__)
+
+# Cấu hình điều phối lời gọi Gemini trong một worker - có thể ghi đè bằng biến môi trường
+SCHEDULER_MAX_CONCURRENCY = int(os.environ.get("SCHEDULER_MAX_CONCURRENCY", "32"))
+SCHEDULER_MAX_QUEUE = int(os.environ.get("SCHEDULER_MAX_QUEUE", "64"))
+# Số lời gọi một session được chạy cùng lúc và được xếp hàng
+SCHEDULER_MAX_PER_SESSION = int(os.environ.get("SCHEDULER_MAX_PER_SESSION", "2"))
+SCHEDULER_MAX_QUEUED_PER_SESSION = int(os.environ.get("SCHEDULER_MAX_QUEUED_PER_SESSION", "4"))
+# Chờ quá lâu thì trả 429 thay vì giữ request
+SCHEDULER_MAX_WAIT = float(os.environ.get("SCHEDULER_MAX_WAIT", "10"))
+
+# Số càng nhỏ càng được ưu tiên: gợi ý ngắn và rẻ hơn lời giải từng bước
+PRIORITIES = {
+    "hint": 0,
+    "full": 1,
+    "step_by_step": 2,
+}
+DEFAULT_PRIORITY = 1
+
+
+class SchedulerOverloaded(Exception):
+    """Raised when a request cannot be admitted; carries the Retry-After hint in seconds."""
+
+    def __init__(self, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class _Waiter:
+    def __init__(self, session_id: str, priority: int, seq: int):
+        self.session_id = session_id
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.event = threading.Event()
+        self.admitted = False
+
+
+class _Slot:
+    def __init__(self, session_id: str, priority: int):
+        self.session_id = session_id
+        self.priority = priority
+        self.active = True
+
+
+class UpstreamScheduler:
+    """
+    Per-worker scheduler for Gemini calls.
+
+    Limits concurrent calls and picks queued requests by priority, then the
+    session with the fewest running calls. Raises SchedulerOverloaded when the
+    queue is full or the wait is too long.
+    """
+
+    def __init__(self, max_concurrency: int = SCHEDULER_MAX_CONCURRENCY, max_queue: int = SCHEDULER_MAX_QUEUE,
+                 max_per_session: int = SCHEDULER_MAX_PER_SESSION,
+                 max_queued_per_session: int = SCHEDULER_MAX_QUEUED_PER_SESSION,
+                 max_wait: float = SCHEDULER_MAX_WAIT):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_per_session = max_per_session
+        self.max_queued_per_session = max_queued_per_session
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._running = 0
+        self._running_by_session: Dict[str, int] = {}
+        self._waiters: List[_Waiter] = []
+        # Slot đang giữ của thread hiện tại, để paused() nhả nó trong lúc chờ thử lại
+        self._local = threading.local()
+        # Thời gian phục vụ trung bình (EWMA) để ước lượng Retry-After
+        self._service_time = 2.0
+        self._wait_samples = deque(maxlen=1000)
+        self._counters = {"admitted": 0, "rejected_queue_full": 0, "rejected_session": 0, "timed_out": 0}
+
+    def _can_run(self, session_id: str) -> bool:
+        return (self._running < self.max_concurrency
+                and self._running_by_session.get(session_id, 0) < self.max_per_session)
+
+    def _start(self, session_id: str) -> None:
+        self._running += 1
+        self._running_by_session[session_id] = self._running_by_session.get(session_id, 0) + 1
+        self._counters["admitted"] += 1
+
+    def _retry_after(self) -> int:
+        # Thời gian để hàng đợi hiện tại chạy hết qua các slot
+        backlog = (len(self._waiters) + self._running) / max(self.max_concurrency, 1)
+        return max(1, math.ceil(backlog * self._service_time))
+
+    def _dispatch(self) -> None:
+        """Hand free slots to the best eligible waiters; caller holds the lock."""
+        while self._waiters and self._running < self.max_concurrency:
+            eligible = [w for w in self._waiters if self._can_run(w.session_id)]
+            if not eligible:
+                return
+            waiter = min(eligible, key=lambda w: (w.priority, self._running_by_session.get(w.session_id, 0), w.seq))
+            self._waiters.remove(waiter)
+            self._start(waiter.session_id)
+            waiter.admitted = True
+            waiter.event.set()
+
+    def _admit(self, session_id: str, priority: int) -> None:
+        with self._lock:
+            if not self._waiters and self._can_run(session_id):
+                self._start(session_id)
+                self._wait_samples.append(0.0)
+                return
+
+            if len(self._waiters) >= self.max_queue:
+                self._counters["rejected_queue_full"] += 1
+                raise SchedulerOverloaded(self._retry_after(), "queue full")
+            queued = sum(1 for w in self._waiters if w.session_id == session_id)
+            if queued >= self.max_queued_per_session:
+                self._counters["rejected_session"] += 1
+                raise SchedulerOverloaded(self._retry_after(), "too many queued requests for this session")
+
+            waiter = _Waiter(session_id, priority, next(self._seq))
+            self._waiters.append(waiter)
+            # Có thể được chạy ngay nếu chỉ bị chặn bởi thứ tự
+            self._dispatch()
+
+        waiter.event.wait(self.max_wait)
+        with self._lock:
+            if not waiter.admitted:
+                self._waiters.remove(waiter)
+                self._counters["timed_out"] += 1
+                raise SchedulerOverloaded(self._retry_after(), "timed out waiting for a slot")
+            self._wait_samples.append(time.monotonic() - waiter.enqueued_at)
+
+    def _release(self, session_id: str, elapsed: Optional[float]) -> None:
+        with self._lock:
+            self._running -= 1
+            remaining = self._running_by_session.get(session_id, 1) - 1
+            if remaining:
+                self._running_by_session[session_id] = remaining
+            else:
+                self._running_by_session.pop(session_id, None)
+            if elapsed is not None:
+                self._service_time = 0.9 * self._service_time + 0.1 * elapsed
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, session_id: Optional[str], solution_mode: Optional[str] = None):
+        """
+        Hold an upstream slot for the duration of the block.
+
+        Args:
+            session_id: Identity used for per-session fairness
+            solution_mode: Used to pick the priority class
+
+        Raises:
+            SchedulerOverloaded: If the request is rejected or waited too long
+        """
+        held = _Slot(session_id or "anonymous", PRIORITIES.get(solution_mode, DEFAULT_PRIORITY))
+        self._admit(held.session_id, held.priority)
+        started = time.monotonic()
+        outer, self._local.slot = getattr(self._local, "slot", None), held
+        try:
+            yield
+        finally:
+            self._local.slot = outer
+            # Slot có thể đã được nhả trong paused() mà không lấy lại được
+            if held.active:
+                self._release(held.session_id, time.monotonic() - started)
+
+    @contextmanager
+    def paused(self):
+        """
+        Give up the slot held by this thread for the block, e.g. while sleeping before a retry.
+
+        The slot is taken again, with the same session and priority, when the
+        block ends; outside slot() the block just runs.
+
+        Raises:
+            SchedulerOverloaded: If the slot cannot be taken again
+        """
+        held = getattr(self._local, "slot", None)
+        if held is None or not held.active:
+            yield
+            return
+        held.active = False
+        self._release(held.session_id, None)
+        try:
+            yield
+        finally:
+            self._admit(held.session_id, held.priority)
+            held.active = True
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queue length, running calls and wait times of this worker."""
+        with self._lock:
+            result = dict(self._counters)
+            waits = sorted(self._wait_samples)
+            result.update({
+                "running": self._running,
+                "queued": len(self._waiters),
+                "sessions_running": len(self._running_by_session),
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "service_time_s": round(self._service_time, 3),
+            })
+        result["wait_ms_avg"] = round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0
+        result["wait_ms_p95"] = round(waits[min(int(len(waits) * 0.95), len(waits) - 1)] * 1000, 1) if waits else 0.0
+        return result
+
+
+# Bộ điều phối dùng chung cho cả module, mỗi worker gunicorn có một bản riêng
+upstream_scheduler = UpstreamScheduler()
@@ -0,0 +1,272 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+from typing import Optional, Dict, Any, Callable
+
+from utils.sqlite_store import SqliteStore, STATS_TABLE
+
+logger = logging.getLogger(__name__)
+
+# Cấu hình gộp request trùng đang chờ Gemini - có thể ghi đè bằng biến môi trường
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "1") != "0"
+SINGLE_FLIGHT_PATH = os.environ.get("SINGLE_FLIGHT_PATH", os.path.join("instance", "single_flight.db"))
+# Quá thời gian này mà leader chưa xong thì coi như leader đã chết
+SINGLE_FLIGHT_LEASE = float(os.environ.get("SINGLE_FLIGHT_LEASE", "90"))
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.environ.get("SINGLE_FLIGHT_POLL_INTERVAL", "0.05"))
+# Giữ kết quả đã xong một lúc cho các worker đang chờ kịp đọc
+SINGLE_FLIGHT_RESULT_TTL = float(os.environ.get("SINGLE_FLIGHT_RESULT_TTL", "30"))
+# Bộ đếm gom trong bộ nhớ và ghi vào SQLite tối đa một lần mỗi khoảng này (giây)
+SINGLE_FLIGHT_STATS_FLUSH = float(os.environ.get("SINGLE_FLIGHT_STATS_FLUSH", "5"))
+
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS flights (
+        key TEXT PRIMARY KEY,
+        owner INTEGER NOT NULL,
+        started_at REAL NOT NULL,
+        result TEXT,
+        finished_at REAL
+    )""",
+    STATS_TABLE,
+)
+
+
+class Flight:
+    """One caller's share in a coalesced call; leaders must publish or fail it."""
+
+    def __init__(self, group: "SingleFlight", key: str, leader: bool, call: "_Call"):
+        self.group = group
+        self.key = key
+        self.leader = leader
+        self._call = call
+
+    def publish(self, result: str) -> None:
+        """Share the leader's result with every follower."""
+        self.group._finish(self, result, None)
+
+    def fail(self, error: Optional[BaseException] = None) -> None:
+        """
+        Release followers after the leader failed or gave up.
+
+        Local followers re-raise error if it is an ordinary exception; with no
+        error (e.g. the client disconnected) they make the call themselves.
+        """
+        self.group._finish(self, None, error if isinstance(error, Exception) else None, failed=True)
+
+    def wait(self) -> Optional[str]:
+        """
+        Wait for the leader's result.
+
+        Returns:
+            The shared result, or None if the leader failed or vanished and
+            the caller should make the upstream call itself
+
+        Raises:
+            The leader's exception for followers in the same worker
+        """
+        call = self._call
+        call.event.wait(self.group.lease)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.remote = False
+
+
+class SingleFlight:
+    """Coalesce identical Gemini calls in flight, within a worker and across workers via SQLite."""
+
+    def __init__(self, path: str = SINGLE_FLIGHT_PATH, lease: float = SINGLE_FLIGHT_LEASE,
+                 poll_interval: float = SINGLE_FLIGHT_POLL_INTERVAL,
+                 result_ttl: float = SINGLE_FLIGHT_RESULT_TTL, enabled: bool = SINGLE_FLIGHT_ENABLED,
+                 stats_flush: float = SINGLE_FLIGHT_STATS_FLUSH):
+        self.path = path
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+        self.enabled = enabled
+        self.stats_flush = stats_flush
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._db = SqliteStore(path, _SCHEMA)
+        self._pending: Dict[str, int] = {}
+        self._last_flush = time.monotonic()
+
+    def _bump(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._pending[name] = self._pending.get(name, 0) + amount
+            due = time.monotonic() - self._last_flush >= self.stats_flush
+        if due:
+            self._flush_stats()
+
+    def _flush_stats(self) -> None:
+        """Add the counters gathered in this worker to the shared stats table."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            self._db.connect().executemany("INSERT INTO stats (name, value) VALUES (?, ?) "
+                                           "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                                           list(pending.items()))
+        except sqlite3.Error as e:
+            logger.warning(f"Single-flight stats update failed: {e}")
+            # Giữ lại để ghi ở lần sau
+            with self._lock:
+                for name, amount in pending.items():
+                    self._pending[name] = self._pending.get(name, 0) + amount
+
+    def _claim(self, key: str) -> bool:
+        """Try to become the leader for key across workers."""
+        conn = self._db.connect()
+        now = time.time()
+        conn.execute("DELETE FROM flights WHERE finished_at < ?", (now - self.result_ttl,))
+        if conn.execute("INSERT OR IGNORE INTO flights (key, owner, started_at) VALUES (?, ?, ?)",
+                        (key, os.getpid(), now)).rowcount:
+            return True
+        # Dòng cũ đã xong hoặc leader quá hạn: giành lại quyền leader
+        return conn.execute("UPDATE flights SET owner = ?, started_at = ?, result = NULL, finished_at = NULL "
+                            "WHERE key = ? AND (finished_at IS NOT NULL OR started_at < ?)",
+                            (os.getpid(), now, key, now - self.lease)).rowcount == 1
+
+    def _poll(self, key: str) -> Optional[str]:
+        """Wait for another worker's leader; None if it failed or timed out."""
+        deadline = time.time() + self.lease
+        conn = self._db.connect()
+        while time.time() < deadline:
+            row = conn.execute("SELECT result, finished_at FROM flights WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None:
+                return row[0]
+            time.sleep(self.poll_interval)
+        return None
+
+    def join(self, key: str) -> Flight:
+        """
+        Join the in-flight call for key, or start one.
+
+        Args:
+            key: Identity of the upstream call (the response cache key)
+
+        Returns:
+            A Flight; when ``flight.leader`` is True the caller makes the
+            upstream call and must publish or fail it
+        """
+        if not self.enabled:
+            return Flight(self, key, True, _Call())
+
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                joined = False
+            else:
+                joined = True
+        if joined:
+            self._bump("local_followers")
+            return Flight(self, key, False, call)
+
+        try:
+            if not self._claim(key):
+                call.remote = True
+        except sqlite3.Error as e:
+            logger.warning(f"Single-flight claim failed: {e}")
+
+        if not call.remote:
+            return Flight(self, key, True, call)
+
+        # Worker khác đang gọi Gemini cho key này: chờ kết quả thay vì gọi lại
+        try:
+            result = self._poll(key)
+        except sqlite3.Error as e:
+            logger.warning(f"Single-flight poll failed: {e}")
+            result = None
+        if result is None:
+            # Leader bên kia lỗi hoặc quá hạn: worker này tự gọi
+            call.remote = False
+            return Flight(self, key, True, call)
+
+        self._bump("remote_followers")
+        self._release(key, call, result, None)
+        return Flight(self, key, False, call)
+
+    def _release(self, key: str, call: _Call, result: Optional[str], error: Optional[BaseException]) -> None:
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.result = result
+        call.error = error
+        call.event.set()
+
+    def _finish(self, flight: Flight, result: Optional[str], error: Optional[BaseException],
+                failed: bool = False) -> None:
+        if self.enabled:
+            self._bump("leaders")
+            try:
+                conn = self._db.connect()
+                if not failed:
+                    conn.execute("UPDATE flights SET result = ?, finished_at = ? WHERE key = ? AND owner = ?",
+                                 (result, time.time(), flight.key, os.getpid()))
+                else:
+                    # Xóa dòng để follower ở worker khác tự gọi lại
+                    conn.execute("DELETE FROM flights WHERE key = ? AND owner = ?", (flight.key, os.getpid()))
+            except sqlite3.Error as e:
+                logger.warning(f"Single-flight publish failed: {e}")
+        self._release(flight.key, flight._call, result, error)
+
+    def do(self, key: str, fn: Callable[[], str]) -> str:
+        """
+        Run fn once for all concurrent callers with the same key.
+
+        Args:
+            key: Identity of the upstream call
+            fn: Makes the upstream call and returns its result
+
+        Returns:
+            fn's result, possibly produced by another caller
+        """
+        flight = self.join(key)
+        if not flight.leader:
+            result = flight.wait()
+            if result is not None:
+                return result
+            return fn()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            flight.fail(e)
+            raise
+        flight.publish(result)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        """Return coalescing counters shared by all workers."""
+        result = {"enabled": self.enabled, "leaders": 0, "local_followers": 0, "remote_followers": 0,
+                  "in_flight": 0}
+        self._flush_stats()
+        try:
+            for name, value in self._db.connect().execute("SELECT name, value FROM stats"):
+                result[name] = value
+            result["in_flight"] = self._db.connect().execute(
+                "SELECT COUNT(*) FROM flights WHERE finished_at IS NULL").fetchone()[0]
+        except sqlite3.Error as e:
+            logger.warning(f"Single-flight stats failed: {e}")
+        # Mỗi follower là một lời gọi Gemini được tiết kiệm
+        result["upstream_calls_saved"] = result["local_followers"] + result["remote_followers"]
+        return result
+
+
+# Bộ gộp request dùng chung cho cả module
+single_flight = SingleFlight()
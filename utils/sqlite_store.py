@@ -0,0 +1,43 @@
+import os
+import sqlite3
+import threading
+from typing import Sequence
+
+# Bảng bộ đếm dùng chung cho các store gom thống kê giữa các worker
+STATS_TABLE = """CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+)"""
+
+
+class SqliteStore:
+    """SQLite database file (WAL mode) shared by all gunicorn workers."""
+
+    def __init__(self, path: str, schema: Sequence[str]):
+        """
+        Args:
+            path: Database file; its directory is created on first use
+            schema: CREATE ... IF NOT EXISTS statements run on each new connection
+        """
+        self.path = path
+        self.schema = tuple(schema)
+        self._local = threading.local()
+
+    def connect(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it and creating the schema if needed."""
+        # Mỗi thread (và mỗi tiến trình sau khi fork) có kết nối riêng
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.schema:
+            conn.execute(statement)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import uuid
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Callable, Tuple
+
+from utils.scheduler import SchedulerOverloaded
+from utils.sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+# Hàng đợi xử lý ảnh tải lên ở chế độ bất đồng bộ - có thể ghi đè bằng biến môi trường
+UPLOAD_JOBS_PATH = os.environ.get("UPLOAD_JOBS_PATH", os.path.join("instance", "upload_jobs.db"))
+# Số job chạy cùng lúc trong mỗi worker (mỗi job giữ một lời gọi Gemini)
+UPLOAD_JOBS_WORKERS = int(os.environ.get("UPLOAD_JOBS_WORKERS", "4"))
+# Job chờ quá số này trong một worker thì từ chối ngay bằng 429
+UPLOAD_JOBS_MAX_QUEUED = int(os.environ.get("UPLOAD_JOBS_MAX_QUEUED", "32"))
+# Giữ kết quả để client thăm dò và để lần tải lại cùng ảnh dùng lại job cũ
+UPLOAD_JOBS_RESULT_TTL = float(os.environ.get("UPLOAD_JOBS_RESULT_TTL", "600"))
+# Job đang chạy quá thời gian này (tính từ lúc bắt đầu chạy) coi như worker chạy nó đã chết
+UPLOAD_JOBS_LEASE = float(os.environ.get("UPLOAD_JOBS_LEASE", "300"))
+# Job chờ trong hàng quá thời gian này mà chưa chạy thì bỏ, client được báo tải lại
+UPLOAD_JOBS_QUEUE_TIMEOUT = float(os.environ.get("UPLOAD_JOBS_QUEUE_TIMEOUT", "120"))
+UPLOAD_JOBS_POLL_INTERVAL = float(os.environ.get("UPLOAD_JOBS_POLL_INTERVAL", "0.2"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+FINISHED_STATES = (JOB_DONE, JOB_FAILED)
+INTERRUPTED_MESSAGE = "Job bị gián đoạn, vui lòng tải ảnh lên lại"
+QUEUE_TIMEOUT_MESSAGE = "Hệ thống đang bận, job chờ quá lâu. Vui lòng tải ảnh lên lại"
+
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        key TEXT NOT NULL UNIQUE,
+        status TEXT NOT NULL,
+        owner INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL,
+        result TEXT,
+        error TEXT
+    )""",
+)
+
+
+class UploadJobQueue:
+    """
+    Job queue for asynchronous ``/upload_image`` requests, shared by all workers via SQLite.
+
+    Jobs are keyed by image and parameters, so a resubmitted upload attaches to its existing job.
+    """
+
+    def __init__(self, path: str = UPLOAD_JOBS_PATH, workers: int = UPLOAD_JOBS_WORKERS,
+                 max_queued: int = UPLOAD_JOBS_MAX_QUEUED, result_ttl: float = UPLOAD_JOBS_RESULT_TTL,
+                 lease: float = UPLOAD_JOBS_LEASE, queue_timeout: float = UPLOAD_JOBS_QUEUE_TIMEOUT,
+                 poll_interval: float = UPLOAD_JOBS_POLL_INTERVAL):
+        self.path = path
+        self.workers = workers
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self.lease = lease
+        self.queue_timeout = queue_timeout
+        self.poll_interval = poll_interval
+        self._db = SqliteStore(path, _SCHEMA)
+        self._lock = threading.Lock()
+        # Báo cho người chờ trong cùng worker ngay khi job đổi trạng thái, không cần thăm dò
+        self._changed = threading.Condition(self._lock)
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+        self._running = 0
+        self._counters = {"submitted": 0, "attached": 0, "completed": 0, "failed": 0, "rejected": 0}
+
+    def _pool(self) -> ThreadPoolExecutor:
+        # Pool tạo lại trong tiến trình mới: thread không đi theo fork
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=max(self.workers, 1),
+                                                    thread_name_prefix="upload-job")
+                self._pid, self._pending, self._running = os.getpid(), 0, 0
+            return self._executor
+
+    def _claim(self, key: str) -> Tuple[str, bool]:
+        """Create a job for key, or return the live job that already has it; (job id, attached)."""
+        conn = self._db.connect()
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        conn.execute("DELETE FROM jobs WHERE finished_at < ?", (now - self.result_ttl,))
+        if conn.execute("INSERT OR IGNORE INTO jobs (id, key, status, owner, created_at) VALUES (?, ?, ?, ?, ?)",
+                        (job_id, key, JOB_QUEUED, os.getpid(), now)).rowcount:
+            return job_id, False
+        # Job cũ thất bại, chờ quá lâu hoặc worker chạy nó đã chết: thay bằng job mới cùng key
+        if conn.execute("UPDATE jobs SET id = ?, status = ?, owner = ?, created_at = ?, started_at = NULL, "
+                        "finished_at = NULL, result = NULL, error = NULL "
+                        "WHERE key = ? AND (status = ? OR (status = ? AND created_at < ?) "
+                        "OR (status = ? AND started_at < ?))",
+                        (job_id, JOB_QUEUED, os.getpid(), now, key, JOB_FAILED, JOB_QUEUED,
+                         now - self.queue_timeout, JOB_RUNNING, now - self.lease)).rowcount:
+            return job_id, False
+        row = conn.execute("SELECT id FROM jobs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            # Dòng vừa bị xóa giữa hai câu lệnh: thử lại một lần
+            return self._claim(key)
+        return row[0], True
+
+    def submit(self, key: str, run: Callable[[], Dict[str, Any]]) -> Tuple[str, bool]:
+        """
+        Queue run() under key, or attach to the job already holding key.
+
+        Args:
+            key: Content hash of the upload plus every parameter that changes the answer
+            run: Pipeline to run in the job pool; returns the JSON-serializable result
+
+        Returns:
+            (job id, attached) where attached is True for an existing job
+
+        Raises:
+            SchedulerOverloaded: Too many jobs are already waiting in this worker
+        """
+        pool = self._pool()
+        with self._lock:
+            if self._pending >= self.max_queued:
+                self._counters["rejected"] += 1
+                raise SchedulerOverloaded(max(int(self.poll_interval * self.max_queued), 1),
+                                          f"{self._pending} upload jobs queued")
+        job_id, attached = self._claim(key)
+        with self._lock:
+            self._counters["attached" if attached else "submitted"] += 1
+            if not attached:
+                self._pending += 1
+        if not attached:
+            pool.submit(self._run, job_id, run)
+        return job_id, attached
+
+    def _run(self, job_id: str, run: Callable[[], Dict[str, Any]]) -> None:
+        with self._lock:
+            self._pending -= 1
+            self._running += 1
+        conn = self._db.connect()
+        # Mặc định là lỗi: kể cả BaseException (vd. gevent Timeout) cũng không để dòng kẹt ở "running"
+        result, error = None, INTERRUPTED_MESSAGE
+        try:
+            now = time.time()
+            # Job chờ quá hạn (hoặc đã bị job mới cùng key thay thế) thì không chạy nữa
+            if not conn.execute("UPDATE jobs SET status = ?, started_at = ? WHERE id = ? AND status = ? "
+                                "AND created_at >= ?",
+                                (JOB_RUNNING, now, job_id, JOB_QUEUED, now - self.queue_timeout)).rowcount:
+                error = QUEUE_TIMEOUT_MESSAGE
+                return
+            self._notify()
+            result = json.dumps(run(), ensure_ascii=False)
+            error = None
+        except Exception as e:
+            logger.error(f"Upload job {job_id} failed: {str(e)}")
+            error = str(e)
+        finally:
+            try:
+                conn.execute("UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = ? "
+                             "WHERE id = ? AND status IN (?, ?)",
+                             (JOB_FAILED if error is not None else JOB_DONE, time.time(), result, error, job_id,
+                              JOB_QUEUED, JOB_RUNNING))
+            except sqlite3.Error as e:
+                logger.error(f"Upload job {job_id} could not be saved: {e}")
+            with self._lock:
+                self._running -= 1
+                self._counters["failed" if error is not None else "completed"] += 1
+            self._notify()
+
+    def _notify(self) -> None:
+        with self._changed:
+            self._changed.notify_all()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the state of a job.
+
+        Returns:
+            A dict with id, status, timestamps and, once finished, result or
+            error; None for unknown or expired jobs
+        """
+        row = self._db.connect().execute(
+            "SELECT status, created_at, started_at, finished_at, result, error FROM jobs WHERE id = ?",
+            (job_id,)).fetchone()
+        if row is None:
+            return None
+        status, created_at, started_at, finished_at, result, error = row
+        now = time.time()
+        if finished_at is not None and finished_at < now - self.result_ttl:
+            return None
+        if status == JOB_QUEUED and created_at < now - self.queue_timeout:
+            status, error = JOB_FAILED, QUEUE_TIMEOUT_MESSAGE
+        elif status == JOB_RUNNING and started_at < now - self.lease:
+            status, error = JOB_FAILED, INTERRUPTED_MESSAGE
+        job = {"id": job_id, "status": status, "created_at": created_at, "started_at": started_at,
+               "finished_at": finished_at}
+        if status == JOB_DONE:
+            job["result"] = json.loads(result)
+        elif status == JOB_FAILED:
+            job["error"] = error
+        return job
+
+    def wait(self, job_id: str, status: Optional[str], timeout: float) -> Optional[Dict[str, Any]]:
+        """Wait up to timeout for the job to leave status; return its current state."""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job["status"] != status or remaining <= 0:
+                return job
+            # Job của worker này báo ngay qua Condition; job ở worker khác thì thăm dò SQLite
+            with self._changed:
+                self._changed.wait(min(self.poll_interval, remaining))
+
+    def stats(self) -> Dict[str, Any]:
+        """Return job counters and queue depth of this worker plus job counts by status in the shared table."""
+        with self._lock:
+            result = dict(self._counters)
+            result.update({"queued": self._pending, "running": self._running})
+        result.update({"workers": self.workers, "max_queued": self.max_queued, "result_ttl": self.result_ttl,
+                       "lease": self.lease, "queue_timeout": self.queue_timeout, "jobs": {}})
+        try:
+            result["jobs"] = dict(self._db.connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+        except sqlite3.Error as e:
+            logger.warning(f"Upload job stats failed: {e}")
+        return result
+
+
+# Hàng đợi dùng chung cho cả module
+upload_jobs = UploadJobQueue()
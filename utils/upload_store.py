@@ -0,0 +1,176 @@
+import os
+import time
+import logging
+import threading
+from typing import Optional, Dict, Any, Tuple
+from utils.huggingface_api import sniff_mime_type
+
+logger = logging.getLogger(__name__)
+
+# Chính sách lưu trữ ảnh tải lên - có thể ghi đè bằng biến môi trường
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(1024 * 1024 * 1024)))
+UPLOAD_MAX_AGE = int(os.environ.get("UPLOAD_MAX_AGE", str(30 * 24 * 3600)))
+UPLOAD_SWEEP_INTERVAL = int(os.environ.get("UPLOAD_SWEEP_INTERVAL", "600"))
+
+EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+OPTIMIZED_SUFFIX = ".optimized.jpg"
+
+
+class UploadStore:
+    """
+    Content-addressed (SHA-256) store for uploaded images with age and size based cleanup.
+
+    Files directly under ``root`` are not part of the store and are never deleted.
+    """
+
+    def __init__(self, root: str, max_bytes: int = UPLOAD_MAX_BYTES, max_age: int = UPLOAD_MAX_AGE,
+                 sweep_interval: int = UPLOAD_SWEEP_INTERVAL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._counters = {"uploads": 0, "dedupe_hits": 0, "evicted_files": 0, "evicted_bytes": 0}
+
+    def _directory(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2])
+
+    def relative_paths(self, sha256: str, data: bytes) -> Tuple[str, str]:
+        """Return the original and optimized paths relative to the store root."""
+        extension = EXTENSIONS.get(sniff_mime_type(data), ".bin")
+        prefix = f"{sha256[:2]}/{sha256}"
+        return f"{prefix}{extension}", f"{prefix}{OPTIMIZED_SUFFIX}"
+
+    def load_optimized(self, sha256: str) -> Optional[bytes]:
+        """
+        Return the stored optimized JPEG for an upload, refreshing its age.
+
+        Args:
+            sha256: Content hash of the original upload
+
+        Returns:
+            The optimized JPEG bytes, or None if this content was not stored yet
+        """
+        with self._lock:
+            self._counters["uploads"] += 1
+        path = os.path.join(self._directory(sha256), f"{sha256}{OPTIMIZED_SUFFIX}")
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        # Cập nhật mtime để lượt dọn coi ảnh này là mới dùng
+        now = time.time()
+        for name in os.listdir(self._directory(sha256)):
+            if name.startswith(sha256):
+                try:
+                    os.utime(os.path.join(self._directory(sha256), name), (now, now))
+                except FileNotFoundError:
+                    pass
+        with self._lock:
+            self._counters["dedupe_hits"] += 1
+        return data
+
+    def save(self, sha256: str, original: bytes, optimized_jpeg: Optional[bytes]) -> None:
+        """Store the original upload and, unless optimizing it failed (None), its optimized JPEG."""
+        original_path, optimized_path = self.relative_paths(sha256, original)
+        os.makedirs(self._directory(sha256), exist_ok=True)
+        files = [(original_path, original)]
+        if optimized_jpeg is not None:
+            files.append((optimized_path, optimized_jpeg))
+        # Ghi file tạm rồi đổi tên để worker khác không đọc phải file dở dang
+        for relative_path, data in files:
+            path = os.path.join(self.root, relative_path)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        self.maybe_sweep()
+
+    def _stored_files(self):
+        # Chỉ duyệt các thư mục con 2 ký tự hex do kho tạo ra
+        for directory in os.listdir(self.root):
+            path = os.path.join(self.root, directory)
+            if len(directory) != 2 or not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                file_path = os.path.join(path, name)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                yield file_path, name.split(".", 1)[0], stat.st_size, stat.st_mtime
+
+    def maybe_sweep(self) -> None:
+        """Run a sweep if the last one in this worker is older than the sweep interval."""
+        now = time.time()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        try:
+            self.sweep()
+        except OSError as e:
+            logger.warning(f"Upload store sweep failed: {e}")
+
+    def sweep(self) -> Dict[str, int]:
+        """
+        Evict expired uploads, then the least recently used ones above the size limit.
+
+        Returns:
+            Number of files and bytes removed in this sweep
+        """
+        now = time.time()
+        # Gom file theo hash để luôn xóa ảnh gốc cùng bản tối ưu
+        groups: Dict[str, Dict[str, Any]] = {}
+        for file_path, sha256, size, mtime in self._stored_files():
+            group = groups.setdefault(sha256, {"files": [], "size": 0, "mtime": 0.0})
+            group["files"].append(file_path)
+            group["size"] += size
+            group["mtime"] = max(group["mtime"], mtime)
+
+        total = sum(group["size"] for group in groups.values())
+        removed_files = 0
+        removed_bytes = 0
+        for group in sorted(groups.values(), key=lambda g: g["mtime"]):
+            if now - group["mtime"] <= self.max_age and total <= self.max_bytes:
+                break
+            for file_path in group["files"]:
+                try:
+                    os.remove(file_path)
+                    removed_files += 1
+                except FileNotFoundError:
+                    pass
+            total -= group["size"]
+            removed_bytes += group["size"]
+
+        with self._lock:
+            self._counters["evicted_files"] += removed_files
+            self._counters["evicted_bytes"] += removed_bytes
+        if removed_files:
+            logger.info(f"Upload store sweep removed {removed_files} files ({removed_bytes} bytes)")
+        return {"files": removed_files, "bytes": removed_bytes}
+
+    def stats(self) -> Dict[str, Any]:
+        """Return disk usage of the store and dedupe counters of this worker."""
+        files = 0
+        size = 0
+        for _, _, file_size, _ in self._stored_files():
+            files += 1
+            size += file_size
+        with self._lock:
+            result = dict(self._counters)
+        result.update({
+            "files": files,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "max_age": self.max_age,
+            "dedupe_ratio": round(result["dedupe_hits"] / result["uploads"], 4) if result["uploads"] else 0.0,
+        })
+        return result